@@ -4,15 +4,40 @@ import logging
 import click
 
 from cli.watch_command import watch
+from cli.serve_command import serve
 from cli.create_job import create_job
+from cli.tag_dir import tag_dir
+from cli.bench_batch import bench_batch
+from cli.bench_preprocess import bench_preprocess
+from cli.bench_jobs import bench_jobs
+from cli.bench_profiles import bench_profiles
+from cli.bench_scan import bench_scan
+from cli.bench_alloc import bench_alloc
+from cli.bench_captions import bench_captions
+from cli.bench_near_duplicates import bench_near_duplicates
+from cli.bench_priorities import bench_priorities
 
-@click.group()
-def cli():
+def configure_logging():
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
+@click.group()
+def cli():
+    configure_logging()
+
 cli.add_command(watch)
-cli.add_command(create_job)
\ No newline at end of file
+cli.add_command(serve)
+cli.add_command(create_job)
+cli.add_command(tag_dir)
+cli.add_command(bench_batch)
+cli.add_command(bench_preprocess)
+cli.add_command(bench_jobs)
+cli.add_command(bench_profiles)
+cli.add_command(bench_scan)
+cli.add_command(bench_alloc)
+cli.add_command(bench_captions)
+cli.add_command(bench_near_duplicates)
+cli.add_command(bench_priorities)
\ No newline at end of file
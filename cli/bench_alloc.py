@@ -0,0 +1,69 @@
+import logging
+import multiprocessing
+import time
+import tracemalloc
+
+import click
+
+from core.interrogator import Interrogator
+
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option("--image-path", "image_paths", required=True, multiple=True, help="Image to tag, may be repeated")
+@click.option("--model-name", default="SmilingWolf/wd-vit-large-tagger-v3", help="Name of the model to benchmark")
+@click.option("--batch-size", default=8, show_default=True, help="Images per model run")
+@click.option("--batches", default=50, show_default=True, help="Batches to measure")
+@click.option("--cpu-only", is_flag=True, help="Only use the CPU execution provider")
+def bench_alloc(image_paths: tuple[str], model_name: str, batch_size: int, batches: int, cpu_only: bool):
+    # Preprocesses and tags batches with and without buffer reuse, each in a fresh process, and reports the
+    # buffers allocated and the tracemalloc peak per job once warmed up.
+    context = multiprocessing.get_context("spawn")
+    for reuse_buffers in (False, True):
+        with context.Pool(1) as pool:
+            result = pool.apply(_measure, (image_paths, model_name, batch_size, batches, cpu_only, reuse_buffers))
+        logging.info(
+            f"reuse_buffers={reuse_buffers}: {result['allocations_per_job']:.2f} buffers allocated per job, "
+            f"tracemalloc peak {result['peak_kib_per_job']:.0f}KiB per job, {result['ms_per_job']:.2f}ms per job"
+        )
+
+
+def _measure(
+        image_paths: tuple[str],
+        model_name: str,
+        batch_size: int,
+        batches: int,
+        cpu_only: bool,
+        reuse_buffers: bool,
+) -> dict:
+    providers = ['CPUExecutionProvider'] if cpu_only else None
+    interrogator = Interrogator(providers=providers, reuse_buffers=reuse_buffers)
+    paths = [image_paths[index % len(image_paths)] for index in range(batch_size)]
+
+    def run_batch():
+        images = [interrogator.preprocess(path, model_name) for path in paths]
+        interrogator.process_batch(images, model_name)
+        for image in images:
+            interrogator.release(image)
+
+    # the first batches load the model and fill the pool
+    for _ in range(3):
+        run_batch()
+    allocations = interrogator.buffer_stats()["allocations"]
+    tracemalloc.start()
+    peak_bytes = 0
+    start = time.perf_counter()
+    for _ in range(batches):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        run_batch()
+        peak_bytes += tracemalloc.get_traced_memory()[1] - baseline
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+    jobs = batches * batch_size
+    return {
+        "allocations_per_job": (interrogator.buffer_stats()["allocations"] - allocations) / jobs,
+        "peak_kib_per_job": peak_bytes / batches / batch_size / 1024,
+        "ms_per_job": elapsed / jobs * 1000,
+    }
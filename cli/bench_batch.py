@@ -0,0 +1,42 @@
+import logging
+import threading
+import time
+
+import click
+
+from core.batch_scheduler import BatchScheduler, DEFAULT_MAX_WAIT
+from core.interrogator import Interrogator
+
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option("--image-path", required=True, help="Path to the image to tag repeatedly")
+@click.option("--model-name", default="SmilingWolf/wd-vit-large-tagger-v3", help="Name of the model to benchmark")
+@click.option("--count", default=64, show_default=True, help="Number of images to tag per batch size")
+@click.option("--batch-sizes", default="1,2,4,8,16", show_default=True, help="Comma separated max batch sizes to try")
+@click.option("--max-batch-wait", default=DEFAULT_MAX_WAIT, show_default=True, help="Maximum seconds to wait for a batch to fill")
+@click.option("--cpu-only", is_flag=True, help="Only use the CPU execution provider")
+def bench_batch(image_path: str, model_name: str, count: int, batch_sizes: str, max_batch_wait: float, cpu_only: bool):
+    providers = ['CPUExecutionProvider'] if cpu_only else None
+    interrogator = Interrogator(providers=providers)
+    image = interrogator.preprocess(image_path, model_name)
+    # warm up so session creation isn't counted against the first batch size
+    interrogator.process_batch([image], model_name)
+
+    for max_batch_size in [int(size) for size in batch_sizes.split(",")]:
+        scheduler = BatchScheduler(interrogator, max_batch_size=max_batch_size, max_wait=max_batch_wait)
+        scheduler.start()
+        # one submitting thread per image simulates concurrent jobs
+        threads = [
+            threading.Thread(target=lambda: scheduler.submit(image, model_name).result())
+            for _ in range(count)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        scheduler.stop()
+        logging.info(f"max_batch_size={max_batch_size}: {count} images in {elapsed:.2f}s, {count / elapsed:.2f} images/s")
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import time
+
+import click
+
+from cli.bench_jobs import TEST_ASSETS_PATH, IMAGE_EXTENSIONS
+from core.execution_profile import PROFILES
+from core.interrogator import Interrogator, ARCHITECTURE_BLIP, CAPTION_ARCHITECTURES, DEFAULT_MAX_CAPTION_TOKENS
+from core.stand_in_model import write_stand_in_captioner
+
+logger = logging.getLogger(__name__)
+
+CAPTION_MODELS = [
+    model_name for model_name in Interrogator.get_valid_models()
+    if Interrogator.get_model_architecture(model_name) in CAPTION_ARCHITECTURES
+]
+
+
+@click.command()
+@click.option("--image-path", "image_paths", multiple=True, help="Image to caption, may be repeated. The test assets by default")
+@click.option("--model-name", type=click.Choice(CAPTION_MODELS), default="Salesforce/blip-image-captioning-base", show_default=True, help="Captioning model to benchmark")
+@click.option("--stand-in", is_flag=True, help="Caption with a tiny randomly initialized BLIP written to --work-dir instead, works offline")
+@click.option("--work-dir", default=os.path.join("data", "bench", "captions"), show_default=True, help="Where the stand-in captioner is written")
+@click.option("--batch-size", "batch_sizes", type=int, multiple=True, default=[1, 4, 8, 16], show_default=True, help="Images per generate call, may be repeated")
+@click.option("--images", "image_count", default=32, show_default=True, help="Images captioned per batch size, cycling through the given ones")
+@click.option("--repeat", default=3, show_default=True, help="Timed runs over all the images per batch size")
+@click.option("--profile", "profile_name", type=click.Choice(list(PROFILES)), default="cpu", show_default=True, help="cpu-bf16 runs the model in bfloat16")
+@click.option("--threads", default=0, show_default=True, help="Torch threads, 0 for all cores")
+@click.option("--max-caption-tokens", default=DEFAULT_MAX_CAPTION_TOKENS, show_default=True, help="Longest caption generated")
+@click.option("--output", default=None, help="Write the results as JSON to this file")
+def bench_captions(
+        image_paths: tuple[str],
+        model_name: str,
+        stand_in: bool,
+        work_dir: str,
+        batch_sizes: tuple[int],
+        image_count: int,
+        repeat: int,
+        profile_name: str,
+        threads: int,
+        max_caption_tokens: int,
+        output: str,
+):
+    # Captions the same images with each batch size and reports captions per second. Greedy generation from
+    # the stand-in's random weights rarely ends early, so every caption is max_caption_tokens long.
+    model_dirs = {}
+    if stand_in:
+        if Interrogator.get_model_architecture(model_name) != ARCHITECTURE_BLIP:
+            raise ValueError(f"The stand-in captioner only stands in for BLIP models, not {model_name}")
+        model_dir = os.path.join(work_dir, "stand-in")
+        write_stand_in_captioner(model_dir, size=Interrogator.get_dimensions_for_model(model_name)[0])
+        model_dirs[model_name] = model_dir
+    if not image_paths:
+        image_paths = [
+            os.path.join(TEST_ASSETS_PATH, name) for name in sorted(os.listdir(TEST_ASSETS_PATH))
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+        ]
+
+    profile = PROFILES[profile_name].with_overrides(intra_op_threads=threads or None)
+    interrogator = Interrogator(model_dirs=model_dirs, profile=profile, max_caption_tokens=max_caption_tokens)
+    images = [interrogator.preprocess(image_paths[index % len(image_paths)], model_name) for index in range(image_count)]
+    # the first caption of each image, so the runs can be checked against each other
+    captions = [result.caption for result in interrogator.process_batch(images[:len(image_paths)], model_name)]
+    logging.info(f"Captions: {captions}")
+
+    results = {}
+    for batch_size in batch_sizes:
+        batches = [images[start:start + batch_size] for start in range(0, len(images), batch_size)]
+        # warm up this batch shape
+        interrogator.process_batch(batches[0], model_name)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for batch in batches:
+                interrogator.process_batch(batch, model_name)
+        elapsed = time.perf_counter() - start
+        results[batch_size] = {
+            "captions_per_second": repeat * len(images) / elapsed,
+            "ms_per_caption": elapsed * 1000 / (repeat * len(images)),
+        }
+        logging.info(
+            f"batch size {batch_size}: {results[batch_size]['captions_per_second']:.2f} captions/s, "
+            f"{results[batch_size]['ms_per_caption']:.1f}ms/caption"
+        )
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump({
+                "model": model_name,
+                "stand_in": stand_in,
+                "profile": profile.name,
+                "torch_dtype": profile.torch_dtype,
+                "max_caption_tokens": max_caption_tokens,
+                "captions": captions,
+                "batch_sizes": results,
+            }, f, indent=2)
+        logging.info(f"Wrote results to {output}")
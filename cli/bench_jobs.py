@@ -0,0 +1,295 @@
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import threading
+import time
+import zipfile
+
+import click
+import numpy as np
+from PIL import Image
+
+from core.batch_scheduler import DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT
+from core.job_executor import DEFAULT_IO_WORKERS, DEFAULT_PREPROCESS_WORKERS
+from core.stand_in_model import write_stand_in_model, DEFAULT_TAG_COUNT
+
+logger = logging.getLogger(__name__)
+
+TEST_ASSETS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_assets")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+# the stand-in is registered under a real model name so jobs pass validation unchanged
+BENCH_MODEL = "SmilingWolf/wd-vit-large-tagger-v3"
+DEFAULT_TOLERANCE = 0.1
+# higher is better for these, lower is better for everything else that's compared
+HIGHER_IS_BETTER = ("jobs_per_second",)
+
+
+@click.command()
+@click.option("--jobs", "job_count", default=200, show_default=True, help="Number of job zips to run")
+@click.option("--work-dir", default=os.path.join("data", "bench"), show_default=True, help="Where the stand-in model, images and job folders are created")
+@click.option("--size", default=448, show_default=True, help="Input size of the stand-in model, 448 or 256 like the real models")
+@click.option("--tag-count", default=DEFAULT_TAG_COUNT, show_default=True, help="Tags in the stand-in vocabulary")
+@click.option("--rate", default=0.0, show_default=True, help="Jobs dropped per second, 0 drops them all at once")
+@click.option("--max-batch-size", default=DEFAULT_MAX_BATCH_SIZE, show_default=True)
+@click.option("--max-batch-wait", default=DEFAULT_MAX_WAIT, show_default=True)
+@click.option("--io-workers", default=DEFAULT_IO_WORKERS, show_default=True)
+@click.option("--preprocess-workers", default=DEFAULT_PREPROCESS_WORKERS, show_default=True)
+@click.option("--extract-jobs", is_flag=True, help="Extract job zips into the working dir instead of reading them in memory")
+@click.option("--output", "output_path", default=os.path.join("data", "bench", "results.json"), show_default=True, help="Where to write the results")
+@click.option("--baseline", "baseline_path", default=None, help="Results to compare against, fails if any metric regressed")
+@click.option("--tolerance", default=DEFAULT_TOLERANCE, show_default=True, help="Fraction a metric may get worse than the baseline")
+@click.option("--save-baseline", is_flag=True, help="Also write the results to --baseline")
+def bench_jobs(
+        job_count: int,
+        work_dir: str,
+        size: int,
+        tag_count: int,
+        rate: float,
+        max_batch_size: int,
+        max_batch_wait: float,
+        io_workers: int,
+        preprocess_workers: int,
+        extract_jobs: bool,
+        output_path: str,
+        baseline_path: str,
+        tolerance: float,
+        save_baseline: bool,
+):
+    # Runs job zips end to end through the watcher, executor, scheduler and interrogator on a generated
+    # stand-in model, so it works offline. It measures everything around the model, not the real model's cost.
+    config = {
+        "jobs": job_count,
+        "size": size,
+        "tag_count": tag_count,
+        "rate": rate,
+        "max_batch_size": max_batch_size,
+        "max_batch_wait": max_batch_wait,
+        "io_workers": io_workers,
+        "preprocess_workers": preprocess_workers,
+        "extract_jobs": extract_jobs,
+    }
+    model_dir = os.path.join(work_dir, "model")
+    write_stand_in_model(model_dir, size=size, tag_count=tag_count)
+    images = _load_images(os.path.join(work_dir, "images"))
+
+    # a fresh process, so peak RSS is only this run's
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        results = pool.apply(_run, (config, work_dir, model_dir, images))
+    results["config"] = config
+    results["environment"] = _environment()
+
+    _log_results(results)
+    _write_json(output_path, results)
+    logging.info(f"Wrote results to {output_path}")
+
+    if baseline_path is None:
+        return
+    if save_baseline:
+        _write_json(baseline_path, results)
+        logging.info(f"Saved baseline to {baseline_path}")
+        return
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, tolerance)
+    if len(regressions) > 0:
+        raise click.ClickException(f"{len(regressions)} metrics regressed against {baseline_path}: {', '.join(regressions)}")
+    logging.info(f"No regressions against {baseline_path}")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    if results["config"] != baseline.get("config"):
+        logging.warning(f"Baseline was run with different settings: {baseline.get('config')}")
+    regressions = []
+    for name, current, previous in _comparable(results, baseline):
+        if name in HIGHER_IS_BETTER:
+            regressed = current < previous * (1 - tolerance)
+        else:
+            regressed = current > previous * (1 + tolerance)
+        change = (current - previous) / previous * 100 if previous else 0.0
+        logging.info(f"{name}: {previous:.2f} -> {current:.2f} ({change:+.1f}%){' REGRESSED' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def _comparable(results: dict, baseline: dict):
+    yield "jobs_per_second", results["jobs_per_second"], baseline["jobs_per_second"]
+    for percentile, value in results["latency_ms"].items():
+        yield f"latency_ms.{percentile}", value, baseline["latency_ms"][percentile]
+    yield "peak_rss_mb", results["peak_rss_mb"], baseline["peak_rss_mb"]
+
+
+def _run(config: dict, work_dir: str, model_dir: str, images: list[tuple[str, bytes]]) -> dict:
+    # imported here so the parent process doesn't pay for them
+    from watchdog.observers import Observer
+    from watchdog.observers.polling import PollingObserver
+
+    from cli.watch_command import is_running_in_docker
+    from core.batch_scheduler import BatchScheduler
+    from core.input_watcher import InputWatcher
+    from core.interrogator import Interrogator
+    from core.metrics import STAGE_SECONDS
+
+    logging.basicConfig(level=logging.WARNING)
+    input_path = os.path.join(work_dir, "input")
+    output_path = os.path.join(work_dir, "output")
+    working_path = os.path.join(work_dir, "working")
+    for path in (input_path, output_path, working_path):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    # built up front so producing jobs isn't part of what's measured
+    jobs = [
+        (f"bench-{index:05d}", _job_zip(f"bench-{index:05d}", *images[index % len(images)]))
+        for index in range(config["jobs"])
+    ]
+
+    interrogator = Interrogator(providers=["CPUExecutionProvider"], model_dirs={BENCH_MODEL: model_dir})
+    interrogator.preload(BENCH_MODEL)
+    scheduler = BatchScheduler(interrogator, max_batch_size=config["max_batch_size"], max_wait=config["max_batch_wait"])
+    scheduler.start()
+    watcher = InputWatcher(output_path, working_path, interrogator, scheduler, extract_jobs=config["extract_jobs"])
+    watcher.start_executor(io_workers=config["io_workers"], preprocess_workers=config["preprocess_workers"])
+    observer = PollingObserver() if is_running_in_docker() else Observer()
+    observer.schedule(watcher, input_path, recursive=False)
+    observer.start()
+
+    dropped_at: dict[str, float] = {}
+
+    def drop_jobs():
+        for job_id, zip_bytes in jobs:
+            tmp_path = os.path.join(input_path, f"{job_id}.zip.partial")
+            with open(tmp_path, "wb") as f:
+                f.write(zip_bytes)
+            dropped_at[job_id] = time.perf_counter()
+            os.replace(tmp_path, os.path.join(input_path, f"{job_id}.zip"))
+            if config["rate"] > 0:
+                time.sleep(1 / config["rate"])
+
+    started = time.perf_counter()
+    producer = threading.Thread(target=drop_jobs, daemon=True)
+    producer.start()
+    finished_at: dict[str, float] = {}
+    # a generous limit, so a stuck run fails instead of hanging CI
+    expiry = started + 60 + config["jobs"]
+    while len(finished_at) < len(jobs) and time.perf_counter() < expiry:
+        for entry in os.scandir(output_path):
+            job_id, extension = os.path.splitext(entry.name)
+            if extension != ".json" or job_id in finished_at:
+                continue
+            finished_at[job_id] = time.perf_counter()
+        time.sleep(0.002)
+    elapsed = time.perf_counter() - started
+    producer.join()
+
+    observer.stop()
+    observer.join()
+    watcher.stop_executor()
+    scheduler.stop()
+
+    errors = 0
+    for job_id in finished_at:
+        with open(os.path.join(output_path, f"{job_id}.json"), "r") as f:
+            if "error" in json.load(f):
+                errors += 1
+
+    latencies = np.array([
+        (finished_at[job_id] - dropped_at[job_id]) * 1000
+        for job_id in finished_at
+        if job_id in dropped_at
+    ])
+    if len(latencies) == 0:
+        latencies = np.array([np.nan])
+    return {
+        "completed": len(finished_at),
+        "errors": errors,
+        "seconds": elapsed,
+        "jobs_per_second": len(finished_at) / elapsed,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+        },
+        # ru_maxrss is in kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stage_mean_ms": {
+            stage: STAGE_SECONDS.total(stage) / STAGE_SECONDS.count(stage) * 1000
+            for (stage,) in STAGE_SECONDS.label_values()
+        },
+    }
+
+
+def _load_images(images_path: str) -> list[tuple[str, bytes]]:
+    # the test assets, plus generated images for the slow paths: a large jpeg, an alpha png and a 16 bit png
+    images = []
+    for name in sorted(os.listdir(TEST_ASSETS_PATH)):
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+            with open(os.path.join(TEST_ASSETS_PATH, name), "rb") as f:
+                images.append((name, f.read()))
+
+    rng = np.random.default_rng(0)
+    large = Image.fromarray(rng.integers(0, 256, (3072, 4096, 3), dtype=np.uint8), "RGB")
+    images.append(("large.jpg", _encode(large, "JPEG", quality=90)))
+    alpha = Image.fromarray(rng.integers(0, 256, (1024, 768, 4), dtype=np.uint8), "RGBA")
+    images.append(("alpha.png", _encode(alpha, "PNG")))
+    deep = Image.fromarray(rng.integers(0, 65536, (1200, 1600), dtype=np.uint16))
+    images.append(("deep.png", _encode(deep, "PNG")))
+
+    os.makedirs(images_path, exist_ok=True)
+    for name, image_bytes in images:
+        with open(os.path.join(images_path, name), "wb") as f:
+            f.write(image_bytes)
+    return images
+
+
+def _encode(image: Image.Image, image_format: str, **options) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def _job_zip(job_id: str, image_name: str, image_bytes: bytes, **job_spec) -> bytes:
+    # job_spec adds to job.json, ie: a priority
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_ref:
+        zip_ref.writestr(image_name, image_bytes)
+        zip_ref.writestr("job.json", json.dumps({
+            "job_id": job_id,
+            "model_name": BENCH_MODEL,
+            "input_image_filename": image_name,
+            **job_spec,
+        }))
+    return buffer.getvalue()
+
+
+def _environment() -> dict:
+    import onnxruntime
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "onnxruntime": onnxruntime.__version__,
+    }
+
+
+def _log_results(results: dict):
+    latency = results["latency_ms"]
+    logging.info(
+        f"{results['completed']} jobs ({results['errors']} errors) in {results['seconds']:.2f}s, "
+        f"{results['jobs_per_second']:.1f} jobs/s, latency p50 {latency['p50']:.0f}ms p95 {latency['p95']:.0f}ms "
+        f"p99 {latency['p99']:.0f}ms, peak RSS {results['peak_rss_mb']:.0f}MiB"
+    )
+    for stage, mean_ms in results["stage_mean_ms"].items():
+        logging.info(f"  {stage}: {mean_ms:.2f}ms mean")
+
+
+def _write_json(path: str, data: dict):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4)
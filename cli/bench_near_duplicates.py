@@ -0,0 +1,105 @@
+import io
+import logging
+import os
+import time
+
+import click
+import numpy as np
+from PIL import Image
+
+from cli.bench_jobs import TEST_ASSETS_PATH, IMAGE_EXTENSIONS, BENCH_MODEL
+from core import preprocess
+from core.near_duplicates import NearDuplicateIndex, perceptual_hash, DEFAULT_MAX_DISTANCE, MAX_DISTANCE
+from core.tagging import TaggingOptions, TagResult
+
+logger = logging.getLogger(__name__)
+
+FILL_CHUNK = 100000
+
+
+@click.command()
+@click.option("--entries", default=1000000, show_default=True, help="Random hashes the index is filled with before timing")
+@click.option("--image-path", "image_paths", multiple=True, help="Image whose resized and re-encoded copies are looked up, may be repeated. The test assets by default")
+@click.option("--work-dir", default=os.path.join("data", "bench", "near_duplicates"), show_default=True, help="Where the index is created")
+@click.option("--max-distance", type=click.IntRange(0, MAX_DISTANCE), default=DEFAULT_MAX_DISTANCE, show_default=True, help="Most differing bits for a match")
+@click.option("--lookups", default=2000, show_default=True, help="Lookups of random hashes to time")
+@click.option("--size", default=448, show_default=True, help="Input size images are preprocessed to")
+def bench_near_duplicates(image_paths: tuple[str], entries: int, work_dir: str, max_distance: int, lookups: int, size: int):
+    # Fills a near duplicate index with random hashes, stores the given images, then reports how many of their
+    # resized and re-encoded copies are found and how long lookups take. Perceptual hashes of real images
+    # cluster more than random ones, so lookups in a real index compare somewhat more candidates.
+    os.makedirs(work_dir, exist_ok=True)
+    db_path = os.path.join(work_dir, "near_duplicates.sqlite")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    if not image_paths:
+        image_paths = [
+            os.path.join(TEST_ASSETS_PATH, name) for name in sorted(os.listdir(TEST_ASSETS_PATH))
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+        ]
+
+    index = NearDuplicateIndex(db_path, max_distance=max_distance, max_entries=entries + len(image_paths))
+    options = TaggingOptions()
+    filler = TagResult(tags=["filler"])
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    for chunk_start in range(0, entries, FILL_CHUNK):
+        count = min(FILL_CHUNK, entries - chunk_start)
+        hashes = rng.integers(0, 1 << 64, count, dtype=np.uint64)
+        index.put_many([(int(image_hash), BENCH_MODEL, options, filler) for image_hash in hashes])
+    logging.info(f"Filled the index with {entries} hashes in {time.perf_counter() - start:.1f}s")
+
+    for image_path in image_paths:
+        image = preprocess.preprocess(image_path, size)
+        index.put(perceptual_hash(image), BENCH_MODEL, options, TagResult(tags=[os.path.basename(image_path)]))
+
+    # random lookups first, so the copies aren't timed against a cold page cache
+    random_seconds = []
+    for image_hash in rng.integers(0, 1 << 64, lookups, dtype=np.uint64):
+        start = time.perf_counter()
+        index.get(int(image_hash), BENCH_MODEL, options)
+        random_seconds.append(time.perf_counter() - start)
+
+    found = 0
+    copies = 0
+    copy_seconds = []
+    for image_path in image_paths:
+        for name, image_bytes in _copies(image_path):
+            image = preprocess.preprocess(io.BytesIO(image_bytes), size)
+            start = time.perf_counter()
+            result = index.get(perceptual_hash(image), BENCH_MODEL, options)
+            copy_seconds.append(time.perf_counter() - start)
+            copies += 1
+            if result is not None and result.tags == [os.path.basename(image_path)]:
+                found += 1
+            else:
+                logging.info(f"Missed the {name} copy of {image_path}")
+
+    stats = index.stats()
+    index.close()
+    logging.info(f"Found {found} of {copies} resized and re-encoded copies ({found / copies:.1%}) within {max_distance} bits")
+    for label, seconds in (("copies", copy_seconds), ("random hashes", random_seconds)):
+        p50, p99 = np.percentile(np.array(seconds) * 1000, [50, 99])
+        logging.info(f"Lookup latency for {label} at {stats['entries']} entries: p50 {p50:.2f}ms p99 {p99:.2f}ms")
+    logging.info(f"Index is {os.path.getsize(db_path) / (1024 * 1024):.0f}MiB on disk, {stats}")
+
+
+def _copies(image_path: str) -> list[tuple[str, bytes]]:
+    # what reposts usually do to an image
+    image = Image.open(image_path)
+    image.load()
+    rgb = image.convert("RGB")
+    copies = []
+    for name, copy, image_format, save_options in (
+            ("jpeg", rgb, "JPEG", {"quality": 75}),
+            ("webp", rgb, "WEBP", {"quality": 80}),
+            ("png", image, "PNG", {}),
+            ("half size", rgb.resize((rgb.width // 2, rgb.height // 2), Image.Resampling.LANCZOS), "JPEG", {"quality": 85}),
+            ("quarter size", rgb.resize((rgb.width // 4, rgb.height // 4), Image.Resampling.BILINEAR), "JPEG", {"quality": 85}),
+            ("1.5x size", rgb.resize((rgb.width * 3 // 2, rgb.height * 3 // 2), Image.Resampling.BICUBIC), "PNG", {}),
+    ):
+        buffer = io.BytesIO()
+        copy.save(buffer, image_format, **save_options)
+        copies.append((name, buffer.getvalue()))
+    return copies
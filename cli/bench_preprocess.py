@@ -0,0 +1,105 @@
+import ctypes
+import logging
+import multiprocessing
+import time
+from typing import Callable, Optional
+
+import click
+import numpy as np
+
+from core import preprocess
+from core.interrogator import Interrogator, ARCHITECTURE_VIT
+
+logger = logging.getLogger(__name__)
+
+# in pixel values (0-255). The reduced path decodes JPEGs at a reduced scale and box filters before INTER_AREA, so it
+# isn't bit exact with the legacy one, edges move by a few values while the image as a whole stays put.
+DEFAULT_MEAN_TOLERANCE = 1.0
+DEFAULT_MAX_TOLERANCE = 32.0
+# the input sizes of the tagger models, which are the ones preprocessed this way
+DEFAULT_SIZES = tuple(sorted({
+    Interrogator.get_dimensions_for_model(model_name)[0]
+    for model_name in Interrogator.get_valid_models()
+    if Interrogator.get_model_architecture(model_name) == ARCHITECTURE_VIT
+}))
+
+PREPROCESSORS = {
+    "legacy": preprocess.preprocess_legacy,
+    "reduced": preprocess.preprocess,
+}
+
+
+@click.command()
+@click.option("--image-path", "image_paths", required=True, multiple=True, help="Image to preprocess, may be repeated")
+@click.option("--size", "sizes", default=DEFAULT_SIZES, show_default=True, multiple=True, type=int, help="Model input size, may be repeated")
+@click.option("--repeat", default=5, show_default=True, help="Times to preprocess each image when timing")
+@click.option("--mean-tolerance", default=DEFAULT_MEAN_TOLERANCE, show_default=True, help="Largest mean absolute difference from the legacy preprocessor, in pixel values")
+@click.option("--max-tolerance", default=DEFAULT_MAX_TOLERANCE, show_default=True, help="Largest absolute difference of any pixel from the legacy preprocessor")
+def bench_preprocess(image_paths: tuple[str], sizes: tuple[int], repeat: int, mean_tolerance: float, max_tolerance: float):
+    # Fails when the reduced preprocessor drifts further from the legacy one than the tolerances allow, at any of
+    # the sizes. Each preprocessor is measured in a fresh process per image so their memory doesn't mix.
+    context = multiprocessing.get_context("spawn")
+    mismatches = []
+    for size in sizes:
+        for image_path in image_paths:
+            legacy = preprocess.preprocess_legacy(image_path, size)
+            reduced = preprocess.preprocess(image_path, size)
+            if legacy.shape != reduced.shape:
+                mismatches.append(f"{image_path} at {size} (shape {reduced.shape}, legacy {legacy.shape})")
+            else:
+                difference = np.abs(legacy - reduced)
+                logging.info(
+                    f"{image_path} at {size}: max abs difference {difference.max():.1f}, "
+                    f"mean abs difference {difference.mean():.3f}"
+                )
+                if difference.mean() > mean_tolerance or difference.max() > max_tolerance:
+                    mismatches.append(
+                        f"{image_path} at {size} (max {difference.max():.1f}, mean {difference.mean():.3f})"
+                    )
+            for name in PREPROCESSORS:
+                with context.Pool(1) as pool:
+                    seconds, peak_kb = pool.apply(_measure, (name, image_path, size, repeat))
+                peak = "not measured" if peak_kb is None else f"{peak_kb / 1024:.1f}MiB"
+                logging.info(f"{image_path} at {size}: {name} {seconds * 1000:.1f}ms per image, peak RSS growth {peak}")
+    if len(mismatches) > 0:
+        raise click.ClickException(
+            f"{len(mismatches)} images differ from the legacy preprocessor by more than the tolerance "
+            f"(mean {mean_tolerance}, max {max_tolerance}): {', '.join(mismatches)}"
+        )
+    logging.info("All images within tolerance of the legacy preprocessor")
+
+
+def _measure(name: str, image_path: str, size: int, repeat: int) -> tuple[float, Optional[int]]:
+    preprocessor = PREPROCESSORS[name]
+    # the first run pays for lazy setup in PIL, numpy and cv2, which isn't the image's
+    preprocessor(image_path, size)
+    peak_kb = _peak_growth_kb(lambda: preprocessor(image_path, size))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        preprocessor(image_path, size)
+    seconds = (time.perf_counter() - start) / repeat
+    return seconds, peak_kb
+
+
+def _peak_growth_kb(run: Callable[[], object]) -> Optional[int]:
+    # How far RSS rose while run() ran. ru_maxrss can't tell, it's already at the high water mark the imports
+    # left, so linux's high water mark is reset first. Memory freed earlier is handed back to the OS so run() can't
+    # quietly reuse it. None where that isn't possible.
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        run()
+        return None
+    before_kb = _proc_status_kb("VmRSS")
+    run()
+    return _proc_status_kb("VmHWM") - before_kb
+
+
+def _proc_status_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+    raise ValueError(f"No {field} in /proc/self/status")
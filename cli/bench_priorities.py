@@ -0,0 +1,196 @@
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+
+import click
+import numpy as np
+
+from cli.bench_jobs import BENCH_MODEL, _load_images, _job_zip, _write_json
+from core.batch_scheduler import DEFAULT_MAX_BATCH_SIZE
+from core.job_executor import DEFAULT_MAX_QUEUED
+from core.priority import PRIORITIES, PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK
+from core.stand_in_model import write_stand_in_model
+
+logger = logging.getLogger(__name__)
+
+# the interactive jobs start once the backfill is under way
+INTERACTIVE_START_DELAY = 0.5
+
+
+@click.command()
+@click.option("--bulk-jobs", default=600, show_default=True, help="Bulk job zips waiting in the input dir at startup")
+@click.option("--interactive-jobs", default=40, show_default=True, help="Interactive job zips dropped while the backfill runs")
+@click.option("--interactive-rate", default=10.0, show_default=True, help="Interactive jobs dropped per second")
+@click.option("--bulk-deadline", type=float, default=None, help="Seconds after startup the bulk jobs are dropped if they haven't reached the model")
+@click.option("--compare/--no-compare", default=True, show_default=True, help="Also run the same jobs with every job at normal priority")
+@click.option("--work-dir", default=os.path.join("data", "bench", "priorities"), show_default=True, help="Where the stand-in model, images and job folders are created")
+@click.option("--size", default=448, show_default=True, help="Input size of the stand-in model")
+@click.option("--max-batch-size", default=DEFAULT_MAX_BATCH_SIZE, show_default=True)
+@click.option("--max-queued", default=DEFAULT_MAX_QUEUED, show_default=True)
+@click.option("--output", "output_path", default=None, help="Write the results as JSON to this file")
+def bench_priorities(
+        bulk_jobs: int,
+        interactive_jobs: int,
+        interactive_rate: float,
+        bulk_deadline: float,
+        compare: bool,
+        work_dir: str,
+        size: int,
+        max_batch_size: int,
+        max_queued: int,
+        output_path: str,
+):
+    # Starts the watcher on a backfill of bulk jobs and drops interactive jobs while it runs, then reports latency
+    # from dropping a zip to its result and queue wait per priority. With --compare the same jobs are run again
+    # all at normal priority, which is how every job was served before priorities.
+    config = {
+        "bulk_jobs": bulk_jobs,
+        "interactive_jobs": interactive_jobs,
+        "interactive_rate": interactive_rate,
+        "bulk_deadline": bulk_deadline,
+        "size": size,
+        "max_batch_size": max_batch_size,
+        "max_queued": max_queued,
+    }
+    model_dir = os.path.join(work_dir, "model")
+    write_stand_in_model(model_dir, size=size)
+    images = _load_images(os.path.join(work_dir, "images"))
+
+    results = {"config": config}
+    context = multiprocessing.get_context("spawn")
+    for name, use_priorities in (("priorities", True), ("all_normal", False)):
+        if name == "all_normal" and not compare:
+            continue
+        # a fresh process for each run, so its metrics are only that run's
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(_run, (config, work_dir, model_dir, images, use_priorities))
+        _log_results(name, results[name])
+
+    if output_path is not None:
+        _write_json(output_path, results)
+        logging.info(f"Wrote results to {output_path}")
+
+
+def _run(config: dict, work_dir: str, model_dir: str, images: list[tuple[str, bytes]], use_priorities: bool) -> dict:
+    # imported here so the parent process doesn't pay for them
+    from core.batch_scheduler import BatchScheduler
+    from core.input_watcher import InputWatcher
+    from core.interrogator import Interrogator
+    from core.metrics import QUEUE_WAIT_SECONDS, JOBS_DROPPED
+
+    logging.basicConfig(level=logging.WARNING)
+    input_path = os.path.join(work_dir, "input")
+    output_path = os.path.join(work_dir, "output")
+    working_path = os.path.join(work_dir, "working")
+    for path in (input_path, output_path, working_path):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    classes = {
+        PRIORITY_BULK: PRIORITY_BULK if use_priorities else PRIORITY_NORMAL,
+        PRIORITY_INTERACTIVE: PRIORITY_INTERACTIVE if use_priorities else PRIORITY_NORMAL,
+    }
+    # the backfill is in the input dir before the watcher starts, like a backlog found at startup
+    bulk_spec = {"priority": classes[PRIORITY_BULK]}
+    if config["bulk_deadline"] is not None:
+        bulk_spec["deadline"] = time.time() + config["bulk_deadline"]
+    for index in range(config["bulk_jobs"]):
+        job_id = f"bulk-{index:05d}"
+        with open(os.path.join(input_path, f"{job_id}.zip"), "wb") as f:
+            f.write(_job_zip(job_id, *images[index % len(images)], **bulk_spec))
+    interactive = [
+        (f"interactive-{index:05d}", _job_zip(
+            f"interactive-{index:05d}",
+            *images[index % len(images)],
+            priority=classes[PRIORITY_INTERACTIVE],
+        ))
+        for index in range(config["interactive_jobs"])
+    ]
+
+    interrogator = Interrogator(providers=["CPUExecutionProvider"], model_dirs={BENCH_MODEL: model_dir})
+    interrogator.preload(BENCH_MODEL)
+    scheduler = BatchScheduler(interrogator, max_batch_size=config["max_batch_size"])
+    scheduler.start()
+    watcher = InputWatcher(output_path, working_path, interrogator, scheduler)
+    watcher.start_executor(max_queued=config["max_queued"])
+
+    started = time.perf_counter()
+    dropped_at: dict[str, float] = {}
+
+    def drop_interactive():
+        time.sleep(INTERACTIVE_START_DELAY)
+        for job_id, zip_bytes in interactive:
+            tmp_path = os.path.join(input_path, f"{job_id}.zip.partial")
+            with open(tmp_path, "wb") as f:
+                f.write(zip_bytes)
+            zip_path = os.path.join(input_path, f"{job_id}.zip")
+            os.replace(tmp_path, zip_path)
+            dropped_at[job_id] = time.perf_counter()
+            # blocks while the pipeline pushes back, which counts towards the job's latency
+            watcher.offer_path(zip_path)
+            time.sleep(1 / config["interactive_rate"])
+
+    watcher.reprocess_unhandled_jobs(input_path)
+    producer = threading.Thread(target=drop_interactive, daemon=True)
+    producer.start()
+
+    total = config["bulk_jobs"] + config["interactive_jobs"]
+    finished_at: dict[str, float] = {}
+    # a generous limit, so a stuck run fails instead of hanging
+    expiry = started + 60 + total
+    while len(finished_at) < total and time.perf_counter() < expiry:
+        for entry in os.scandir(output_path):
+            job_id, extension = os.path.splitext(entry.name)
+            if extension == ".json" and job_id not in finished_at:
+                finished_at[job_id] = time.perf_counter()
+        time.sleep(0.002)
+    elapsed = time.perf_counter() - started
+    producer.join()
+    watcher.stop_executor()
+    scheduler.stop()
+
+    results = {"seconds": elapsed}
+    for job_class in (PRIORITY_INTERACTIVE, PRIORITY_BULK):
+        job_ids = [job_id for job_id in finished_at if job_id.startswith(job_class)]
+        errors = 0
+        for job_id in job_ids:
+            with open(os.path.join(output_path, f"{job_id}.json"), "r") as f:
+                errors += "error" in json.load(f)
+        latencies = np.array([(finished_at[job_id] - dropped_at.get(job_id, started)) * 1000 for job_id in job_ids])
+        if len(latencies) == 0:
+            latencies = np.array([np.nan])
+        results[job_class] = {
+            "completed": len(job_ids),
+            "errors": errors,
+            "latency_ms": {
+                "p50": float(np.percentile(latencies, 50)),
+                "p99": float(np.percentile(latencies, 99)),
+            },
+        }
+    results["queue_wait_ms"] = {
+        priority: {
+            "count": QUEUE_WAIT_SECONDS.count(priority),
+            "p50": QUEUE_WAIT_SECONDS.quantile(0.5, priority) * 1000,
+            "p99": QUEUE_WAIT_SECONDS.quantile(0.99, priority) * 1000,
+        }
+        for priority in PRIORITIES
+        if QUEUE_WAIT_SECONDS.count(priority) > 0
+    }
+    results["dropped"] = int(sum(JOBS_DROPPED.value(priority, "deadline") for priority in PRIORITIES))
+    return results
+
+
+def _log_results(name: str, results: dict):
+    logging.info(f"{name}: {results['seconds']:.2f}s, {results['dropped']} images dropped past their deadline")
+    for job_class in (PRIORITY_INTERACTIVE, PRIORITY_BULK):
+        line = results[job_class]
+        logging.info(
+            f"  {job_class} jobs: {line['completed']} done ({line['errors']} errors), "
+            f"latency p50 {line['latency_ms']['p50']:.0f}ms p99 {line['latency_ms']['p99']:.0f}ms"
+        )
+    for priority, wait in results["queue_wait_ms"].items():
+        logging.info(f"  queue wait at {priority} priority: p50 {wait['p50']:.0f}ms p99 {wait['p99']:.0f}ms ({wait['count']} images)")
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import time
+
+import click
+
+from core.execution_profile import PROFILES
+from core.interrogator import Interrogator
+
+logger = logging.getLogger(__name__)
+
+# full precision on the CPU, what every other profile is compared against
+REFERENCE_PROFILE = "cpu"
+
+
+@click.command()
+@click.option("--image-path", "image_paths", required=True, multiple=True, help="Image to tag, may be repeated")
+@click.option("--model-name", default="SmilingWolf/wd-vit-large-tagger-v3", help="Name of the model to benchmark")
+@click.option("--profile", "profile_names", type=click.Choice(list(PROFILES)), multiple=True, default=["cpu-int8"], show_default=True, help="Profile to compare against the full precision cpu profile, may be repeated")
+@click.option("--batch-size", default=8, show_default=True, help="Images per model run")
+@click.option("--repeat", default=5, show_default=True, help="Timed runs over all the images per profile")
+@click.option("--models-path", default=os.path.join("data", "models"), show_default=True, help="Where optimized and quantized models are kept")
+@click.option("--output", default=None, help="Write the results as JSON to this file")
+def bench_profiles(
+        image_paths: tuple[str],
+        model_name: str,
+        profile_names: tuple[str],
+        batch_size: int,
+        repeat: int,
+        models_path: str,
+        output: str,
+):
+    os.makedirs(models_path, exist_ok=True)
+    reference = _run_profile(REFERENCE_PROFILE, image_paths, model_name, batch_size, repeat, models_path)
+    results = {REFERENCE_PROFILE: _summary(reference, reference)}
+    for profile_name in profile_names:
+        if profile_name == REFERENCE_PROFILE:
+            continue
+        run = _run_profile(profile_name, image_paths, model_name, batch_size, repeat, models_path)
+        results[profile_name] = _summary(run, reference)
+
+    for profile_name, summary in results.items():
+        logging.info(
+            f"{profile_name}: {summary['ms_per_image']:.2f}ms/image, {summary['speedup']:.2f}x, "
+            f"tag precision {summary['precision']:.4f}, recall {summary['recall']:.4f}, "
+            f"identical tags on {summary['exact_match']:.1%} of images"
+        )
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump({"model": model_name, "images": len(image_paths), "profiles": results}, f, indent=2)
+        logging.info(f"Wrote results to {output}")
+
+
+def _run_profile(profile_name: str, image_paths: tuple[str], model_name: str, batch_size: int, repeat: int, models_path: str) -> dict:
+    interrogator = Interrogator(optimized_cache_path=models_path, profile=PROFILES[profile_name])
+    images = [interrogator.preprocess(image_path, model_name) for image_path in image_paths]
+    batches = [images[start:start + batch_size] for start in range(0, len(images), batch_size)]
+    # warm up so session creation and quantization aren't timed
+    tags = [result.tags for batch in batches for result in interrogator.process_batch(batch, model_name)]
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for batch in batches:
+            interrogator.process_batch(batch, model_name)
+    elapsed = time.perf_counter() - start
+    return {"seconds_per_image": elapsed / (repeat * len(images)), "tags": tags}
+
+
+def _summary(run: dict, reference: dict) -> dict:
+    precisions, recalls, exact = [], [], 0
+    for tags, reference_tags in zip(run["tags"], reference["tags"]):
+        tags, reference_tags = set(tags), set(reference_tags)
+        common = len(tags & reference_tags)
+        precisions.append(common / len(tags) if tags else float(not reference_tags))
+        recalls.append(common / len(reference_tags) if reference_tags else float(not tags))
+        exact += tags == reference_tags
+    return {
+        "ms_per_image": run["seconds_per_image"] * 1000,
+        "speedup": reference["seconds_per_image"] / run["seconds_per_image"],
+        "precision": sum(precisions) / len(precisions),
+        "recall": sum(recalls) / len(recalls),
+        "exact_match": exact / len(precisions),
+    }
@@ -0,0 +1,77 @@
+import logging
+import os
+import shutil
+import time
+
+import click
+
+from core.input_scanner import ScanningObserver, shard_name, DEFAULT_SCAN_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class _CountingHandler:
+    # stands in for the input watcher, takes every path without running anything
+    def __init__(self):
+        self.offered = 0
+
+    def offer_path(self, path: str) -> bool:
+        self.offered += 1
+        return True
+
+
+@click.command()
+@click.option("--files", "file_count", default=100000, show_default=True, help="Empty job zips to create in the input dir")
+@click.option("--work-dir", default=os.path.join("data", "bench", "scan"), show_default=True, help="Where the input dir is created")
+@click.option("--sharded", is_flag=True, help="Spread the zips over hashed subdirectories")
+@click.option("--polls", default=20, show_default=True, help="Polls to time for each scanner")
+@click.option("--scan-interval", default=DEFAULT_SCAN_INTERVAL, show_default=True, help="Poll interval used to turn CPU time per poll into CPU use")
+def bench_scan(file_count: int, work_dir: str, sharded: bool, polls: int, scan_interval: float):
+    # Compares the scanning observer against what watchdog's PollingObserver does each poll (a snapshot of the
+    # whole dir) on an idle backlog, and times how long each takes to notice one new job.
+    from watchdog.utils.dirsnapshot import DirectorySnapshot
+
+    input_path = os.path.join(work_dir, "input")
+    shutil.rmtree(input_path, ignore_errors=True)
+    os.makedirs(input_path)
+    start = time.perf_counter()
+    for index in range(file_count):
+        _create_job(input_path, f"bench-{index}", sharded)
+    logging.info(f"Created {file_count} zips in {time.perf_counter() - start:.1f}s")
+    # directories changed in the last couple of seconds are always relisted, let them settle
+    time.sleep(2.5)
+
+    handler = _CountingHandler()
+    scanner = ScanningObserver(full_scan_interval=float("inf"))
+    scanner.schedule(handler, input_path, recursive=sharded)
+    first_scan_cpu, _ = _timed(scanner.scan)
+    logging.info(f"scan: first scan offered {handler.offered} zips using {first_scan_cpu * 1000:.1f}ms CPU")
+    idle_cpu = min(_timed(scanner.scan)[0] for _ in range(polls))
+    _create_job(input_path, "bench-new", sharded)
+    handler.offered = 0
+    new_job_cpu, _ = _timed(scanner.scan)
+    logging.info(
+        f"scan: {idle_cpu * 1000:.3f}ms CPU per idle poll ({idle_cpu / scan_interval:.2%} of a core every "
+        f"{scan_interval}s), {new_job_cpu * 1000:.1f}ms to offer {handler.offered} new zip"
+    )
+
+    snapshot_cpu = min(_timed(lambda: DirectorySnapshot(input_path, recursive=sharded))[0] for _ in range(polls))
+    logging.info(
+        f"watchdog polling: {snapshot_cpu * 1000:.1f}ms CPU per poll ({snapshot_cpu / scan_interval:.2%} of a core "
+        f"every {scan_interval}s), idle or not"
+    )
+    shutil.rmtree(input_path, ignore_errors=True)
+
+
+def _create_job(input_path: str, job_id: str, sharded: bool):
+    if sharded:
+        input_path = os.path.join(input_path, shard_name(job_id))
+        os.makedirs(input_path, exist_ok=True)
+    with open(os.path.join(input_path, f"{job_id}.zip"), "w"):
+        pass
+
+
+def _timed(function) -> tuple[float, object]:
+    start = time.process_time()
+    result = function()
+    return time.process_time() - start, result
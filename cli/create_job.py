@@ -1,7 +1,6 @@
 import json
 import logging
 import os
-import shutil
 import tempfile
 import time
 import uuid
@@ -10,13 +9,19 @@ from io import BytesIO
 
 import click
 
+from core.input_scanner import shard_name
+from core.priority import PRIORITIES, PRIORITY_NORMAL
+
 logger = logging.getLogger(__name__)
 
 @click.command
 
 @click.option("--image-path", required=True, help="Path to the image")
 @click.option("--model-name", default="SmilingWolf/wd-vit-large-tagger-v3", required=True, help="Name of the model to use, ie: 'openai/clip-vit-large-patch14'")
-def create_job(image_path: str, model_name: str):
+@click.option("--shard", is_flag=True, help="Put the job in its hashed subdirectory of data/input")
+@click.option("--priority", type=click.Choice(PRIORITIES), default=PRIORITY_NORMAL, show_default=True, help="Interactive jobs are run ahead of normal ones, and those ahead of bulk ones")
+@click.option("--deadline-seconds", type=float, default=None, help="Drop the job with an error if it hasn't reached the model this many seconds from now")
+def create_job(image_path: str, model_name: str, shard: bool, priority: str, deadline_seconds: float):
     if not os.path.exists(image_path):
         raise FileNotFoundError(image_path)
     file_name = os.path.basename(image_path)
@@ -25,11 +30,20 @@ def create_job(image_path: str, model_name: str):
         "model_name": model_name,
         "job_id": job_id,
         "input_image_filename": file_name,
+        "priority": priority,
     }
+    if deadline_seconds is not None:
+        job_spec["deadline"] = time.time() + deadline_seconds
 
-    zip_file_folder = os.path.join(os.getcwd(), 'data', 'input', f"{job_id}.zip")
+    input_path = os.path.join(os.getcwd(), 'data', 'input')
+    if shard:
+        input_path = os.path.join(input_path, shard_name(job_id))
+    zip_file_folder = os.path.join(input_path, f"{job_id}.zip")
+    os.makedirs(os.path.dirname(zip_file_folder), exist_ok=True)
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".zip") as tmp:
+    # Write next to the final path and rename it into place. The rename is atomic on the same filesystem,
+    # so the watcher never sees a partial zip and picks the job up without waiting for it to settle.
+    with tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(zip_file_folder), suffix=".zip.partial") as tmp:
         with zipfile.ZipFile(tmp, 'w') as zip:
             zip.write(image_path, arcname=file_name)
 
@@ -40,5 +54,5 @@ def create_job(image_path: str, model_name: str):
         tmp.flush()
         os.fsync(tmp.fileno())
         tmp_name = tmp.name
-    shutil.move(tmp_name, zip_file_folder)
+    os.replace(tmp_name, zip_file_folder)
     logging.info(f"Created job {job_id} in {zip_file_folder}")
\ No newline at end of file
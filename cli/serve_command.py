@@ -0,0 +1,48 @@
+import logging
+import threading
+
+import click
+
+from cli.watch_command import Runtime, runtime_options
+from core.http_api import TaggingHTTPServer, TaggingService, DEFAULT_MAX_BODY_BYTES, DEFAULT_REQUEST_TIMEOUT, \
+    DEFAULT_MAX_PENDING
+
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", show_default=True, help="Address to listen on")
+@click.option("--port", default=8000, show_default=True, help="Port to listen on")
+@click.option("--watch/--no-watch", "watch_input", default=True, show_default=True, help="Keep processing jobs from data/input as well")
+@click.option("--max-body-mb", default=DEFAULT_MAX_BODY_BYTES // (1024 * 1024), show_default=True, help="Largest request body accepted")
+@click.option("--request-timeout", default=DEFAULT_REQUEST_TIMEOUT, show_default=True, help="Seconds to wait for tags before giving up on a request")
+@click.option("--max-pending", default=DEFAULT_MAX_PENDING, show_default=True, help="Images held for requests before new ones get a 503, bulk requests get one at half of it and normal ones at three quarters")
+@runtime_options
+def serve(host: str, port: int, watch_input: bool, max_body_mb: int, request_timeout: float, max_pending: int, **options):
+    runtime = Runtime(**options)
+    service = TaggingService(
+        runtime.interrogator,
+        runtime.scheduler,
+        runtime.cache,
+        runtime.near_duplicates,
+        max_pending=max_pending,
+    )
+    server = TaggingHTTPServer(
+        (host, port),
+        service,
+        max_body_bytes=max_body_mb * 1024 * 1024,
+        request_timeout=request_timeout,
+    )
+    server_thread = threading.Thread(target=server.serve_forever, name="http-server", daemon=True)
+    server_thread.start()
+    logging.info(f"Serving tags on http://{host}:{server.server_port}")
+    try:
+        if watch_input:
+            runtime.watch()
+        else:
+            threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    server.server_close()
+    runtime.stop()
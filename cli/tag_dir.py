@@ -0,0 +1,82 @@
+import json
+import logging
+import os
+
+import click
+
+from core.batch_scheduler import BatchScheduler, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT
+from core.dir_tagger import DirTagger, FORMATS, FORMAT_JSONL, DEFAULT_SHARD_SIZE, DEFAULT_CHECKPOINT_INTERVAL
+from core.execution_profile import PROFILES
+from core.interrogator import Interrogator
+from core.job_executor import DEFAULT_PREPROCESS_WORKERS, DEFAULT_MAX_IN_FLIGHT
+from core.tagging import TaggingOptions
+
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.argument("root", type=click.Path(exists=True, file_okay=False))
+@click.option("--model-name", default="SmilingWolf/wd-vit-large-tagger-v3", show_default=True, type=click.Choice(Interrogator.get_valid_models()))
+@click.option("--model-dir", default=None, help="Directory with model.onnx and selected_tags.csv to use instead of downloading the model")
+@click.option("--options", "options_json", default=None, help="Tagging options as a JSON object, like the options of a job.json")
+@click.option("--output", "output_path", default=os.path.join("data", "tags"), show_default=True, help="Where the shards and checkpoint are written, running again with the same dir resumes")
+@click.option("--format", "file_format", type=click.Choice(FORMATS), default=FORMAT_JSONL, show_default=True, help="Shard format, parquet needs pyarrow")
+@click.option("--shard-size", default=DEFAULT_SHARD_SIZE, show_default=True, help="Images per shard")
+@click.option("--checkpoint-interval", default=DEFAULT_CHECKPOINT_INTERVAL, show_default=True, help="Seconds after which a shard is written and checkpointed even if it isn't full")
+@click.option("--preprocess-workers", default=DEFAULT_PREPROCESS_WORKERS, show_default=True, help="Threads decoding and resizing images")
+@click.option("--max-in-flight", default=DEFAULT_MAX_IN_FLIGHT, show_default=True, help="Images being preprocessed or waiting on inference at once")
+@click.option("--max-batch-size", default=DEFAULT_MAX_BATCH_SIZE, show_default=True, help="Maximum number of images run through the model at once")
+@click.option("--max-batch-wait", default=DEFAULT_MAX_WAIT, show_default=True, help="Maximum seconds to wait for a batch to fill")
+@click.option("--profile", "profile_name", type=click.Choice(list(PROFILES)), default="default", show_default=True, help="How models are run, see watch --help")
+def tag_dir(
+        root: str,
+        model_name: str,
+        model_dir: str,
+        options_json: str,
+        output_path: str,
+        file_format: str,
+        shard_size: int,
+        checkpoint_interval: float,
+        preprocess_workers: int,
+        max_in_flight: int,
+        max_batch_size: int,
+        max_batch_wait: float,
+        profile_name: str,
+):
+    # Tags every image under ROOT without making a job of each, for backfilling an archive. Stop it with ctrl-c
+    # and run it again with the same --output to carry on.
+    try:
+        options = TaggingOptions.from_job_spec({"options": json.loads(options_json) if options_json else {}})
+    except ValueError as e:
+        raise click.ClickException(f"Invalid --options: {e}")
+    interrogator = Interrogator(
+        optimized_cache_path=os.path.join(os.getcwd(), 'data', 'models'),
+        model_dirs={model_name: model_dir} if model_dir is not None else None,
+        profile=PROFILES[profile_name],
+    )
+    scheduler = BatchScheduler(interrogator, max_batch_size=max_batch_size, max_wait=max_batch_wait)
+    try:
+        tagger = DirTagger(
+            interrogator,
+            scheduler,
+            root,
+            output_path,
+            model_name,
+            options,
+            file_format=file_format,
+            shard_size=shard_size,
+            checkpoint_interval=checkpoint_interval,
+            preprocess_workers=preprocess_workers,
+            max_in_flight=max_in_flight,
+        )
+        # a checkpoint of another run is refused before the model is loaded
+        tagger.check_checkpoint()
+    except ValueError as e:
+        # pyarrow missing for parquet, or --output holding a different run
+        raise click.ClickException(str(e))
+    interrogator.preload(model_name)
+    scheduler.start()
+    try:
+        tagger.run()
+    finally:
+        scheduler.stop()
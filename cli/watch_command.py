@@ -1,33 +1,364 @@
 import logging
+import multiprocessing
 import os
+import signal
+import time
+from typing import Optional
 
 import click
 from watchdog.observers import Observer
-from watchdog.observers.polling import PollingObserver
 
+from core.batch_scheduler import BatchScheduler, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT
+from core.job_executor import DEFAULT_IO_WORKERS, DEFAULT_PREPROCESS_WORKERS, DEFAULT_MAX_QUEUED, \
+    DEFAULT_MAX_IN_FLIGHT
+from core.execution_profile import PROFILES, GRAPH_OPTIMIZATION_LEVELS, TORCH_DTYPES
+from core.job_claims import JobClaims, default_worker_id, DEFAULT_CLAIM_TIMEOUT
+from core.job_journal import JobJournal
+from core.input_scanner import ScanningObserver, DEFAULT_SCAN_INTERVAL, DEFAULT_FULL_SCAN_INTERVAL
 from core.job_watcher import InputObserver
+from core.metrics import REGISTRY, start_metrics_server, MetricsTextfileWriter, DEFAULT_TEXTFILE_INTERVAL, \
+    QUEUE_WAIT_SECONDS
+from core.priority import PRIORITIES
+from core.model_pool import DEFAULT_MEMORY_BUDGET
+from core.result_cache import ResultCache, DEFAULT_MEMORY_ENTRIES, DEFAULT_MAX_DISK_BYTES
+from core.near_duplicates import NearDuplicateIndex, DEFAULT_MAX_DISTANCE, DEFAULT_MAX_ENTRIES, MAX_DISTANCE
+from core.result_sink import create_result_sink, SINKS, SINK_FILES, DEFAULT_ROTATE_BYTES, DEFAULT_COMMIT_INTERVAL
 from core.input_watcher import InputWatcher
-from core.interrogator import Interrogator
+from core.interrogator import Interrogator, DEFAULT_MAX_CAPTION_TOKENS
+from core.tracing import Tracer, DEFAULT_PROFILE_SLOWEST
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MODEL = "SmilingWolf/wd-vit-large-tagger-v3"
+
+_RUNTIME_OPTIONS = [
+    click.option("--max-batch-size", default=DEFAULT_MAX_BATCH_SIZE, show_default=True, help="Maximum number of images run through the model at once"),
+    click.option("--max-batch-wait", default=DEFAULT_MAX_WAIT, show_default=True, help="Maximum seconds to wait for a batch to fill"),
+    click.option("--io-workers", default=DEFAULT_IO_WORKERS, show_default=True, help="Threads waiting on, unzipping and reading jobs"),
+    click.option("--preprocess-workers", default=DEFAULT_PREPROCESS_WORKERS, show_default=True, help="Threads decoding and resizing images"),
+    click.option("--max-queued", default=DEFAULT_MAX_QUEUED, show_default=True, help="Jobs accepted before new jobs wait for room, and jobs of each priority waiting to be preprocessed"),
+    click.option("--max-in-flight", default=DEFAULT_MAX_IN_FLIGHT, show_default=True, help="Jobs waiting on or in inference at once"),
+    click.option("--extract-jobs", is_flag=True, help="Extract job zips into data/working instead of reading them in memory"),
+    click.option("--cache/--no-cache", default=True, show_default=True, help="Answer repeated images from the result cache in data/cache"),
+    click.option("--cache-memory-entries", default=DEFAULT_MEMORY_ENTRIES, show_default=True, help="Results kept in memory"),
+    click.option("--cache-max-mb", default=DEFAULT_MAX_DISK_BYTES // (1024 * 1024), show_default=True, help="Size of the on-disk result cache"),
+    click.option("--near-duplicates/--no-near-duplicates", default=False, show_default=True, help="Answer resized and re-encoded copies of images already tagged from their perceptual hash in data/cache"),
+    click.option("--near-duplicate-distance", type=click.IntRange(0, MAX_DISTANCE), default=DEFAULT_MAX_DISTANCE, show_default=True, help="Most bits of the 64 bit perceptual hash that may differ for a match"),
+    click.option("--near-duplicate-max-entries", default=DEFAULT_MAX_ENTRIES, show_default=True, help="Hashes kept in the near duplicate index"),
+    click.option("--result-sink", type=click.Choice(SINKS), default=SINK_FILES, show_default=True, help="Write results as one file per job, appended to a JSON Lines file or into a sqlite table"),
+    click.option("--result-rotate-mb", default=DEFAULT_ROTATE_BYTES // (1024 * 1024), show_default=True, help="Size at which the jsonl result file is rotated"),
+    click.option("--result-commit-interval", default=DEFAULT_COMMIT_INTERVAL, show_default=True, help="Seconds results are gathered for one fsync with the jsonl and sqlite sinks"),
+    click.option("--input-scanner", type=click.Choice(["auto", "watchdog", "scan"]), default="auto", show_default=True, help="How new jobs are found: filesystem events, or listing data/input. auto lists it in docker, where events from mounts don't arrive"),
+    click.option("--scan-interval", default=DEFAULT_SCAN_INTERVAL, show_default=True, help="Seconds between listings of data/input by the scan input scanner"),
+    click.option("--full-scan-interval", default=DEFAULT_FULL_SCAN_INTERVAL, show_default=True, help="Seconds between listings that offer every file again, not just new ones"),
+    click.option("--journal/--no-journal", default=True, show_default=True, help="Track jobs in data/journal so a restart resumes them and never reruns a written job"),
+    click.option("--model-memory-mb", default=DEFAULT_MEMORY_BUDGET // (1024 * 1024), show_default=True, help="Memory budget for models kept loaded at once"),
+    click.option("--metrics-port", type=int, default=None, help="Serve prometheus metrics on this port at /metrics"),
+    click.option("--metrics-textfile", type=click.Path(dir_okay=False), default=None, help="Write prometheus metrics to this file for the node exporter textfile collector"),
+    click.option("--metrics-interval", default=DEFAULT_TEXTFILE_INTERVAL, show_default=True, help="Seconds between writes of --metrics-textfile"),
+    click.option("--trace/--no-trace", default=False, show_default=True, help="Write a Chrome trace of every job to data/traces. SIGUSR1 or creating data/traces/enabled also turns it on and off while running"),
+    click.option("--trace-profile-sample", type=click.FloatRange(0, 1), default=0.0, show_default=True, help="Share of traced jobs also run under cProfile"),
+    click.option("--trace-profile-slowest", default=DEFAULT_PROFILE_SLOWEST, show_default=True, help="cProfile stats kept, of the slowest profiled jobs"),
+    click.option("--worker-id", default=None, help="Name of this worker's claim and working dirs, defaults to <hostname>-0"),
+    click.option("--claim-timeout", default=DEFAULT_CLAIM_TIMEOUT, show_default=True, help="Seconds without a heartbeat before another worker's claimed jobs are taken back"),
+    click.option("--profile", "profile_name", type=click.Choice(list(PROFILES)), default="default", show_default=True, help="How models are run, cpu-int8 runs an INT8 quantized copy, cpu-bf16 runs captioning models in bfloat16"),
+    click.option("--intra-op-threads", default=0, show_default=True, help="Threads each model uses, 0 for all cores"),
+    click.option("--inter-op-threads", type=int, default=None, help="Threads running independent parts of the graph at once"),
+    click.option("--graph-optimization", type=click.Choice(GRAPH_OPTIMIZATION_LEVELS), default=None, help="onnxruntime graph optimization level, all by default"),
+    click.option("--cpu-mem-arena/--no-cpu-mem-arena", default=None, help="Let onnxruntime keep a memory arena, on by default. Turning it off saves memory with several workers"),
+    click.option("--torch-dtype", type=click.Choice(TORCH_DTYPES), default=None, help="dtype captioning models run in, the profile's by default"),
+    click.option("--max-caption-tokens", default=DEFAULT_MAX_CAPTION_TOKENS, show_default=True, help="Longest caption captioning models generate"),
+    click.option("--preload-model", "preload_models", multiple=True, default=[DEFAULT_MODEL], show_default=True, help="Model to load and warm up before watching, may be repeated"),
+    click.option("--model-dir", "model_dirs", multiple=True, callback=lambda ctx, param, values: parse_model_dirs(values), help=f"Directory with model.onnx and selected_tags.csv (or a captioning model's files) to use instead of downloading the model, as <model>=<dir> or just <dir> for {DEFAULT_MODEL}, may be repeated"),
+]
+
+
+def runtime_options(function):
+    # options shared by every command that runs a Runtime
+    for option in reversed(_RUNTIME_OPTIONS):
+        function = option(function)
+    return function
+
+
+def parse_model_dirs(values: tuple[str, ...]) -> dict[str, str]:
+    # model name -> local directory, from --model-dir values
+    model_dirs = {}
+    for value in values:
+        model_name, separator, model_dir = value.rpartition("=")
+        if separator == "":
+            model_name = DEFAULT_MODEL
+        if model_name not in Interrogator.get_valid_models():
+            raise click.BadParameter(f"Invalid model: {model_name}", param_hint="--model-dir")
+        if not os.path.isdir(model_dir):
+            raise click.BadParameter(f"{model_dir} isn't a directory", param_hint="--model-dir")
+        model_dirs[model_name] = model_dir
+    return model_dirs
+
+
+class Runtime:
+    # The resident interrogator, batch scheduler, result cache and input watcher, shared by watch and serve.
+    def __init__(
+            self,
+            max_batch_size: int,
+            max_batch_wait: float,
+            io_workers: int,
+            preprocess_workers: int,
+            max_queued: int,
+            max_in_flight: int,
+            extract_jobs: bool,
+            cache: bool,
+            cache_memory_entries: int,
+            cache_max_mb: int,
+            near_duplicates: bool,
+            near_duplicate_distance: int,
+            near_duplicate_max_entries: int,
+            result_sink: str,
+            result_rotate_mb: int,
+            result_commit_interval: float,
+            input_scanner: str,
+            scan_interval: float,
+            full_scan_interval: float,
+            journal: bool,
+            model_memory_mb: int,
+            metrics_port: Optional[int],
+            metrics_textfile: Optional[str],
+            metrics_interval: float,
+            trace: bool,
+            trace_profile_sample: float,
+            trace_profile_slowest: int,
+            worker_id: Optional[str],
+            claim_timeout: float,
+            profile_name: str,
+            intra_op_threads: int,
+            inter_op_threads: Optional[int],
+            graph_optimization: Optional[str],
+            cpu_mem_arena: Optional[bool],
+            torch_dtype: Optional[str],
+            max_caption_tokens: int,
+            preload_models: tuple[str],
+            model_dirs: dict[str, str],
+    ):
+        self.started_at = time.monotonic()
+        self.input_path = os.path.join(os.getcwd(), 'data', 'input')
+        self.output_path = os.path.join(os.getcwd(), 'data', 'output')
+        claims_path = os.path.join(os.getcwd(), 'data', 'claims')
+        if worker_id is None:
+            worker_id = default_worker_id()
+        # each worker extracts into its own dir, so a clean start doesn't touch anyone else's jobs
+        working_path = os.path.join(os.getcwd(), 'data', 'working', worker_id)
+        models_path = os.path.join(os.getcwd(), 'data', 'models')
+        profile = PROFILES[profile_name].with_overrides(
+            intra_op_threads=intra_op_threads or None,
+            inter_op_threads=inter_op_threads,
+            graph_optimization=graph_optimization,
+            cpu_mem_arena=cpu_mem_arena,
+            torch_dtype=torch_dtype,
+        )
+        # quantized and bfloat16 models give slightly different results, they're cached apart from the full
+        # precision ones
+        variants = (['int8'] if profile.quantize else []) + ([profile.torch_dtype] if profile.torch_dtype != 'float32' else [])
+        cache_file = '.'.join(['results', *variants, 'sqlite'])
+        cache_path = os.path.join(os.getcwd(), 'data', 'cache', cache_file)
+        near_duplicates_path = os.path.join(os.getcwd(), 'data', 'cache', '.'.join(['near_duplicates', *variants, 'sqlite']))
+        journal_path = os.path.join(os.getcwd(), 'data', 'journal', 'jobs.sqlite')
+        traces_path = os.path.join(os.getcwd(), 'data', 'traces')
+        if input_scanner == "auto":
+            input_scanner = "scan" if is_running_in_docker() else "watchdog"
+        self._input_scanner = input_scanner
+        self._scan_intervals = (scan_interval, full_scan_interval)
+        self._executor_options = {
+            "io_workers": io_workers,
+            "preprocess_workers": preprocess_workers,
+            "max_queued": max_queued,
+            "max_in_flight": max_in_flight,
+        }
+
+        REGISTRY.constant_labels["worker"] = worker_id
+        self._metrics_server = None
+        if metrics_port is not None:
+            self._metrics_server = start_metrics_server("0.0.0.0", metrics_port)
+        self._metrics_writer = None
+        if metrics_textfile is not None:
+            self._metrics_writer = MetricsTextfileWriter(metrics_textfile, metrics_interval)
+            self._metrics_writer.start()
+        self.tracer = Tracer(
+            traces_path,
+            enabled=trace,
+            profile_sample=trace_profile_sample,
+            profile_slowest=trace_profile_slowest,
+        )
+        self.tracer.start()
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.tracer.toggle())
+
+        self.interrogator = Interrogator(
+            memory_budget=model_memory_mb * 1024 * 1024,
+            optimized_cache_path=models_path,
+            model_dirs=model_dirs,
+            profile=profile,
+            max_caption_tokens=max_caption_tokens,
+        )
+        for model_name in preload_models:
+            self.interrogator.preload(model_name)
+        logging.info(f"Ready to process jobs after {time.monotonic() - self.started_at:.2f}s")
+        self.scheduler = BatchScheduler(self.interrogator, max_batch_size=max_batch_size, max_wait=max_batch_wait)
+        self.scheduler.start()
+        self.cache = None
+        if cache:
+            self.cache = ResultCache(
+                cache_path,
+                memory_entries=cache_memory_entries,
+                max_disk_bytes=cache_max_mb * 1024 * 1024,
+            )
+        self.near_duplicates = None
+        if near_duplicates:
+            self.near_duplicates = NearDuplicateIndex(
+                near_duplicates_path,
+                max_distance=near_duplicate_distance,
+                max_entries=near_duplicate_max_entries,
+            )
+        self.claims = JobClaims(claims_path, worker_id, self.input_path, claim_timeout=claim_timeout)
+        # workers each append to their own jsonl file, the sqlite table is shared
+        self.sink = create_result_sink(
+            result_sink,
+            self.output_path,
+            f"results-{worker_id}",
+            rotate_bytes=result_rotate_mb * 1024 * 1024,
+            commit_interval=result_commit_interval,
+        )
+        self.journal = JobJournal(journal_path, worker_id) if journal else None
+        self.watcher = InputWatcher(
+            self.output_path,
+            working_path,
+            self.interrogator,
+            self.scheduler,
+            extract_jobs=extract_jobs,
+            cache=self.cache,
+            started_at=self.started_at,
+            claims=self.claims,
+            sink=self.sink,
+            journal=self.journal,
+            near_duplicates=self.near_duplicates,
+            tracer=self.tracer,
+        )
+
+    def watch(self):
+        # blocks until interrupted
+        os.makedirs(self.input_path, exist_ok=True)
+        os.makedirs(self.output_path, exist_ok=True)
+        self.watcher.clean_start()
+        self.claims.start()
+        self.watcher.start_executor(**self._executor_options)
+        self.watcher.reprocess_unhandled_jobs(self.input_path)
+        if self._input_scanner == "scan":
+            observer = ScanningObserver(*self._scan_intervals)
+        else:
+            observer = Observer()
+        input_observer = InputObserver(self.input_path, observer, self.watcher)
+        logging.info("Starting input observer")
+        input_observer.start()
+
+    def stop(self):
+        self.watcher.stop_executor()
+        self.sink.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.claims.stop()
+        self.scheduler.stop()
+        logging.info(f"Models: {self.interrogator.model_stats()}")
+        logging.info(f"Buffers: {self.interrogator.buffer_stats()}")
+        for priority in PRIORITIES:
+            count = QUEUE_WAIT_SECONDS.count(priority)
+            if count > 0:
+                p50, p99 = (QUEUE_WAIT_SECONDS.quantile(q, priority) * 1000 for q in (0.5, 0.99))
+                logging.info(f"Queue wait for {count} {priority} images: p50 {p50:.0f}ms p99 {p99:.0f}ms")
+        if self.cache is not None:
+            logging.info(f"Result cache: {self.cache.stats()}")
+            self.cache.close()
+        if self.near_duplicates is not None:
+            logging.info(f"Near duplicates: {self.near_duplicates.stats()}")
+            self.near_duplicates.close()
+        self.tracer.stop()
+        if self._metrics_writer is not None:
+            self._metrics_writer.stop()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+
+
 @click.command()
-def watch():
-    input_path = os.path.join(os.getcwd(), 'data', 'input')
-    output_path = os.path.join(os.getcwd(), 'data', 'output')
-    working_path = os.path.join(os.getcwd(), 'data', 'working')
-
-    interrogator = Interrogator()
-    watcher = InputWatcher(output_path, working_path, interrogator)
-    watcher.clean_start()
-    watcher.reprocess_unhandled_jobs(input_path)
-    if is_running_in_docker():
-        observer = PollingObserver()
-    else:
-        observer = Observer()
-    input_observer = InputObserver(input_path, observer, watcher)
-    logging.info("Starting input observer")
-    input_observer.start()
+@click.option("--workers", default=1, show_default=True, help="Worker processes, each with its own copy of the models")
+@runtime_options
+def watch(workers: int, **options):
+    if workers > 1:
+        run_workers(workers, options)
+        return
+    runtime = Runtime(**options)
+    runtime.watch()
+    runtime.stop()
+
+
+def run_workers(workers: int, options: dict):
+    # Each worker is a separate process with its own models, claiming jobs from the shared input dir.
+    # Cores are split between them unless --intra-op-threads says otherwise.
+    intra_op_threads = options["intra_op_threads"] or max(1, (os.cpu_count() or 1) // workers)
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(workers):
+        worker_options = {
+            **options,
+            "worker_id": f"{options['worker_id']}-{index}" if options["worker_id"] else default_worker_id(index),
+            "intra_op_threads": intra_op_threads,
+        }
+        if options["metrics_port"] is not None:
+            worker_options["metrics_port"] = options["metrics_port"] + index
+        if options["metrics_textfile"] is not None:
+            root, extension = os.path.splitext(options["metrics_textfile"])
+            worker_options["metrics_textfile"] = f"{root}-{index}{extension}"
+        process = context.Process(target=_run_worker, args=(worker_options,), name=worker_options["worker_id"])
+        process.start()
+        processes.append(process)
+    logging.info(f"Started {workers} workers with {intra_op_threads} threads each")
+
+    # ctrl-c reaches the workers too, so they ignore it and the parent forwards a single SIGTERM instead
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    if hasattr(signal, "SIGUSR1"):
+        # tracing is toggled for every worker by signalling the parent
+        def forward(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, signum)
+
+        signal.signal(signal.SIGUSR1, forward)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+
+def _run_worker(options: dict):
+    from cli import configure_logging
+    configure_logging()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _stop_worker)
+    runtime = Runtime(**options)
+    runtime.watch()
+    runtime.stop()
+
+
+def _stop_worker(signum, frame):
+    # the parent and a supervisor signalling the whole process group can both send SIGTERM, only the first
+    # one stops the worker so the rest don't interrupt it while it finishes writing results
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
 
 def is_running_in_docker():
-    return os.path.exists('/.dockerenv')
\ No newline at end of file
+    return os.path.exists('/.dockerenv')
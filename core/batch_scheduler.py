@@ -0,0 +1,209 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+from core import tracing
+from core.metrics import STAGE_SECONDS, BATCH_PENDING, QUEUE_WAIT_SECONDS, JOBS_DROPPED
+from core.interrogator import Interrogator, ImageSource
+from core.priority import PRIORITY_NORMAL, DeadlineExceededError, is_expired, urgency
+from core.tagging import TaggingOptions, TagResult
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_MAX_WAIT = 0.02
+MAX_CONSECUTIVE_BATCHES = 8
+
+
+@dataclass(order=True)
+class _BatchItem:
+    # (priority, deadline, sequence), so pending images come off their heap most urgent first
+    sort_key: tuple
+    model_name: str = field(compare=False)
+    image: np.ndarray = field(compare=False)
+    options: TaggingOptions = field(compare=False)
+    future: Future = field(compare=False)
+    queued_at: float = field(compare=False)
+    priority: str = field(compare=False)
+    deadline: Optional[float] = field(compare=False)
+    # when the job was picked up, before it was loaded and preprocessed
+    picked_up_at: float = field(compare=False)
+    trace: Optional[tracing.JobTrace] = field(compare=False)
+
+    @property
+    def rows(self) -> int:
+        # an animated image takes a row of the batch per frame
+        return len(self.image) if self.image.ndim == 4 else 1
+
+
+class BatchScheduler:
+    """
+    Gathers preprocessed images from concurrent jobs and runs them through the interrogator as one batch.
+    A batch is dispatched once it reaches max_batch_size rows (an animated image counts each of its frames) or the
+    oldest image has waited max_wait seconds.
+    Images are queued per model, most urgent first: interactive before normal before bulk, then by deadline. The
+    scheduler keeps serving the model it last ran while that model has work as urgent as any other (up to
+    MAX_CONSECUTIVE_BATCHES in a row) so mixed traffic doesn't switch models on every batch. Images past their
+    deadline are dropped instead of run.
+    """
+
+    def __init__(
+            self,
+            interrogator: Interrogator,
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            max_wait: float = DEFAULT_MAX_WAIT,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        self._interrogator = interrogator
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._condition = threading.Condition()
+        # per model, a heap of _BatchItem
+        self._pending: dict[str, list[_BatchItem]] = {}
+        self._sequence = itertools.count()
+        self._stopping = False
+        self._current_model: Optional[str] = None
+        self._consecutive_batches = 0
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # anything already submitted is still run
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+
+    def process(self, image_path: ImageSource, model_name: str, options: Optional[TaggingOptions] = None) -> TagResult:
+        image = self._interrogator.preprocess(image_path, model_name, options)
+        return self.submit(image, model_name, options).result()
+
+    def submit(
+            self,
+            image: np.ndarray,
+            model_name: str,
+            options: Optional[TaggingOptions] = None,
+            priority: str = PRIORITY_NORMAL,
+            deadline: Optional[float] = None,
+            picked_up_at: Optional[float] = None,
+            trace: Optional[tracing.JobTrace] = None,
+    ) -> Future:
+        if options is None:
+            options = TaggingOptions()
+        future = Future()
+        now = time.monotonic()
+        with self._condition:
+            item = _BatchItem(
+                (*urgency(priority, deadline), next(self._sequence)),
+                model_name,
+                image,
+                options,
+                future,
+                now,
+                priority,
+                deadline,
+                picked_up_at if picked_up_at is not None else now,
+                trace,
+            )
+            heapq.heappush(self._pending.setdefault(model_name, []), item)
+            BATCH_PENDING.inc()
+            self._condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0 and not self._stopping:
+                    self._condition.wait()
+                if len(self._pending) == 0:
+                    return
+                model_name = self._choose_model()
+                pending = self._pending[model_name]
+                dispatch_at = min(item.queued_at for item in pending) + self._max_wait
+                while sum(item.rows for item in pending) < self._max_batch_size and not self._stopping:
+                    remaining = dispatch_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                expired = []
+                items = []
+                rows = 0
+                while len(pending) > 0:
+                    if is_expired(pending[0].deadline):
+                        expired.append(heapq.heappop(pending))
+                        continue
+                    # an animation with more frames than max_batch_size still runs, as a batch of its own
+                    if len(items) > 0 and rows + pending[0].rows > self._max_batch_size:
+                        break
+                    rows += pending[0].rows
+                    items.append(heapq.heappop(pending))
+                if len(pending) == 0:
+                    del self._pending[model_name]
+            self._drop_expired(expired)
+            if len(items) > 0:
+                self._dispatch(model_name, items)
+
+    def _choose_model(self) -> str:
+        # only models holding the most urgent priority waiting are considered
+        most_urgent = min(pending[0].sort_key[0] for pending in self._pending.values())
+        candidates = [name for name, pending in self._pending.items() if pending[0].sort_key[0] == most_urgent]
+        if self._current_model in candidates and self._consecutive_batches < MAX_CONSECUTIVE_BATCHES:
+            self._consecutive_batches += 1
+            return self._current_model
+        # otherwise serve whichever model has been waiting longest
+        model_name = min(candidates, key=lambda name: min(item.queued_at for item in self._pending[name]))
+        self._current_model = model_name
+        self._consecutive_batches = 1
+        return model_name
+
+    def _drop_expired(self, items: list[_BatchItem]):
+        if len(items) == 0:
+            return
+        logging.info(f"Dropping {len(items)} images past their deadline")
+        BATCH_PENDING.dec(amount=len(items))
+        for item in items:
+            JOBS_DROPPED.inc(item.priority, "deadline")
+            item.future.set_exception(DeadlineExceededError("Deadline passed before the image reached the model"))
+
+    def _dispatch(self, model_name: str, items: list[_BatchItem]):
+        logging.info(f"Dispatching batch of {len(items)} images for model {model_name}")
+        BATCH_PENDING.dec(amount=len(items))
+        dispatched_at = time.monotonic()
+        for item in items:
+            STAGE_SECONDS.observe(dispatched_at - item.queued_at, "batch_wait")
+            QUEUE_WAIT_SECONDS.observe(dispatched_at - item.picked_up_at, item.priority)
+            if item.trace is not None:
+                # the wait started on the thread that submitted the image, it's shown on this one
+                now = time.perf_counter()
+                item.trace.add("batch_wait", now - (dispatched_at - item.queued_at), now, {"priority": item.priority})
+        try:
+            # every traced job in the batch gets the batch's spans
+            with tracing.use(*(item.trace for item in items), batch_size=len(items)):
+                results = self._interrogator.process_batch(
+                    [item.image for item in items],
+                    model_name,
+                    [item.options for item in items],
+                )
+        except Exception as e:
+            for item in items:
+                item.future.set_exception(e)
+            return
+        for item, result in zip(items, results):
+            item.future.set_result(result)
@@ -0,0 +1,49 @@
+import threading
+
+import numpy as np
+
+DEFAULT_MAX_FREE = 64
+
+
+class BufferPool:
+    """
+    float32 arrays kept for reuse, so steady state preprocessing and inference don't allocate. acquire() hands
+    out a free array of the exact shape, or a new one, and release() keeps it for the next acquire, up to
+    max_free arrays per shape. A pool with max_free of 0 allocates every time.
+    """
+
+    def __init__(self, max_free: int = DEFAULT_MAX_FREE):
+        self._max_free = max_free
+        self._free: dict[tuple[int, ...], list[np.ndarray]] = {}
+        self._mutex = threading.Lock()
+        self.allocations = 0
+        self.reuses = 0
+
+    def acquire(self, shape: tuple[int, ...]) -> np.ndarray:
+        with self._mutex:
+            free = self._free.get(shape)
+            if free:
+                self.reuses += 1
+                return free.pop()
+            self.allocations += 1
+        return np.empty(shape, dtype=np.float32)
+
+    def release(self, array: np.ndarray):
+        # the array must not be used by the caller afterwards
+        with self._mutex:
+            free = self._free.setdefault(array.shape, [])
+            if len(free) < self._max_free:
+                free.append(array)
+
+    def stats(self) -> dict[str, int]:
+        with self._mutex:
+            return {
+                "allocations": self.allocations,
+                "reuses": self.reuses,
+                "free_bytes": sum(array.nbytes for free in self._free.values() for array in free),
+            }
+
+
+def batch_capacity(rows: int) -> int:
+    # batches are cut from buffers with a power of two rows, so a handful of shapes serve every batch size
+    return 1 << (rows - 1).bit_length()
@@ -0,0 +1,290 @@
+import dataclasses
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from core.batch_scheduler import BatchScheduler
+from core.interrogator import Interrogator
+from core.job_executor import DEFAULT_PREPROCESS_WORKERS, DEFAULT_MAX_IN_FLIGHT
+from core.tagging import TaggingOptions
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+FORMAT_JSONL = "jsonl"
+FORMAT_PARQUET = "parquet"
+FORMATS = (FORMAT_JSONL, FORMAT_PARQUET)
+CHECKPOINT_FILE = "checkpoint.json"
+SHARD_PREFIX = "tags"
+DEFAULT_SHARD_SIZE = 10000
+DEFAULT_CHECKPOINT_INTERVAL = 60.0
+PROGRESS_INTERVAL = 5.0
+
+
+def walk_images(root: str, after: Optional[str] = None) -> Iterator[str]:
+    # Depth first with each directory's entries in name order, so every walk of the same tree has the same order.
+    # Paths relative to root that don't come after `after` in that order are skipped, without listing the
+    # directories that only hold those.
+    after_parts = None if after is None else tuple(after.split(os.sep))
+    yield from _walk(root, (), after_parts)
+
+
+def _walk(path: str, parts: tuple, after_parts: Optional[tuple]) -> Iterator[str]:
+    try:
+        with os.scandir(path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+    except OSError as e:
+        logging.error(f"Skipping {path}: {e}")
+        return
+    for entry in entries:
+        entry_parts = (*parts, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            # every path in the directory sorts before `after` unless the directory is one of its parents
+            if after_parts is not None and entry_parts < after_parts[:len(entry_parts)]:
+                continue
+            yield from _walk(entry.path, entry_parts, after_parts)
+        elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS and entry.is_file():
+            if after_parts is None or entry_parts > after_parts:
+                yield os.path.join(*entry_parts)
+
+
+class DirTagger:
+    """
+    Tags every image under root into shards of JSON Lines or Parquet in output_path. Images are preprocessed by a
+    pool of threads and batched by the scheduler, and their rows are written in walk order. A shard is written once
+    it holds shard_size rows or checkpoint_interval seconds have passed, then checkpoint.json records the last
+    image in it. Running again with the same output_path resumes after that image.
+    """
+
+    def __init__(
+            self,
+            interrogator: Interrogator,
+            scheduler: BatchScheduler,
+            root: str,
+            output_path: str,
+            model_name: str,
+            options: Optional[TaggingOptions] = None,
+            file_format: str = FORMAT_JSONL,
+            shard_size: int = DEFAULT_SHARD_SIZE,
+            checkpoint_interval: float = DEFAULT_CHECKPOINT_INTERVAL,
+            preprocess_workers: int = DEFAULT_PREPROCESS_WORKERS,
+            max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    ):
+        if file_format not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}, got {file_format}")
+        if file_format == FORMAT_PARQUET:
+            # fail before tagging anything rather than at the first shard
+            _import_pyarrow()
+        if model_name not in Interrogator.get_valid_models():
+            raise ValueError(f"Invalid model: {model_name}")
+        self._interrogator = interrogator
+        self._scheduler = scheduler
+        self._root = os.path.abspath(root)
+        self._output_path = output_path
+        self._model_name = model_name
+        self._options = options if options is not None else TaggingOptions()
+        self._format = file_format
+        self._shard_size = shard_size
+        self._checkpoint_interval = checkpoint_interval
+        self._preprocess_workers = preprocess_workers
+        self._max_in_flight = max_in_flight
+
+    def check_checkpoint(self):
+        # raises ValueError when output_path holds a checkpoint of a different run
+        self._load_checkpoint()
+
+    def run(self) -> dict:
+        # blocks until every image is tagged or ctrl-c, either way the rows so far are written and checkpointed
+        os.makedirs(self._output_path, exist_ok=True)
+        checkpoint = self._load_checkpoint()
+        if checkpoint["last_path"] is not None:
+            logging.info(
+                f"Resuming after {checkpoint['last_path']}, {checkpoint['images']} images in "
+                f"{checkpoint['shards']} shards are already tagged"
+            )
+        self._remove_unfinished_shards(checkpoint["shards"])
+
+        pool = ThreadPoolExecutor(self._preprocess_workers, thread_name_prefix="tag-dir-preprocess")
+        pending: deque[tuple[str, Future]] = deque()
+        rows: list[dict] = []
+        stats = {"images": 0, "errors": 0}
+        started = time.perf_counter()
+        shard_started = started
+        progress = (started, 0)
+        try:
+            for path in walk_images(self._root, checkpoint["last_path"]):
+                pending.append((path, self._submit(pool, path)))
+                # rows leave in walk order, a slow image holds up the ones behind it until max_in_flight
+                while len(pending) > 0 and (len(pending) >= self._max_in_flight or pending[0][1].done()):
+                    rows.append(self._row(*pending.popleft(), stats))
+                    if len(rows) >= self._shard_size or time.perf_counter() - shard_started >= self._checkpoint_interval:
+                        self._write_shard(checkpoint, rows)
+                        rows = []
+                        shard_started = time.perf_counter()
+                    progress = self._log_progress(progress, stats)
+            while len(pending) > 0:
+                rows.append(self._row(*pending.popleft(), stats))
+        except KeyboardInterrupt:
+            logging.info("Interrupted, writing out the images tagged so far")
+        self._write_shard(checkpoint, rows)
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        seconds = time.perf_counter() - started
+        stats["seconds"] = seconds
+        stats["images_per_second"] = stats["images"] / seconds if seconds > 0 else 0.0
+        stats["shards"] = checkpoint["shards"]
+        logging.info(
+            f"Tagged {stats['images']} images ({stats['errors']} errors) in {seconds:.1f}s, "
+            f"{stats['images_per_second']:.1f} images/s, {checkpoint['images']} in {checkpoint['shards']} shards "
+            f"in {self._output_path}"
+        )
+        return stats
+
+    def _submit(self, pool: ThreadPoolExecutor, path: str) -> Future:
+        # preprocessed on the pool, then batched with whatever else is waiting
+        result = Future()
+
+        def preprocessed(future: Future):
+            try:
+                image = future.result()
+            except Exception as e:
+                result.set_exception(e)
+                return
+            inferred = self._scheduler.submit(image, self._model_name, self._options)
+            inferred.add_done_callback(lambda f: self._finish(image, f, result))
+
+        pool.submit(
+            self._interrogator.preprocess,
+            os.path.join(self._root, path),
+            self._model_name,
+            self._options,
+        ).add_done_callback(preprocessed)
+        return result
+
+    def _finish(self, image, inferred: Future, result: Future):
+        self._interrogator.release(image)
+        if inferred.exception() is not None:
+            result.set_exception(inferred.exception())
+        else:
+            result.set_result(inferred.result())
+
+    def _row(self, path: str, future: Future, stats: dict) -> dict:
+        try:
+            row = {"path": path, "model": self._model_name, **future.result().to_response()}
+        except Exception as e:
+            # anything one image raises, ie: PIL's DecompressionBombError or cv2.error, is that image's error row
+            # rather than the end of the run
+            stats["errors"] += 1
+            logging.error(f"Failed to tag {path}: {e}")
+            row = {"path": path, "error": str(e)}
+        stats["images"] += 1
+        return row
+
+    def _log_progress(self, progress: tuple[float, int], stats: dict) -> tuple[float, int]:
+        # images/s since the last line, so a slowdown shows up instead of being averaged away
+        logged_at, logged_images = progress
+        now = time.perf_counter()
+        if now - logged_at < PROGRESS_INTERVAL:
+            return progress
+        rate = (stats["images"] - logged_images) / (now - logged_at)
+        logging.info(f"Tagged {stats['images']} images ({stats['errors']} errors), {rate:.1f} images/s")
+        return now, stats["images"]
+
+    def _write_shard(self, checkpoint: dict, rows: list[dict]):
+        # the shard is in place before the checkpoint names it, a crash in between writes it again
+        if len(rows) == 0:
+            return
+        path = self._shard_path(checkpoint["shards"])
+        tmp_path = path + ".tmp"
+        if self._format == FORMAT_PARQUET:
+            _write_parquet(tmp_path, rows)
+        else:
+            _write_jsonl(tmp_path, rows)
+        os.replace(tmp_path, path)
+        checkpoint["shards"] += 1
+        checkpoint["images"] += len(rows)
+        checkpoint["last_path"] = rows[-1]["path"]
+        _write_json(os.path.join(self._output_path, CHECKPOINT_FILE), checkpoint)
+
+    def _shard_path(self, index: int) -> str:
+        return os.path.join(self._output_path, f"{SHARD_PREFIX}-{index:05d}.{self._format}")
+
+    def _load_checkpoint(self) -> dict:
+        run = {
+            "root": self._root,
+            "model": self._model_name,
+            "options": dataclasses.asdict(self._options),
+            "format": self._format,
+        }
+        checkpoint_path = os.path.join(self._output_path, CHECKPOINT_FILE)
+        if not os.path.exists(checkpoint_path):
+            return {**run, "shards": 0, "images": 0, "last_path": None}
+        with open(checkpoint_path, "r") as f:
+            checkpoint = json.load(f)
+        for key, value in run.items():
+            if checkpoint.get(key) != value:
+                raise ValueError(
+                    f"{self._output_path} holds a run with a different {key} ({checkpoint.get(key)}), "
+                    f"use another output dir or remove it to start over"
+                )
+        return checkpoint
+
+    def _remove_unfinished_shards(self, shards: int):
+        # left by a run that stopped before it could checkpoint them
+        with os.scandir(self._output_path) as entries:
+            for entry in entries:
+                if not entry.name.startswith(f"{SHARD_PREFIX}-"):
+                    continue
+                index = entry.name[len(SHARD_PREFIX) + 1:].split(".")[0]
+                if entry.name.endswith(".tmp") or not index.isdigit() or int(index) >= shards:
+                    os.remove(entry.path)
+
+
+def _write_json(path: str, data: dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _write_jsonl(path: str, rows: list[dict]):
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False))
+            f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Writing parquet needs pyarrow, install it with: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def _write_parquet(path: str, rows: list[dict]):
+    pa, pq = _import_pyarrow()
+    scores = pa.map_(pa.string(), pa.float32())
+
+    def items(row: dict, key: str):
+        return None if row.get(key) is None else list(row[key].items())
+
+    table = pa.table({
+        "path": pa.array([row["path"] for row in rows], pa.string()),
+        "model": pa.array([row.get("model") for row in rows], pa.string()),
+        "tags": pa.array([row.get("tags") for row in rows], pa.list_(pa.string())),
+        "confidences": pa.array([items(row, "confidences") for row in rows], scores),
+        "ratings": pa.array([items(row, "ratings") for row in rows], scores),
+        "caption": pa.array([row.get("caption") for row in rows], pa.string()),
+        "error": pa.array([row.get("error") for row in rows], pa.string()),
+    })
+    pq.write_table(table, path)
@@ -0,0 +1,73 @@
+import dataclasses
+from dataclasses import dataclass
+from typing import Optional
+
+GRAPH_OPTIMIZATION_LEVELS = ("disable", "basic", "extended", "all")
+TORCH_DTYPES = ("float32", "bfloat16")
+
+
+@dataclass(frozen=True)
+class ExecutionProfile:
+    """
+    How models are run: which providers, whether the model is swapped for an INT8 dynamically quantized copy,
+    and the onnxruntime session settings. Captioning models run on torch, with the same thread counts and in
+    torch_dtype.
+    """
+    name: str
+    providers: tuple[str, ...] = ("CUDAExecutionProvider", "CPUExecutionProvider")
+    quantize: bool = False
+    # 0 leaves the choice to onnxruntime, which uses every core for intra op threads
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    graph_optimization: str = "all"
+    cpu_mem_arena: bool = True
+    mem_pattern: bool = True
+    # bfloat16 halves the memory of captioning models and is much faster on CPUs with AVX512-BF16 or AMX,
+    # it falls back to float32 where the hardware doesn't support it
+    torch_dtype: str = "float32"
+
+    def __post_init__(self):
+        if self.graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(
+                f"graph_optimization must be one of {', '.join(GRAPH_OPTIMIZATION_LEVELS)}, got {self.graph_optimization}"
+            )
+        if self.torch_dtype not in TORCH_DTYPES:
+            raise ValueError(f"torch_dtype must be one of {', '.join(TORCH_DTYPES)}, got {self.torch_dtype}")
+        if self.intra_op_threads < 0 or self.inter_op_threads < 0:
+            raise ValueError("thread counts can't be negative")
+
+    def with_overrides(self, **overrides) -> "ExecutionProfile":
+        # None means keep the profile's setting
+        return dataclasses.replace(self, **{key: value for key, value in overrides.items() if value is not None})
+
+    def session_options(self, graph_optimization: Optional[str] = None):
+        import onnxruntime as ort
+
+        levels = {
+            "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }
+        options = ort.SessionOptions()
+        options.graph_optimization_level = levels[graph_optimization or self.graph_optimization]
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = self.inter_op_threads
+        if self.inter_op_threads > 1:
+            # inter op threads only run independent branches of the graph in parallel mode
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        options.enable_cpu_mem_arena = self.cpu_mem_arena
+        options.enable_mem_pattern = self.mem_pattern
+        return options
+
+
+PROFILES = {
+    # what the interrogator has always done, CUDA when it's there
+    "default": ExecutionProfile("default"),
+    "cpu": ExecutionProfile("cpu", providers=("CPUExecutionProvider",)),
+    # weights stored as INT8, activations quantized on the fly. Much faster matmuls on CPUs with AVX2/VNNI, at the
+    # cost of some accuracy, see bench-profiles.
+    "cpu-int8": ExecutionProfile("cpu-int8", providers=("CPUExecutionProvider",), quantize=True),
+    # captioning models in bfloat16, tagging models run as in cpu
+    "cpu-bf16": ExecutionProfile("cpu-bf16", providers=("CPUExecutionProvider",), torch_dtype="bfloat16"),
+}
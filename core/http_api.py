@@ -0,0 +1,360 @@
+import io
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlsplit, parse_qs
+
+import cv2
+from PIL import Image
+
+from core.batch_scheduler import BatchScheduler
+from core.interrogator import Interrogator
+from core.metrics import REGISTRY, CONTENT_TYPE, HTTP_REQUESTS, JOBS_DROPPED, timed
+from core.near_duplicates import NearDuplicateIndex, perceptual_hash
+from core.priority import PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK, DeadlineExceededError, \
+    is_expired, read_priority
+from core.result_cache import ResultCache, cache_key
+from core.tagging import TaggingOptions, TagResult
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "SmilingWolf/wd-vit-large-tagger-v3"
+DEFAULT_MAX_BODY_BYTES = 64 * 1024 * 1024
+DEFAULT_REQUEST_TIMEOUT = 60.0
+DEFAULT_MAX_PENDING = 256
+# share of max_pending each priority may fill, the rest is kept free for more urgent requests
+ADMISSION_SHARES = {PRIORITY_INTERACTIVE: 1.0, PRIORITY_NORMAL: 0.75, PRIORITY_BULK: 0.5}
+RETRY_AFTER_SECONDS = 1
+
+_FLOAT_OPTIONS = ("general_threshold", "character_threshold", "scene_threshold")
+_INT_OPTIONS = ("top_k", "frame_step", "max_frames")
+_BOOL_OPTIONS = ("include_ratings", "include_confidences")
+_STRING_OPTIONS = ("frame_sampling", "frame_aggregation")
+# raised for an image that can't be decoded, a 400 rather than a dropped connection
+_IMAGE_ERRORS = (ValueError, OSError, cv2.error, Image.DecompressionBombError)
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class TaggingService:
+    """
+    Tags encoded images held in memory with the resident interrogator, going through the same batch scheduler
+    and result caches as jobs from the input folder. At most max_pending images are held between preprocessing and
+    their result, bulk requests are turned away first so interactive ones still get in.
+    """
+
+    def __init__(
+            self,
+            interrogator: Interrogator,
+            scheduler: Optional[BatchScheduler] = None,
+            cache: Optional[ResultCache] = None,
+            near_duplicates: Optional[NearDuplicateIndex] = None,
+            max_pending: int = DEFAULT_MAX_PENDING,
+    ):
+        self._interrogator = interrogator
+        self._scheduler = scheduler
+        self._cache = cache
+        self._near_duplicates = near_duplicates
+        self._max_pending = max_pending
+        self._pending = 0
+        self._pending_mutex = threading.Lock()
+
+    def submit(
+            self,
+            image_bytes: bytes,
+            model_name: str,
+            options: TaggingOptions,
+            priority: str = PRIORITY_NORMAL,
+            deadline: Optional[float] = None,
+    ) -> Future:
+        picked_up_at = time.monotonic()
+        if model_name not in Interrogator.get_valid_models():
+            raise ValueError(f"Invalid model: {model_name}")
+        key = None
+        if self._cache is not None:
+            key = cache_key(image_bytes, model_name, options, self._interrogator.generation_options(model_name))
+            result = self._cache.get(key)
+            if result is not None:
+                future = Future()
+                future.set_result(result)
+                return future
+        if is_expired(deadline):
+            JOBS_DROPPED.inc(priority, "deadline")
+            raise DeadlineExceededError("Deadline passed before the image was tagged")
+
+        self._admit(priority)
+        try:
+            future = self._run(image_bytes, model_name, options, priority, deadline, picked_up_at, key)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _admit(self, priority: str):
+        with self._pending_mutex:
+            if self._pending >= self._max_pending * ADMISSION_SHARES[priority]:
+                JOBS_DROPPED.inc(priority, "queue_full")
+                raise QueueFullError(f"Too many images waiting to be tagged for {priority} priority, retry later")
+            self._pending += 1
+
+    def _release(self):
+        with self._pending_mutex:
+            self._pending -= 1
+
+    def _run(
+            self,
+            image_bytes: bytes,
+            model_name: str,
+            options: TaggingOptions,
+            priority: str,
+            deadline: Optional[float],
+            picked_up_at: float,
+            key: Optional[str],
+    ) -> Future:
+        image = self._interrogator.preprocess(io.BytesIO(image_bytes), model_name, options)
+        image_hash = None
+        if self._near_duplicates is not None and image.ndim == 3:
+            with timed("near_duplicate_lookup"):
+                image_hash = perceptual_hash(image)
+                result = self._near_duplicates.get(image_hash, model_name, options)
+            if result is not None:
+                self._interrogator.release(image)
+                future = Future()
+                future.set_result(result)
+                if key is not None:
+                    self._cache.put(key, result)
+                return future
+
+        if self._scheduler is not None:
+            future = self._scheduler.submit(
+                image,
+                model_name,
+                options,
+                priority=priority,
+                deadline=deadline,
+                picked_up_at=picked_up_at,
+            )
+        else:
+            future = Future()
+            future.set_result(self._interrogator.process_batch([image], model_name, [options])[0])
+        # once the image has been run its buffer can be reused
+        future.add_done_callback(lambda _: self._interrogator.release(image))
+
+        if key is not None:
+            future.add_done_callback(lambda done: self._remember(key, done))
+        if image_hash is not None:
+            future.add_done_callback(lambda done: self._remember_near_duplicate(image_hash, model_name, options, done))
+        return future
+
+    def _remember(self, key: str, future: Future):
+        if future.exception() is None:
+            self._cache.put(key, future.result())
+
+    def _remember_near_duplicate(self, image_hash: int, model_name: str, options: TaggingOptions, future: Future):
+        if future.exception() is None:
+            self._near_duplicates.put(image_hash, model_name, options, future.result())
+
+
+class TaggingHTTPServer(ThreadingHTTPServer):
+    # every connection gets its own thread, images from concurrent requests meet again in the batch scheduler
+    daemon_threads = True
+
+    def __init__(
+            self,
+            address: tuple[str, int],
+            service: TaggingService,
+            max_body_bytes: int = DEFAULT_MAX_BODY_BYTES,
+            request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+    ):
+        super().__init__(address, TaggingRequestHandler)
+        self.service = service
+        self.max_body_bytes = max_body_bytes
+        self.request_timeout = request_timeout
+
+
+class TaggingRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, so clients can send many images over one connection
+    protocol_version = "HTTP/1.1"
+    server: TaggingHTTPServer
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/metrics":
+            self._send(200, REGISTRY.render().encode("utf-8"), CONTENT_TYPE)
+        elif path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/tag":
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            # the body can't be told apart from the next request
+            self.close_connection = True
+            self._send_json(400, {"error": f"Invalid Content-Length: {self.headers.get('Content-Length')}"})
+            return
+        if length > self.server.max_body_bytes:
+            self.close_connection = True
+            self._send_json(413, {"error": f"Request body is over {self.server.max_body_bytes} bytes"})
+            return
+        body = self.rfile.read(length)
+        if length == 0:
+            self._send_json(400, {"error": "Request body is empty, send an image or multipart/form-data"})
+            return
+
+        started_at = time.perf_counter()
+        try:
+            model_name, options, scheduling = _read_query(url.query)
+            # an image nobody is waiting for anymore isn't run
+            timeout_at = time.time() + self.server.request_timeout
+            scheduling["deadline"] = min(scheduling["deadline"] or timeout_at, timeout_at)
+            content_type = self.headers.get("Content-Type", "")
+            if content_type.startswith("multipart/"):
+                status, response = self._tag_many(_read_multipart(content_type, body), model_name, options, scheduling)
+            else:
+                status, response = self._tag_one(body, model_name, options, scheduling)
+        except ValueError as e:
+            status, response = 400, {"error": str(e)}
+        logging.info(f"{self.command} {self.path} {status} in {(time.perf_counter() - started_at) * 1000:.0f}ms")
+        HTTP_REQUESTS.inc(str(status))
+        self._send_json(status, response, retry_after=status == 503)
+
+    def _tag_one(self, image_bytes: bytes, model_name: str, options: TaggingOptions, scheduling: dict) -> tuple[int, dict]:
+        try:
+            result = self._wait(self.server.service.submit(image_bytes, model_name, options, **scheduling))
+        except QueueFullError as e:
+            return 503, {"error": str(e)}
+        # before OSError, which TimeoutError is a subclass of
+        except TimeoutError as e:
+            return 504, {"error": str(e)}
+        except _IMAGE_ERRORS as e:
+            return 400, {"error": str(e)}
+        except Exception as e:
+            # the model failed rather than the image, ie: it couldn't be loaded or inference raised
+            logging.error(f"Failed to tag an image with {model_name}: {e}")
+            return 500, {"error": str(e)}
+        return 200, {"model": model_name, **result.to_response()}
+
+    def _tag_many(
+            self,
+            images: list[tuple[str, bytes]],
+            model_name: str,
+            options: TaggingOptions,
+            scheduling: dict,
+    ) -> tuple[int, dict]:
+        # everything is submitted before waiting on anything, so the images can share a batch
+        submitted: list[tuple[str, Optional[Future], Optional[str]]] = []
+        rejected = 0
+        for filename, image_bytes in images:
+            try:
+                submitted.append((filename, self.server.service.submit(image_bytes, model_name, options, **scheduling), None))
+            except QueueFullError as e:
+                rejected += 1
+                submitted.append((filename, None, str(e)))
+            except _IMAGE_ERRORS as e:
+                submitted.append((filename, None, str(e)))
+            except Exception as e:
+                logging.error(f"Failed to tag {filename} with {model_name}: {e}")
+                submitted.append((filename, None, str(e)))
+        if rejected == len(images):
+            return 503, {"error": submitted[0][2]}
+
+        results = []
+        for index, (filename, future, error) in enumerate(submitted):
+            line = {"index": index, "filename": filename}
+            if future is not None:
+                try:
+                    result = self._wait(future)
+                    line.update({"model": model_name, **result.to_response()})
+                except _IMAGE_ERRORS as e:
+                    # TimeoutError included, it's an OSError
+                    error = str(e)
+                except Exception as e:
+                    # like a bad image in a batch job, a failed one doesn't fail the rest
+                    logging.error(f"Failed to tag {filename} with {model_name}: {e}")
+                    error = str(e)
+            if error is not None:
+                line["error"] = error
+            results.append(line)
+        return 200, {"results": results}
+
+    def _wait(self, future: Future) -> TagResult:
+        try:
+            return future.result(timeout=self.server.request_timeout)
+        except FutureTimeoutError:
+            if future.done():
+                # dropped at its deadline, DeadlineExceededError is a TimeoutError too
+                raise
+            raise TimeoutError(f"No result after {self.server.request_timeout}s")
+
+    def _send_json(self, status: int, response: dict, retry_after: bool = False):
+        self._send(status, json.dumps(response).encode("utf-8"), "application/json", retry_after)
+
+    def _send(self, status: int, body: bytes, content_type: str, retry_after: bool = False):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if retry_after:
+            self.send_header("Retry-After", str(RETRY_AFTER_SECONDS))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # requests are logged once they're answered, with their latency
+        pass
+
+
+def _read_query(query: str) -> tuple[str, TaggingOptions, dict]:
+    # the model, tagging options and the priority and deadline passed on to TaggingService.submit
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    model_name = params.pop("model", DEFAULT_MODEL)
+    priority = read_priority({"priority": params.pop("priority", PRIORITY_NORMAL)})
+    deadline = params.pop("deadline", None)
+    if deadline is not None:
+        try:
+            deadline = float(deadline)
+        except ValueError:
+            raise ValueError(f"deadline must be a unix time in seconds, got {deadline}")
+    options = {}
+    for key, value in params.items():
+        if key in _BOOL_OPTIONS:
+            options[key] = value.lower() in ("1", "true", "yes")
+        elif key in _FLOAT_OPTIONS or key in _INT_OPTIONS:
+            try:
+                options[key] = int(value) if key in _INT_OPTIONS else float(value)
+            except ValueError:
+                raise ValueError(f"{key} must be a number, got {value}")
+        elif key in _STRING_OPTIONS:
+            options[key] = value
+        else:
+            raise ValueError(f"Unknown query parameter: {key}")
+    return model_name, TaggingOptions.from_job_spec({"options": options}), {"priority": priority, "deadline": deadline}
+
+
+def _read_multipart(content_type: str, body: bytes) -> list[tuple[str, bytes]]:
+    message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body)
+    if not message.is_multipart():
+        raise ValueError("Couldn't read multipart body")
+    images = []
+    for index, part in enumerate(message.iter_parts()):
+        filename = part.get_filename() or part.get_param("name", header="content-disposition") or str(index)
+        images.append((filename, part.get_payload(decode=True)))
+    if len(images) == 0:
+        raise ValueError("Multipart body has no images")
+    return images
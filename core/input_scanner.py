@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Optional, Protocol
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCAN_INTERVAL = 0.5
+DEFAULT_FULL_SCAN_INTERVAL = 60.0
+# directories changed this recently are listed again on the next poll, a file created in the same mtime tick as
+# the last listing would otherwise be missed. NFS mtimes can be as coarse as a second.
+MTIME_GRANULARITY = 2.0
+
+
+class PathHandler(Protocol):
+    def offer_path(self, path: str) -> bool: ...
+
+
+def shard_name(job_id: str) -> str:
+    # the sharded input layout puts <job_id>.zip in data/input/<shard>/, one of 256 dirs
+    return hashlib.blake2b(job_id.encode("utf-8"), digest_size=1).hexdigest()
+
+
+class ScanningObserver:
+    """
+    Finds new files in the input dir by listing it with os.scandir every scan_interval and hands them straight to
+    the handler. Only names that weren't there on the last listing are offered, and a directory is only listed
+    again when its mtime changes, so an idle backlog costs one stat per directory per poll. With recursive
+    scheduling, the input dir's subdirectories (ie: the sharded layout) are scanned too, so a change only relists
+    its own shard. Every full_scan_interval everything is offered again, which catches a job put back under
+    the same name between two polls. Has the parts of watchdog's observer interface that InputObserver uses.
+    """
+
+    def __init__(self, scan_interval: float = DEFAULT_SCAN_INTERVAL, full_scan_interval: float = DEFAULT_FULL_SCAN_INTERVAL):
+        self._scan_interval = scan_interval
+        self._full_scan_interval = full_scan_interval
+        self._handler: Optional[PathHandler] = None
+        self._path: Optional[str] = None
+        self._recursive = False
+        # directory -> (mtime_ns when listed or None to list it again, names of the files in it)
+        self._listed: dict[str, tuple[Optional[int], set[str]]] = {}
+        self._subdirs: list[str] = []
+        self._last_full_scan = 0.0
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def schedule(self, handler: PathHandler, path: str, recursive: bool = False):
+        self._handler = handler
+        self._path = path
+        self._recursive = recursive
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="input-scanner", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def scan(self) -> int:
+        # one pass over the input dir, returns how many paths were offered
+        full = time.monotonic() - self._last_full_scan >= self._full_scan_interval
+        if full:
+            self._last_full_scan = time.monotonic()
+        offered = self._scan_dir(self._path, full, is_root=True)
+        for subdir in self._subdirs:
+            offered += self._scan_dir(subdir, full)
+        return offered
+
+    def _scan_dir(self, path: str, full: bool, is_root: bool = False) -> int:
+        listed_mtime, previous_names = self._listed.get(path, (None, set()))
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._listed.pop(path, None)
+            return 0
+        if mtime == listed_mtime and not full:
+            return 0
+
+        names = set()
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # d_type from the listing, no stat per entry
+                    if entry.is_file():
+                        names.add(entry.name)
+                    elif is_root and self._recursive and entry.is_dir():
+                        subdirs.append(entry.path)
+        except FileNotFoundError:
+            self._listed.pop(path, None)
+            return 0
+        if is_root:
+            self._subdirs = subdirs
+        recent = time.time() - mtime / 1e9 < MTIME_GRANULARITY
+        self._listed[path] = (None if recent else mtime, names)
+
+        offered = 0
+        for name in (names if full else names - previous_names):
+            if self._stopping.is_set():
+                break
+            # blocks while the work queue is full, which paces a large backlog
+            offered += self._handler.offer_path(os.path.join(path, name))
+        return offered
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.scan()
+            except OSError as e:
+                logging.error(f"Failed to scan {self._path}: {e}")
+            self._stopping.wait(self._scan_interval)
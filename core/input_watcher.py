@@ -6,65 +6,516 @@ import threading
 import time
 import uuid
 import zipfile
+from concurrent.futures import Future
 from pathlib import Path
+from typing import Iterator, Optional
 
 from watchdog.events import FileSystemEventHandler
+from core.batch_scheduler import BatchScheduler
 from core.interrogator import Interrogator
+from core.job import Job, JobBatch
+from core.job_claims import JobClaims
+from core.job_journal import JobJournal
+from core.result_cache import ResultCache, cache_key
+from core.near_duplicates import NearDuplicateIndex, perceptual_hash
+from core.input_scanner import shard_name
+from core.priority import DeadlineExceededError, read_priority, read_deadline
+from core.result_sink import ResultSink, FileResultSink
+from core.tagging import TaggingOptions, TagResult
+from core.tracing import Tracer, JobTrace
+from core import tracing
+from core.metrics import timed, JOBS_FINISHED, JOB_ERRORS
+from core.job_executor import JobExecutor, DEFAULT_IO_WORKERS, DEFAULT_PREPROCESS_WORKERS, DEFAULT_MAX_QUEUED, \
+    DEFAULT_MAX_IN_FLIGHT
 
 logger = logging.getLogger(__name__)
 
+# a producer can create <job_id>.zip.ready once <job_id>.zip is completely written
+READY_SUFFIX = ".ready"
+# files being written that will be renamed to .zip once complete
+PARTIAL_SUFFIXES = (".partial", ".tmp")
+MIN_POLL_INTERVAL = 0.01
+MAX_POLL_INTERVAL = 0.25
+
 
 class InputWatcher(FileSystemEventHandler):
-    def __init__(self, output_path: str, working_path: str, interrogator: Interrogator):
+    def __init__(
+            self,
+            output_path: str,
+            working_path: str,
+            interrogator: Interrogator,
+            scheduler: Optional[BatchScheduler] = None,
+            extract_jobs: bool = False,
+            cache: Optional[ResultCache] = None,
+            started_at: Optional[float] = None,
+            claims: Optional[JobClaims] = None,
+            sink: Optional[ResultSink] = None,
+            journal: Optional[JobJournal] = None,
+            near_duplicates: Optional[NearDuplicateIndex] = None,
+            tracer: Optional[Tracer] = None,
+    ):
         self._output_path = output_path
+        self._sink = sink if sink is not None else FileResultSink(output_path)
         self._working_path = working_path
         self._interrogator = interrogator
+        self._scheduler = scheduler
+        # when false, jobs are read straight out of the zip and the working dir is never touched
+        self._extract_jobs = extract_jobs
+        self._cache = cache
+        # time.monotonic() when the process started, used to track time to first result
+        self._started_at = started_at if started_at is not None else time.monotonic()
+        self.time_to_first_result: Optional[float] = None
+        self._executor: Optional[JobExecutor] = None
+        # zip paths currently queued or running, mapped to when they were picked up. Several events can
+        # announce the same zip (created, closed, moved, a .ready sidecar), it only runs once.
+        self._claimed: dict[str, float] = {}
+        # zip paths a producer has signalled as complete, these skip the stability check
+        self._ready: set[str] = set()
+        self._claim_mutex = threading.Lock()
+        # when set, zips are renamed into this worker's claim dir before they're read, so workers sharing the
+        # input dir never run the same job. The working dir must then belong to this worker alone.
+        self._claims = claims
+        self._journal = journal
+        # answers resized and re-encoded copies of images already tagged, after preprocessing
+        self._near_duplicates = near_duplicates
+        self._tracer = tracer
+        # job id -> trace of the job, until its result is written
+        self._traces: dict[str, JobTrace] = {}
 
     def clean_start(self):
         delete_all_in_path(self._working_path)
+        if self._claims is not None:
+            released = self._claims.release_own()
+            if released > 0:
+                logging.info(f"Returned {released} unfinished jobs from {self._claims.path} to the input dir")
+
+    def start_executor(
+            self,
+            io_workers: int = DEFAULT_IO_WORKERS,
+            preprocess_workers: int = DEFAULT_PREPROCESS_WORKERS,
+            max_queued: int = DEFAULT_MAX_QUEUED,
+            max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    ):
+        self._executor = JobExecutor(
+            self,
+            io_workers=io_workers,
+            preprocess_workers=preprocess_workers,
+            max_queued=max_queued,
+            max_in_flight=max_in_flight,
+        )
+        self._executor.start()
+
+    def stop_executor(self):
+        if self._executor is not None:
+            self._executor.stop()
+            self._executor = None
 
     def reprocess_unhandled_jobs(self, input_path):
-        files_by_oldest = list_files_sorted_by_oldest(input_path)
-        for file in files_by_oldest:
-            file_path = os.path.join(input_path, file)
-            thread: threading.Thread = threading.Thread(
-                target=self._handle_path,
-                args=(file_path,)
-            )
-            thread.start()
+        if self._executor is None:
+            self._feed_backlog(input_path)
+            return
+        # feed the backlog from a single thread so the bounded intake queue paces it
+        thread: threading.Thread = threading.Thread(
+            target=self._feed_backlog,
+            args=(input_path,),
+            name="backlog-feeder",
+            daemon=True,
+        )
+        thread.start()
+
+    def _feed_backlog(self, input_path: str):
+        # Streamed rather than listed and sorted up front, so starting doesn't wait on a large backlog. Jobs the
+        # journal has seen go first in the order they were seen, then anything else in the input dir.
+        queued = 0
+        if self._journal is not None:
+            for zip_name in self._journal.unfinished():
+                queued += self._submit(os.path.join(input_path, zip_name))
+        queued += self._feed_dir(input_path, into_subdirs=True)
+        logging.info(f"Queued {queued} backlog jobs")
 
+    def _feed_dir(self, path: str, into_subdirs: bool = False) -> int:
+        # the input dir's subdirectories are the shards of the sharded layout, input/<shard>/<job_id>.zip
+        queued = 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if into_subdirs:
+                        queued += self._feed_dir(entry.path)
+                    continue
+                queued += self.offer_path(entry.path)
+        return queued
+
+    def offer_path(self, path: str) -> bool:
+        # for scanners that hand over paths directly instead of through watchdog events
+        if path.endswith(READY_SUFFIX):
+            return self._submit(path[:-len(READY_SUFFIX)], ready=True)
+        return self._submit(path)
+
+    # A zip is known to be complete when it's renamed into place (on_moved), when the writer closes it
+    # (on_closed, inotify only) or when a <job_id>.zip.ready sidecar appears. Anything else is picked up
+    # from on_created and polled until it's stable.
     def on_created(self, event):
+        if event.is_directory:
+            return
+        os.makedirs(self._output_path, exist_ok=True)
+        logging.debug(f"File created: {event.src_path}")
+        if event.src_path.endswith(READY_SUFFIX):
+            self._submit(event.src_path[:-len(READY_SUFFIX)], ready=True)
+        else:
+            self._submit(event.src_path)
+
+    def on_moved(self, event):
+        if event.is_directory:
+            return
         os.makedirs(self._output_path, exist_ok=True)
-        print(f"File created: {event.src_path}")
-        zip_path = event.src_path
-        self._handle_path(zip_path)
+        if event.dest_path.endswith(READY_SUFFIX):
+            self._submit(event.dest_path[:-len(READY_SUFFIX)], ready=True)
+        else:
+            self._submit(event.dest_path, ready=True)
+
+    def on_closed(self, event):
+        if event.is_directory:
+            return
+        self._submit(event.src_path, ready=True)
+
+    def _submit(self, path: str, ready: bool = False) -> bool:
+        # true when the zip wasn't already queued or running
+        if _is_ignored(path) or not os.path.isfile(path):
+            return False
+        with self._claim_mutex:
+            if ready:
+                self._ready.add(path)
+            if path in self._claimed:
+                return False
+            self._claimed[path] = time.monotonic()
+        if self._journal is not None and path.endswith(".zip"):
+            self._journal.seen(self._zip_path_to_job_id(path), self._journal_name(path))
+        if self._executor is not None:
+            self._executor.submit(path)
+        else:
+            self._handle_path(path)
+        return True
 
     def _handle_path(self, zip_path):
+        try:
+            for job in self.load_jobs(zip_path):
+                try:
+                    with tracing.use(job.trace, image=job.index):
+                        if job.result is None and job.error is None:
+                            with tracing.span("preprocess"):
+                                self.preprocess_job(job)
+                            job.result = self.infer_job(job).result()
+                        self.finish_job(job)
+                except (ValueError, RuntimeError, OSError) as e:
+                    self.fail_job(zip_path, e, job)
+        except (ValueError, RuntimeError, TimeoutError) as e:
+            self.fail_job(zip_path, e)
+
+    def load_jobs(self, zip_path: str) -> Iterator[Job]:
+        # jobs answered by the cache come back with their result already set
+        self._validate_zip_file(zip_path)
         job_id = self._zip_path_to_job_id(zip_path)
+        trace = self._begin_trace(job_id)
+        # already in our claim dir when the executor put the zip aside and loads it again, it was ready and is ours
+        owned = self._claims is not None and os.path.dirname(zip_path) == self._claims.path
+        if not owned:
+            with tracing.use(trace):
+                with timed("wait"):
+                    ready = self._wait_until_file_ready(zip_path)
+            if not ready:
+                # gone, another worker took it
+                with self._claim_mutex:
+                    self._claimed.pop(zip_path, None)
+                self._end_trace(job_id, discard=True)
+                return
+        journal_name = self._journal_name(zip_path)
+        if self._claims is not None and not owned:
+            claimed_path = self._claims.claim(zip_path)
+            self._move_claim(zip_path, claimed_path)
+            if claimed_path is None:
+                self._end_trace(job_id, discard=True)
+                return
+            zip_path = claimed_path
+        resumed: dict[int, dict] = {}
+        if self._journal is not None:
+            if self._journal.is_written(job_id):
+                logging.info(f"Skipping job {job_id}, its result was already written")
+                self._end_trace(job_id, discard=True)
+                self._cleanup(job_id, zip_path)
+                return
+            self._journal.claimed(job_id, journal_name)
+            resumed = self._journal.inferred_lines(job_id)
+        picked_up_at = self._claimed.get(zip_path)
+        jobs = self._handle_zip(zip_path)
         try:
-            self._validate_zip_file(zip_path)
-            self._wait_until_file_ready(zip_path)
-        except ValueError as e:
-            self._write_error_response(str(e), job_id)
-            logging.error(f"Failed to validate zip file: {e}")
-        except TimeoutError as e:
-            self._write_error_response(str(e), job_id)
-            logging.error(f"Timeout waiting for zip file {zip_path}: {e}")
+            yield from self._load_zip_jobs(jobs, job_id, trace, picked_up_at, resumed)
+        except GeneratorExit:
+            # closed to be loaded again later, that load traces it
+            self._end_trace(job_id, discard=True)
+            raise
+
+    def _load_zip_jobs(
+            self,
+            jobs: Iterator[Job],
+            job_id: str,
+            trace: Optional[JobTrace],
+            picked_up_at: Optional[float],
+            resumed: dict[int, dict],
+    ) -> Iterator[Job]:
+        while True:
+            # the trace is only current while this generator runs, not while the caller has the job
+            with tracing.use(trace):
+                job = next(jobs, None)
+                if job is None:
+                    break
+                job.picked_up_at = picked_up_at
+                if trace is None and job.trace_requested:
+                    trace = self._begin_trace(job_id, requested=True, picked_up_at=picked_up_at)
+                job.trace = trace
+                line = resumed.get(job.index or 0)
+                if line is not None and job.error is None:
+                    self._resume(job, line)
+                elif self._cache is not None and job.error is None:
+                    with timed("cache_lookup"):
+                        self._lookup_cached_result(job)
+            yield job
+
+    def _begin_trace(
+            self,
+            job_id: str,
+            requested: bool = False,
+            picked_up_at: Optional[float] = None,
+    ) -> Optional[JobTrace]:
+        if self._tracer is None:
+            return None
+        trace = self._tracer.begin(job_id, requested)
+        if trace is None:
+            return None
+        if picked_up_at is not None:
+            # asked for in job.json, so the time spent before job.json was read is one span
+            now = time.perf_counter()
+            trace.add("load", now - (time.monotonic() - picked_up_at), now)
+        with self._claim_mutex:
+            self._traces[job_id] = trace
+        return trace
+
+    def _end_trace(self, job_id: str, discard: bool = False):
+        if self._tracer is None:
+            return
+        with self._claim_mutex:
+            trace = self._traces.pop(job_id, None)
+        if trace is None:
+            return
+        if discard:
+            self._tracer.discard(trace)
+        else:
+            self._tracer.finish(trace)
+
+    def _resume(self, job: Job, line: dict):
+        job.resumed_line = line
+        if "error" in line:
+            job.error = line["error"]
+        else:
+            job.result = TagResult.from_response(line)
+
+    def _move_claim(self, zip_path: str, claimed_path: Optional[str]):
+        with self._claim_mutex:
+            picked_up_at = self._claimed.pop(zip_path, None)
+            self._ready.discard(zip_path)
+            if claimed_path is not None and picked_up_at is not None:
+                self._claimed[claimed_path] = picked_up_at
+        if claimed_path is not None and os.path.exists(zip_path + READY_SUFFIX):
+            try:
+                os.remove(zip_path + READY_SUFFIX)
+            except FileNotFoundError:
+                pass
+
+    def _lookup_cached_result(self, job: Job):
+        image_bytes = job.image_bytes
+        if image_bytes is None:
+            with open(job.image_path, "rb") as f:
+                image_bytes = f.read()
+        job.cache_key = cache_key(
+            image_bytes,
+            job.model_name,
+            job.options,
+            self._interrogator.generation_options(job.model_name),
+        )
+        result = self._cache.get(job.cache_key)
+        if result is not None:
+            job.result = result
+            job.from_cache = True
+            stats = self._cache.stats()
+            logging.info(
+                f"Answered job {job.job_id} from cache "
+                f"(memory hits: {stats['memory_hits']}, disk hits: {stats['disk_hits']}, misses: {stats['misses']})"
+            )
+
+    def preprocess_job(self, job: Job):
+        job.image = self._interrogator.preprocess(job.image_source(), job.model_name, job.options)
+        if self._near_duplicates is not None and job.image.ndim == 3:
+            with timed("near_duplicate_lookup"):
+                self._lookup_near_duplicate(job)
+
+    def _lookup_near_duplicate(self, job: Job):
+        job.image_hash = perceptual_hash(job.image)
+        result = self._near_duplicates.get(job.image_hash, job.model_name, job.options)
+        if result is not None:
+            job.result = result
+            job.from_near_duplicate = True
+            stats = self._near_duplicates.stats()
+            logging.info(
+                f"Answered job {job.job_id} from a near duplicate "
+                f"(hits: {stats['hits']}, misses: {stats['misses']}, entries: {stats['entries']})"
+            )
+
+    def infer_job(self, job: Job) -> Future:
+        if job.result is not None:
+            # answered by the near duplicate index
+            future = Future()
+            future.set_result(job.result)
+            return future
+        if job.image is not None and self._scheduler is not None:
+            return self._scheduler.submit(
+                job.image,
+                job.model_name,
+                job.options,
+                priority=job.priority,
+                deadline=job.deadline,
+                picked_up_at=job.picked_up_at,
+                trace=job.trace,
+            )
+        future = Future()
         try:
-            self._handle_zip(zip_path)
-        except ValueError as e:
-            self._write_error_response(str(e), job_id)
-            logging.error(f"Failed to handle zip file: {e}")
-        except RuntimeError as e:
-            self._write_error_response(str(e), job_id)
-            logging.error(f"Failed to handle zip file: {e}")
-        except TimeoutError as e:
-            self._write_error_response(str(e), job_id)
-            logging.error(f"Timeout waiting for zip file {zip_path}: {e}")
-        os.remove(zip_path)
+            if job.image is not None:
+                future.set_result(self._interrogator.process_batch([job.image], job.model_name, [job.options])[0])
+            else:
+                future.set_result(self._interrogator.process(job.image_source(), job.model_name, job.options))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def finish_job(self, job: Job):
+        self._release_image(job)
+        if job.batch is not None:
+            self._finish_batch_image(job)
+            return
+        logging.info(f"got tags: {job.result.tags}")
+        logging.info(f"finished job {job.job_id} with model name: {job.model_name}")
+        job_response = job.resumed_line
+        if job_response is None:
+            job_response = {
+                "job_id": job.job_id,
+                "model": job.model_name,
+                **job.result.to_response(),
+            }
+            if self._journal is not None:
+                self._journal.inferred(job.job_id, 0, job_response)
+        with timed("write"):
+            written = self._sink.write(job.job_id, job_response)
+        JOBS_FINISHED.inc(_finished_source(job))
+        picked_up_at = self._claimed.get(job.zip_path)
+        if picked_up_at is not None:
+            logging.info(f"Job {job.job_id} took {(time.monotonic() - picked_up_at) * 1000:.0f}ms from pickup to result")
+        if self.time_to_first_result is None:
+            self.time_to_first_result = time.monotonic() - self._started_at
+            logging.info(f"Time to first result: {self.time_to_first_result:.2f}s")
+        self._remember(job)
+        self._end_trace(job.job_id)
+        self._cleanup_when_written(written, job.job_id, job.zip_path)
+
+    def _finish_batch_image(self, job: Job):
+        line = job.resumed_line
+        if line is None and job.error is not None:
+            line = {"job_id": job.job_id, "index": job.index, "filename": job.filename, "error": job.error}
+        elif line is None:
+            line = {
+                "job_id": job.job_id,
+                "index": job.index,
+                "filename": job.filename,
+                "model": job.model_name,
+                **job.result.to_response(),
+            }
+            self._remember(job)
+        if job.resumed_line is None and self._journal is not None:
+            # a restart before the whole batch is written doesn't run this image again
+            self._journal.inferred(job.job_id, job.index, line)
+        if job.result is not None:
+            JOBS_FINISHED.inc(_finished_source(job))
+        if not job.batch.record(line):
+            return
+        with timed("write"):
+            written = self._sink.write_batch(job.job_id, job.batch.lines)
+        picked_up_at = self._claimed.get(job.zip_path)
+        if picked_up_at is not None:
+            logging.info(f"Job {job.job_id} took {(time.monotonic() - picked_up_at) * 1000:.0f}ms from pickup to result")
+        self._end_trace(job.job_id)
+        self._cleanup_when_written(written, job.job_id, job.zip_path)
+
+    def _remember(self, job: Job):
+        if self._cache is not None and job.cache_key is not None and not job.from_cache:
+            self._cache.put(job.cache_key, job.result)
+        if self._near_duplicates is not None and job.image_hash is not None and not job.from_near_duplicate:
+            self._near_duplicates.put(job.image_hash, job.model_name, job.options, job.result)
+
+    def fail_job(self, zip_path: str, error: Exception, job: Optional[Job] = None):
+        JOB_ERRORS.inc(type(error).__name__)
+        if job is not None:
+            self._release_image(job)
+        if job is not None and job.batch is not None:
+            # one bad image doesn't fail the rest of the batch
+            logging.error(f"Failed to tag {job.filename} in job {job.job_id}: {error}")
+            job.error = str(error)
+            self._finish_batch_image(job)
+            return
+        job_id = self._zip_path_to_job_id(zip_path)
+        if isinstance(error, DeadlineExceededError):
+            logging.error(f"Dropped job {job_id}: {error}")
+        elif isinstance(error, TimeoutError):
+            logging.error(f"Timeout waiting for zip file {zip_path}: {error}")
+        else:
+            logging.error(f"Failed to handle zip file {zip_path}: {error}")
+        written = self._write_error_response(str(error), job_id)
+        self._end_trace(job_id)
+        self._cleanup_when_written(written, job_id, zip_path)
+
+    def _release_image(self, job: Job):
+        # the image was copied into its batch, the buffer goes back to the interrogator for the next job
+        if job.image is not None:
+            self._interrogator.release(job.image)
+            job.image = None
+
+    def _cleanup_when_written(self, written: Future, job_id: str, zip_path: str):
+        # the zip is only removed once its result is stored, a job whose result couldn't be stored runs again
+        # on the next start
+        def cleanup(_):
+            if written.exception() is not None:
+                logging.error(f"Keeping {zip_path}, the result of job {job_id} wasn't stored: {written.exception()}")
+                return
+            if self._journal is not None:
+                self._journal.written(job_id, self._journal_name(zip_path))
+            self._cleanup(job_id, zip_path)
+
+        written.add_done_callback(cleanup)
+
+    def _cleanup(self, job_id: str, zip_path: str):
+        zip_paths = [zip_path]
+        if self._claims is not None:
+            # a job can fail after it was claimed but before its jobs carried the claimed path
+            zip_paths.append(os.path.join(self._claims.path, os.path.basename(zip_path)))
+        for path in zip_paths:
+            if os.path.exists(path):
+                os.remove(path)
+                logging.info(f"deleted input zip file: {path}")
+            if os.path.exists(path + READY_SUFFIX):
+                os.remove(path + READY_SUFFIX)
+            with self._claim_mutex:
+                self._claimed.pop(path, None)
+                self._ready.discard(path)
         job_working_dir = self.get_job_working_dir(job_id)
-        shutil.rmtree(job_working_dir)
-        logging.info(f"deleted working dir: {job_working_dir}")
+        if os.path.exists(job_working_dir):
+            shutil.rmtree(job_working_dir)
+            logging.info(f"deleted working dir: {job_working_dir}")
 
     def _validate_zip_file(self, zip_path):
         os.path.basename(zip_path)
@@ -74,85 +525,197 @@ class InputWatcher(FileSystemEventHandler):
 
     def _wait_until_file_ready(self, zip_path):
         return self._wait_until_stable(zip_path)
-        # max_wait = 5
-        # expiry = time.time() + max_wait
-        # while not _is_file_closed(zip_path):
-        #     if time.time() > expiry:
-        #         raise TimeoutError(f"File {zip_path} wasn't closed closed after {max_wait} seconds.")
-        #     time.sleep(0.1)
+
     def _wait_until_stable(self, zip_path):
-        previous_size = -1
+        # Fallback for producers that don't signal completion. The zip is ready once its size and mtime stop
+        # changing and its central directory (written last) can be read. Polling starts fast and backs off.
+        previous_stat = None
+        interval = MIN_POLL_INTERVAL
         max_wait = 5
         expiry = time.time() + max_wait
         while True:
+            if zip_path in self._ready:
+                return True
             if time.time() > expiry:
                 raise TimeoutError(f"File {zip_path} wasn't ready after {max_wait} seconds.")
-            current_size = os.path.getsize(zip_path)
-            if current_size == previous_size:
+            try:
+                stat = os.stat(zip_path)
+            except FileNotFoundError:
+                # claimed by another worker
+                return False
+            current_stat = (stat.st_size, stat.st_mtime_ns)
+            if current_stat == previous_stat and zipfile.is_zipfile(zip_path):
                 return True
-            previous_size = current_size
-            time.sleep(1)
-    def _handle_zip(self, zip_path):
+            previous_stat = current_stat
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    def _handle_zip(self, zip_path) -> Iterator[Job]:
         logging.info(f"Handling zip file: {zip_path}")
         job_id: str = self._zip_path_to_job_id(zip_path)
+        if not self._extract_jobs:
+            yield from self._read_jobs(job_id, zip_path)
+            return
         job_working_dir = self.get_job_working_dir(job_id)
         os.makedirs(job_working_dir, exist_ok=True)
-        unzip_file(zip_path, job_working_dir)
-        self._start_job(job_id)
-        logging.info(f"deleted input zip file: {zip_path}")
+        with timed("unzip"):
+            unzip_file(zip_path, job_working_dir)
+        yield from self._start_job(job_id, zip_path)
+
+    def _read_jobs(self, job_id: str, zip_path: str) -> Iterator[Job]:
+        with open_zip(zip_path) as zip_ref:
+            names = [info.filename for info in zip_ref.infolist() if not info.is_dir()]
+            if "job.json" not in names:
+                raise ValueError(f"Job {job_id} has no job file")
+            job_spec = json.loads(zip_ref.read("job.json"))
+            if "images" in job_spec:
+                # each image is read only when the executor has room for it
+                for job in self._create_batch_jobs(job_id, zip_path, job_spec):
+                    if job.error is None:
+                        try:
+                            with timed("unzip"):
+                                job.image_bytes = zip_ref.read(job.filename)
+                        except KeyError:
+                            JOB_ERRORS.inc("KeyError")
+                            job.error = f"{job.filename} isn't in the zip"
+                        except (zipfile.BadZipFile, OSError) as e:
+                            JOB_ERRORS.inc(type(e).__name__)
+                            job.error = f"Failed to read {job.filename}: {e}"
+                    yield job
+                return
+            images = [name for name in names if os.path.splitext(name)[1].lower() in self._supported_extensions()]
+            if len(images) == 0:
+                raise ValueError(f"Job {job_id} has no images")
+            image_name = job_spec.get("input_image_filename")
+            if image_name not in images:
+                image_name = images[0]
+            with timed("unzip"):
+                image_bytes = zip_ref.read(image_name)
+        yield self._create_job(job_id, zip_path, job_spec, image_bytes=image_bytes)
+
+    def _journal_name(self, zip_path: str) -> str:
+        # the zip's path relative to the input dir, which keeps its shard dir in the sharded layout
+        name = os.path.basename(zip_path)
+        shard = os.path.basename(os.path.dirname(zip_path))
+        if shard == shard_name(self._zip_path_to_job_id(zip_path)):
+            return os.path.join(shard, name)
+        return name
 
     def _zip_path_to_job_id(self, zip_path) -> str:
         job_id = os.path.splitext(os.path.basename(zip_path))[0]
         return job_id
 
-    def _write_error_response(self, response, job_id):
+    def _write_error_response(self, response, job_id) -> Future:
         job_response = {
             "error": response,
         }
-        response_file_name = f"{job_id}.json"
-        path = os.path.join(self._output_path, response_file_name)
-        with open(path, "w") as f:
-            logging.info(f"Wrote error {response_file_name}")
-            json.dump(job_response, f, indent=4)
+        logging.info(f"Writing error for job {job_id}")
+        return self._sink.write(job_id, job_response)
 
     def get_job_working_dir(self, id):
         job_working_dir = os.path.join(self._working_path, id)
         return job_working_dir
 
-    def _start_job(self, job_id: str):
+    def _start_job(self, job_id: str, zip_path: str) -> Iterator[Job]:
         job_working_dir = self.get_job_working_dir(job_id)
+        job_file_path = os.path.join(job_working_dir, "job.json")
+        if os.path.exists(job_file_path):
+            job_spec = read_json(job_file_path)
+            if "images" in job_spec:
+                for job in self._create_batch_jobs(job_id, zip_path, job_spec):
+                    if job.error is None:
+                        image_path = os.path.normpath(os.path.join(job_working_dir, job.filename))
+                        if not image_path.startswith(os.path.normpath(job_working_dir) + os.sep) or not os.path.isfile(image_path):
+                            JOB_ERRORS.inc("KeyError")
+                            job.error = f"{job.filename} isn't in the zip"
+                        job.image_path = image_path
+                    yield job
+                return
         images = self.find_images(job_id)
         if len(images) == 0:
             raise ValueError(f"Job {job_id} has no images")
         image_path = os.path.join(job_working_dir, images[0])
-        job_file_path = os.path.join(job_working_dir, "job.json")
         if not os.path.exists(job_file_path):
             raise ValueError(f"Job {job_id} has no job file")
         job_spec = read_json(job_file_path)
+        yield self._create_job(job_id, zip_path, job_spec, image_path=image_path)
+
+    def _create_batch_jobs(self, job_id: str, zip_path: str, job_spec: dict) -> Iterator[Job]:
+        # job.json lists the images, each either a filename or {"filename": ..., "options": {...}}.
+        # Per image options are layered over the job's options.
+        model_name = self._read_model_name(job_id, job_spec)
+        priority, deadline = self._read_scheduling(job_id, job_spec)
+        entries = job_spec["images"]
+        if not isinstance(entries, list) or len(entries) == 0:
+            raise ValueError(f"Job {job_id} images must be a non-empty list")
+        job_options = job_spec.get("options", {})
+        batch = JobBatch(job_id, zip_path, len(entries))
+        for index, entry in enumerate(entries):
+            job = Job(
+                job_id=job_id,
+                zip_path=zip_path,
+                model_name=model_name,
+                batch=batch,
+                index=index,
+                priority=priority,
+                deadline=deadline,
+                trace_requested=job_spec.get("trace") is True,
+            )
+            try:
+                if isinstance(entry, str):
+                    entry = {"filename": entry}
+                if not isinstance(entry, dict) or not isinstance(entry.get("filename"), str):
+                    raise ValueError(f"image entries must be a filename or an object with a filename, got {entry}")
+                job.filename = entry["filename"]
+                image_options = entry.get("options", {})
+                if not isinstance(image_options, dict) or not isinstance(job_options, dict):
+                    raise ValueError("options must be an object")
+                job.options = TaggingOptions.from_job_spec({"options": {**job_options, **image_options}})
+            except ValueError as e:
+                JOB_ERRORS.inc(type(e).__name__)
+                job.error = str(e)
+            yield job
+
+    def _create_job(
+            self,
+            job_id: str,
+            zip_path: str,
+            job_spec: dict,
+            image_path: Optional[str] = None,
+            image_bytes: Optional[bytes] = None,
+    ) -> Job:
+        model_name = self._read_model_name(job_id, job_spec)
+        priority, deadline = self._read_scheduling(job_id, job_spec)
+        try:
+            options = TaggingOptions.from_job_spec(job_spec)
+        except ValueError as e:
+            raise ValueError(f"Job {job_id} has invalid options: {e}")
+        return Job(
+            job_id=job_id,
+            zip_path=zip_path,
+            model_name=model_name,
+            image_path=image_path,
+            image_bytes=image_bytes,
+            options=options,
+            priority=priority,
+            deadline=deadline,
+            trace_requested=job_spec.get("trace") is True,
+        )
+
+    def _read_scheduling(self, job_id: str, job_spec: dict) -> tuple[str, Optional[float]]:
+        try:
+            return read_priority(job_spec), read_deadline(job_spec)
+        except ValueError as e:
+            raise ValueError(f"Job {job_id} {e}")
+
+    def _read_model_name(self, job_id: str, job_spec: dict) -> str:
         # need a model name
         if "model_name" not in job_spec:
             raise ValueError(f"Job {job_id} has no model name")
         model_name = job_spec["model_name"]
         if not self._is_valid_model(model_name):
             raise ValueError(f"Job {job_id} has invalid model name: {model_name}")
-        try:
-            tags = self._interrogator.process(image_path, model_name)
-        except ValueError as e:
-            # we're not using it properly.
-            # todo: cleanup
-            return
-        logging.info(f"got tags: {tags}")
-        logging.info(f"finished job {job_id} with model name: {model_name}")
-        job_response = {
-            "job_id": job_id,
-            "model": model_name,
-            "tags": tags,
-        }
-        response_file_name = f"{job_id}.json"
-        path = os.path.join(self._output_path, response_file_name)
-        with open(path, "w") as f:
-            logging.info(f"Wrote {response_file_name}")
-            json.dump(job_response, f, indent=4)
+        return model_name
 
     def _is_valid_model(self, model_name) -> bool:
         valid_models = Interrogator.get_valid_models()
@@ -166,7 +729,7 @@ class InputWatcher(FileSystemEventHandler):
             return [
                 f.name
                 for f in Path(job_working_dir).iterdir()
-                if f.is_file() and f.suffix.lower() in {'.jpg', '.jpeg', '.png'}
+                if f.is_file() and f.suffix.lower() in self._supported_extensions()
             ]
         except RuntimeError:
             logging.error(f"Directory not found: {job_working_dir}")
@@ -177,7 +740,19 @@ class InputWatcher(FileSystemEventHandler):
             return []
 
     def _supported_extensions(self):
-        return [".jpg", ".jpeg", '.png"']
+        return [".jpg", ".jpeg", ".png", ".gif", ".webp"]
+
+
+def _finished_source(job: Job) -> str:
+    if job.resumed_line is not None:
+        return "journal"
+    if job.from_near_duplicate:
+        return "near_duplicate"
+    return "cache" if job.from_cache else "model"
+
+
+def _is_ignored(path: str) -> bool:
+    return path.endswith(READY_SUFFIX) or path.endswith(PARTIAL_SUFFIXES)
 
 
 def _is_file_closed(file_path):
@@ -206,6 +781,7 @@ def unzip_file(zip_file_path, destination_folder):
     # Ensure the destination folder exists
     os.makedirs(destination_folder, exist_ok=True)
     expiry = time.time() + 5
+    interval = MIN_POLL_INTERVAL
 
     # Open the zip file
     while True:
@@ -220,10 +796,26 @@ def unzip_file(zip_file_path, destination_folder):
                 return
         except zipfile.BadZipFile as e:
             print(f"Failed to extract {zip_file_path}: {e}")
-            time.sleep(0.1)
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
 
 
 
+def open_zip(zip_file_path) -> zipfile.ZipFile:
+    expiry = time.time() + 5
+    interval = MIN_POLL_INTERVAL
+    while True:
+        if time.time() > expiry:
+            os.remove(zip_file_path)
+            raise TimeoutError(f"Zip file {zip_file_path} couldn't be opened after 5 seconds")
+        try:
+            return zipfile.ZipFile(zip_file_path, 'r')
+        except zipfile.BadZipFile as e:
+            logging.warning(f"Failed to open {zip_file_path}, retrying: {e}")
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+
 def read_json(file_path):
     with open(file_path, 'r') as file:
         data = json.load(file)
@@ -235,7 +827,14 @@ def list_directories(path):
 
 def list_files_sorted_by_oldest(directory):
     # Get all file paths in the directory
-    files = [os.path.join(directory, file) for file in os.listdir(directory) if os.path.isfile(os.path.join(directory, file))]
+    files = []
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file():
+                files.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            # other workers can claim files while we're listing
+            pass
     # Sort files by modified time (oldest first)
-    files.sort(key=lambda x: os.path.getmtime(x))
-    return files
\ No newline at end of file
+    files.sort()
+    return [path for _, path in files]
\ No newline at end of file
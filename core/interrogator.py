@@ -1,23 +1,20 @@
 import logging
+import tempfile
+from contextlib import contextmanager
 from pathlib import Path
 
-import torch
-from onnxruntime import InferenceSession
-
 import numpy as np
-from PIL import Image
-from transformers import Blip2Processor, \
-    Blip2ForConditionalGeneration, \
-    BlipProcessor, BlipForConditionalGeneration, \
-    AutoModelForImageClassification, \
-    AutoFeatureExtractor, AutoConfig
-from huggingface_hub import hf_hub_download
-import pandas as pd
 
-from core import dbimutils as dbimutils
+from core import preprocess as vit_preprocess
+from core.buffer_pool import BufferPool, batch_capacity, DEFAULT_MAX_FREE
+from core.metrics import timed, BATCH_SIZE
+from core.execution_profile import ExecutionProfile, PROFILES
+from core.model_files import resolve_model_file, create_onnx_session, quantized_model_path
+from core.model_pool import ModelPool, LoadedModel, DEFAULT_MEMORY_BUDGET
+from core.tagging import TaggingOptions, TagResult, TagVocabulary
 
 
-from typing import Optional
+from typing import Optional, BinaryIO
 import threading
 
 logger = logging.getLogger(__name__)
@@ -25,180 +22,334 @@ logger = logging.getLogger(__name__)
 ARCHITECTURE_VIT = "vit"
 ARCHITECTURE_BLIP = "blip"
 ARCHITECTURE_BLIP2 = "blip2"
+CAPTION_ARCHITECTURES = (ARCHITECTURE_BLIP, ARCHITECTURE_BLIP2)
+
+# longest caption generated, in tokens. Captions are a sentence, this bounds the time a batch can take.
+DEFAULT_MAX_CAPTION_TOKENS = 30
 
+# a path on disk or an open file-like object holding the encoded image
+ImageSource = str | BinaryIO
 
+
+# torch, transformers and onnxruntime are imported when a model of their architecture is first loaded,
+# so starting up doesn't pay for libraries the configured models never use.
 class Interrogator:
-    def __init__(self):
-        self._current_model_name: Optional[str] = None
-        self._current_model: Optional[Blip2ForConditionalGeneration | BlipForConditionalGeneration] = None
-        self._processor: Optional[Blip2Processor | BlipProcessor] = None
-        self._feature_extractor: Optional[AutoFeatureExtractor] = None
+    def __init__(
+            self,
+            providers: Optional[list[str]] = None,
+            memory_budget: int = DEFAULT_MEMORY_BUDGET,
+            optimized_cache_path: Optional[str] = None,
+            model_dirs: Optional[dict[str, str]] = None,
+            profile: Optional[ExecutionProfile] = None,
+            reuse_buffers: bool = True,
+            max_caption_tokens: int = DEFAULT_MAX_CAPTION_TOKENS,
+    ):
         self._mutex: threading.Lock = threading.Lock()
-        self._providers: list[str] = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-        self._model_tags = None
+        if profile is None:
+            profile = PROFILES["default"]
+        if providers is not None:
+            profile = profile.with_overrides(providers=tuple(providers))
+        self._profile = profile
+        self._models = ModelPool(self._setup_model, self._teardown_model, memory_budget)
+        # model name -> input shape, and the mean and std captioning models normalize by
+        self._input_specs: dict[str, tuple[tuple[int, int, int], Optional[tuple[np.ndarray, np.ndarray]]]] = {}
+        # where graph optimized copies of onnx models are kept between restarts
+        self._optimized_cache_path = optimized_cache_path
+        # model name -> local directory with model.onnx and selected_tags.csv, used instead of the hub
+        self._model_dirs: dict[str, str] = model_dirs or {}
+        # preprocessed images, batch inputs and model outputs
+        self._buffers = BufferPool(DEFAULT_MAX_FREE if reuse_buffers else 0)
+        self._max_caption_tokens = max_caption_tokens
 
-    def process(self, image_path: str, model_name: str) -> list[str]:
-        logging.info(f"Processing {image_path} with model {model_name}")
+    def preload(self, model_name: str):
+        # loads and warms up a model ahead of the first job that needs it
+        with self._mutex:
+            self._ensure_model(model_name)
+
+    def generation_options(self, model_name: str) -> dict:
+        # settings of this interrogator that change what the model returns, cached results are kept apart by them
+        if Interrogator.get_model_architecture(model_name) in CAPTION_ARCHITECTURES:
+            return {"max_caption_tokens": self._max_caption_tokens}
+        return {}
+
+    def model_stats(self) -> dict:
         with self._mutex:
-            if model_name not in Interrogator.get_valid_models():
-                raise ValueError(f"Invalid model: {model_name}")
-            if self._current_model_name == None:
-                # first run, set it up.
-                logging.info("No current model, setting up")
-                self._setup_model(model_name)
-            elif model_name != self._current_model_name:
-                logging.info("Changing model, tearing down model")
-                self._teardown_model()
-                logging.info(f"Changing model to {model_name}")
-                self._setup_model(model_name)
+            return self._models.stats()
 
+    def buffer_stats(self) -> dict:
+        return self._buffers.stats()
+
+    @contextmanager
+    def _locked(self):
+        # without a scheduler, jobs queue up here for the model, the wait is its own stage
+        with timed("lock_wait"):
+            self._mutex.acquire()
+        try:
+            yield
+        finally:
+            self._mutex.release()
+
+    def release(self, image: np.ndarray):
+        # hands back an image from preprocess() once its result is in, a later preprocess() reuses its buffer
+        if image.ndim == 3:
+            self._buffers.release(image)
+
+    def process(self, image_path: ImageSource, model_name: str, options: Optional[TaggingOptions] = None) -> TagResult:
+        logging.info(f"Processing {image_path} with model {model_name}")
+        if options is None:
+            options = TaggingOptions()
+        with self._locked():
+            loaded = self._ensure_model(model_name)
 
             # prepare inputs for the model
-            architecture = Interrogator.get_model_architecture(model_name)
-            if architecture == ARCHITECTURE_BLIP or architecture == ARCHITECTURE_BLIP2:
-                image = self._preprocess_image(image_path, model_name)
-                tags = self._process_blip(image)
-            elif architecture == ARCHITECTURE_VIT:
-                tags = self._process_vit(image_path)
+            if loaded.architecture in CAPTION_ARCHITECTURES:
+                image = vit_preprocess.preprocess_caption(image_path, loaded.input_shape[:2], *_normalization(loaded))
+                return _caption_result(self._run_caption(loaded, [image])[0])
+            elif loaded.architecture != ARCHITECTURE_VIT:
+                raise ValueError(f"Invalid architecture: {loaded.architecture}")
+            image = self._preprocess_vit(image_path, loaded.input_shape[0], options)
+            confidents, output = self._run_vit(loaded, [image])
+
+        with timed("select_tags"):
+            result = loaded.vocabulary.select(_aggregate_frames(confidents, [image], [options]), options)[0]
+        self._buffers.release(output)
+        return result
+
+    def preprocess(self, image_path: ImageSource, model_name: str, options: Optional[TaggingOptions] = None) -> np.ndarray:
+        # Preprocessing only needs the model input size, so it runs outside the lock
+        # and can overlap with inference of other jobs. Animated images come back as a stack of frames,
+        # picked by the options' frame sampling. Captioning models only see the first frame.
+        if model_name not in Interrogator.get_valid_models():
+            raise ValueError(f"Invalid model: {model_name}")
+        spec = self._input_specs.get(model_name)
+        if spec is None:
+            # the input spec is remembered so later jobs don't touch the model pool until inference
+            with self._mutex:
+                spec = self._input_specs.get(model_name)
+                if spec is None:
+                    loaded = self._ensure_model(model_name)
+                    normalization = _normalization(loaded) if loaded.architecture in CAPTION_ARCHITECTURES else None
+                    spec = (loaded.input_shape, normalization)
+                    self._input_specs[model_name] = spec
+        input_shape, normalization = spec
+        out = self._buffers.acquire(input_shape)
+        if normalization is not None:
+            return vit_preprocess.preprocess_caption(image_path, input_shape[:2], *normalization, out)
+        image = self._preprocess_vit(image_path, input_shape[0], options if options is not None else TaggingOptions(), out)
+        if image is not out:
+            # animated, the frames got their own array
+            self._buffers.release(out)
+        return image
+
+    def process_batch(
+            self,
+            images: list[np.ndarray],
+            model_name: str,
+            options: Optional[list[TaggingOptions]] = None,
+    ) -> list[TagResult]:
+        logging.info(f"Processing batch of {len(images)} images with model {model_name}")
+        if options is None:
+            options = [TaggingOptions()] * len(images)
+        with self._locked():
+            loaded = self._ensure_model(model_name)
+            if loaded.architecture in CAPTION_ARCHITECTURES:
+                captions = self._run_caption(loaded, images)
+            elif loaded.architecture == ARCHITECTURE_VIT:
+                confidents, output = self._run_vit(loaded, images)
+                vocabulary = loaded.vocabulary
             else:
-                raise ValueError(f"Invalid architecture: {architecture}")
-
-        # Split the caption into potential tags
-        return tags
-    def _process_blip(self, image: Image.Image) -> list[str]:
-        inputs = self._processor(images=image, return_tensors="pt")
-
-        # generate captions (description of the image)
-        outputs = self._model.generate(**inputs)
-        caption = self._processor.decode(outputs[0], skip_special_tokens=True)
-        tags = [word.lower() for word in caption.split()]
-        return tags
-    def _process_vit(self, image_path: str) -> list[str]:
-        vision_tags = []
-        image: Image.Image = Image.open(image_path)
-
-
-        # code for converting the image and running the model is taken from the link below
-        # thanks, SmilingWolf!
-        # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
-
-        # convert an image to fit the model
-        _, height, _, _ = self._model.get_inputs()[0].shape
-
-        # alpha to white
-        image = image.convert('RGBA')
-        new_image = Image.new('RGBA', image.size, 'WHITE')
-        new_image.paste(image, mask=image)
-        image = new_image.convert('RGB')
-        image = np.asarray(image)
-
-        # PIL RGB to OpenCV BGR
-        image = image[:, :, ::-1]
-
-        image = dbimutils.make_square(image, height)
-        image = dbimutils.smart_resize(image, height)
-        image = image.astype(np.float32)
-        image = np.expand_dims(image, 0)
-        
-        input_name = self._model.get_inputs()[0].name
-        label_name = self._model.get_outputs()[0].name
-        confidents = self._model.run([label_name], {input_name: image})[0]
-
-        tags = self._model_tags[:][['name']]
-        tags['confidents'] = confidents[0]
-
-        # first 4 items are for rating (general, sensitive, questionable, explicit)
-        ratings = dict(tags[:4].values)
-
-        # rest are regular tags
-        tags = dict(tags[4:].values)
-        threshold = 0.35
-        logging.info(f"filtering {len(tags)} tags with threshold {threshold}")
-        filtered = {tag: confidence for tag, confidence in tags.items() if confidence > threshold}
-        logging.info(f"filtered down to {len(filtered)} tags")
-        keys = list(filtered.keys())
-        keys = [s.replace("_", " ") for s in keys]
-        return keys
-    def _preprocess_image(self, image_path: str, model_name: str) -> Image.Image:
-        target_size = Interrogator.get_dimensions_for_model(model_name)
-        image: Image.Image = Image.open(image_path)
-        image.thumbnail(target_size, Image.Resampling.LANCZOS)
-
-        padded_image = Image.new("RGB", target_size, (0, 0, 0))
-        padded_image.paste(
-            image,
-            ((target_size[0] - image.size[0]) // 2, (target_size[1] - image.size[1]) // 2)
-        )
-        return padded_image
+                raise ValueError(f"Invalid architecture: {loaded.architecture}")
+        if loaded.architecture in CAPTION_ARCHITECTURES:
+            return [_caption_result(caption) for caption in captions]
+        confidents = _aggregate_frames(confidents, images, options)
+
+        # tag selection doesn't need the model, so it runs after the lock is released.
+        # rows sharing the same options are thresholded together.
+        results: list[Optional[TagResult]] = [None] * len(images)
+        rows_by_options: dict[TaggingOptions, list[int]] = {}
+        for row, row_options in enumerate(options):
+            rows_by_options.setdefault(row_options, []).append(row)
+        with timed("select_tags"):
+            for row_options, rows in rows_by_options.items():
+                for row, result in zip(rows, vocabulary.select(confidents[rows], row_options)):
+                    results[row] = result
+        self._buffers.release(output)
+        return results
+
+    def _ensure_model(self, model_name: str) -> LoadedModel:
+        if model_name not in Interrogator.get_valid_models():
+            raise ValueError(f"Invalid model: {model_name}")
+        return self._models.get(model_name)
+
+    def _run_caption(self, loaded: LoadedModel, images: list[np.ndarray]) -> list[str]:
+        # One generate call captions the whole batch. The images are copied into a pooled channels last batch that
+        # torch reads in place, only a dtype or device conversion copies it.
+        import torch
+
+        rows = len(images)
+        batch = self._buffers.acquire((batch_capacity(rows), *loaded.input_shape))
+        for row, image in enumerate(images):
+            batch[row] = image
+        BATCH_SIZE.observe(rows, loaded.name)
+        pixel_values = torch.from_numpy(batch[:rows]).permute(0, 3, 1, 2).to(loaded.model.device, loaded.model.dtype)
+        with timed("inference"), torch.inference_mode():
+            # greedy and bounded, so one image can't hold up the rest of the batch
+            output_ids = loaded.model.generate(
+                pixel_values=pixel_values,
+                max_new_tokens=self._max_caption_tokens,
+                num_beams=1,
+                do_sample=False,
+            )
+        self._buffers.release(batch)
+        return loaded.processor.batch_decode(output_ids, skip_special_tokens=True)
 
-    def _setup_model(self, model_name):
+    def _preprocess_vit(
+            self,
+            image_path: ImageSource,
+            height: int,
+            options: TaggingOptions,
+            out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        return vit_preprocess.preprocess_frames(image_path, height, options, out)
+
+    def _run_vit(self, loaded: LoadedModel, images: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+        # The images, and the frames of animated ones, are copied into a pooled NHWC float32 batch and the
+        # model writes straight into a pooled output buffer through io binding. Returns the confidences, a view
+        # of the output buffer, and the buffer itself, which the caller releases once it's done with them.
+        rows = sum(len(_as_rows(image)) for image in images)
+        capacity = batch_capacity(rows)
+        batch = self._buffers.acquire((capacity, *loaded.input_shape))
+        output = self._buffers.acquire((capacity, loaded.output_size))
+        row = 0
+        for image in images:
+            frames = _as_rows(image)
+            batch[row:row + len(frames)] = frames
+            row += len(frames)
+
+        BATCH_SIZE.observe(rows, loaded.name)
+        binding = loaded.io_binding
+        binding.bind_input(loaded.input_name, "cpu", 0, np.float32, (rows, *loaded.input_shape), batch.ctypes.data)
+        binding.bind_output(loaded.output_name, "cpu", 0, np.float32, (rows, loaded.output_size), output.ctypes.data)
+        with timed("inference"):
+            loaded.model.run_with_iobinding(binding)
+        self._buffers.release(batch)
+        return output[:rows], output
+
+    def _setup_model(self, model_name) -> LoadedModel:
         logging.info(f"Setting up model: {model_name}")
         architecture = Interrogator.get_model_architecture(model_name)
-        if architecture == ARCHITECTURE_BLIP:
-            self._model = BlipForConditionalGeneration.from_pretrained(model_name)
-            self._processor = BlipProcessor.from_pretrained(model_name)
-        elif architecture == ARCHITECTURE_BLIP2:
-            self._model = Blip2ForConditionalGeneration.from_pretrained(model_name)
-            self._processor = Blip2Processor.from_pretrained(model_name)
+        if architecture in CAPTION_ARCHITECTURES:
+            return self._setup_caption(model_name, architecture)
         elif architecture == ARCHITECTURE_VIT:
-            self._setup_wd(model_name)
+            return self._setup_wd(model_name)
         else:
             raise ValueError(f"Invalid architecture: {architecture}")
-        self._current_model_name = model_name
-    def _setup_wd(self, model_name: str):
+
+    def _setup_caption(self, model_name: str, architecture: str) -> LoadedModel:
+        import torch
+        if architecture == ARCHITECTURE_BLIP:
+            from transformers import BlipProcessor as processor_class, BlipForConditionalGeneration as model_class
+        else:
+            from transformers import Blip2Processor as processor_class, Blip2ForConditionalGeneration as model_class
+
+        _set_torch_threads(self._profile)
+        use_cuda = "CUDAExecutionProvider" in self._profile.providers and torch.cuda.is_available()
+        device = torch.device("cuda" if use_cuda else "cpu")
+        dtype = _torch_dtype(self._profile.torch_dtype, device)
+        source = self._model_dirs.get(model_name, model_name)
+        model = model_class.from_pretrained(source, torch_dtype=dtype).to(device).eval()
+        processor = processor_class.from_pretrained(source)
+        size = processor.image_processor.size
+        height, width = size["height"], size["width"]
+        logging.info(f"Loaded {architecture} model {model_name} from {source} on {device} in {dtype}")
+
+        # the first generate sets up kernels for this dtype, get it out of the way before real jobs
+        with torch.inference_mode():
+            model.generate(pixel_values=torch.zeros((1, 3, height, width), dtype=dtype, device=device), max_new_tokens=2)
+        return LoadedModel(
+            model_name,
+            architecture,
+            model,
+            processor,
+            memory_bytes=_torch_model_bytes(model),
+            input_shape=(height, width, 3),
+        )
+
+    def _setup_wd(self, model_name: str) -> LoadedModel:
         model_file = "model.onnx"
         tags_file = "selected_tags.csv"
         repo_id = model_name
-        logging.info(f"Downloading wd model: {model_name}")
-        model_path = Path(hf_hub_download(
-            repo_id=repo_id,
-            filename=model_file
-        ))
-        tags_path = Path(hf_hub_download(
-            repo_id=repo_id,
-            filename=tags_file,
-        ))
-
-        from onnxruntime import InferenceSession
-        self._model = InferenceSession(
-            str(model_path),
-            providers=self._providers,
-        )
-        logging.info(f"Loaded wd model {model_name} from {model_path}")
-        self._model_tags = pd.read_csv(tags_path)
-
-
-    def _teardown_model(self):
-        model_architecture = Interrogator.get_model_architecture(self._current_model_name)
-        if model_architecture == "blip" or model_architecture == "blip2":
-            logging.info(f"Tearing down model {self._current_model_name}")
-            del self._model
-            self._model = None
-            del self._processor
-            self._processor = None
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-        elif model_architecture == ARCHITECTURE_VIT:
-            del self._model
-            self._model = None
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
+        logging.info(f"Resolving wd model: {model_name}")
+        if model_name in self._model_dirs:
+            model_path = Path(self._model_dirs[model_name]) / model_file
+            tags_path = Path(self._model_dirs[model_name]) / tags_file
         else:
-            raise RuntimeError(f"not implemented: {model_architecture}")
+            model_path = resolve_model_file(repo_id, model_file)
+            tags_path = resolve_model_file(repo_id, tags_file)
+
+        if self._profile.quantize:
+            model_path = quantized_model_path(model_path, self._optimized_cache_path or tempfile.gettempdir())
+        model = create_onnx_session(model_path, self._profile, self._optimized_cache_path)
+        logging.info(f"Loaded wd model {model_name} from {model_path} with the {self._profile.name} profile")
+
+        # the first run allocates the memory arena and picks kernels, get it out of the way before real jobs
+        model_input = model.get_inputs()[0]
+        model_output = model.get_outputs()[0]
+        _, height, width, channels = model_input.shape
+        model.run([model_output.name], {model_input.name: np.zeros((1, height, width, channels), np.float32)})
+        vocabulary = TagVocabulary.load(str(tags_path))
+        logging.info(f"Loaded {len(vocabulary)} tags for {model_name}")
+        # the session holds roughly the weights in memory, the file size is a good enough estimate
+        return LoadedModel(
+            model_name,
+            ARCHITECTURE_VIT,
+            model,
+            vocabulary=vocabulary,
+            memory_bytes=model_path.stat().st_size,
+            input_name=model_input.name,
+            output_name=model_output.name,
+            input_shape=(height, width, channels),
+            # one confidence per tag, the output's tag dimension may not be fixed in the graph
+            output_size=len(vocabulary),
+            io_binding=model.io_binding(),
+        )
+
+    def _teardown_model(self, loaded: LoadedModel):
+        logging.info(f"Tearing down model {loaded.name}")
+        if loaded.architecture not in (ARCHITECTURE_BLIP, ARCHITECTURE_BLIP2, ARCHITECTURE_VIT):
+            raise RuntimeError(f"not implemented: {loaded.architecture}")
+        loaded.model = None
+        loaded.processor = None
+        if loaded.architecture == ARCHITECTURE_BLIP or loaded.architecture == ARCHITECTURE_BLIP2:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                torch.cuda.synchronize()
 
     @staticmethod
     def get_valid_models() -> list[str]:
         return [
+            "Salesforce/blip-image-captioning-base",
+            "Salesforce/blip2-opt-2.7b",
+            "Salesforce/blip2-flan-t5-xl",
             "SmilingWolf/wd-vit-large-tagger-v3",
+            "SmilingWolf/wd-eva02-large-tagger-v3",
+            "SmilingWolf/wd-vit-tagger-v3",
+            "SmilingWolf/wd-swinv2-tagger-v3",
+            "SmilingWolf/wd-convnext-tagger-v3",
         ]
 
     @staticmethod
     def get_dimensions_for_model(model_name: str):
         dimensions = {
-            "Salesforce/blip-image-captioning-base": (224, 224),
+            "Salesforce/blip-image-captioning-base": (384, 384),
             "Salesforce/blip2-opt-2.7b": (224, 224),
             "Salesforce/blip2-flan-t5-xl": (224, 224),
             "SmilingWolf/wd-vit-large-tagger-v3": (256, 256),
+            "SmilingWolf/wd-eva02-large-tagger-v3": (448, 448),
+            "SmilingWolf/wd-vit-tagger-v3": (448, 448),
+            "SmilingWolf/wd-swinv2-tagger-v3": (448, 448),
+            "SmilingWolf/wd-convnext-tagger-v3": (448, 448),
         }
         return dimensions[model_name]
 
@@ -209,5 +360,78 @@ class Interrogator:
             "Salesforce/blip2-opt-2.7b": ARCHITECTURE_BLIP2,
             "Salesforce/blip2-flan-t5-xl": ARCHITECTURE_BLIP2,
             "SmilingWolf/wd-vit-large-tagger-v3": ARCHITECTURE_VIT,
+            "SmilingWolf/wd-eva02-large-tagger-v3": ARCHITECTURE_VIT,
+            "SmilingWolf/wd-vit-tagger-v3": ARCHITECTURE_VIT,
+            "SmilingWolf/wd-swinv2-tagger-v3": ARCHITECTURE_VIT,
+            "SmilingWolf/wd-convnext-tagger-v3": ARCHITECTURE_VIT,
         }
         return architecture[model_name]
+
+
+def _as_rows(image: np.ndarray) -> np.ndarray:
+    # a still image is one row of the batch, an animated one a row per frame
+    return image if image.ndim == 4 else np.expand_dims(image, 0)
+
+
+def _aggregate_frames(confidents: np.ndarray, images: list[np.ndarray], options: list[TaggingOptions]) -> np.ndarray:
+    # one row of confidences per image, combining the rows of each animated image's frames
+    if all(image.ndim == 3 for image in images):
+        return confidents
+    rows = []
+    start = 0
+    for image, image_options in zip(images, options):
+        if image.ndim == 3:
+            rows.append(confidents[start])
+            start += 1
+            continue
+        frames = confidents[start:start + len(image)]
+        rows.append(frames.max(axis=0) if image_options.frame_aggregation == "max" else frames.mean(axis=0))
+        start += len(image)
+    return np.stack(rows)
+
+
+def _caption_result(caption: str) -> TagResult:
+    return TagResult(tags=[word.lower() for word in caption.split()], caption=caption)
+
+
+def _normalization(loaded: LoadedModel) -> tuple[np.ndarray, np.ndarray]:
+    image_processor = loaded.processor.image_processor
+    return (
+        np.asarray(image_processor.image_mean, dtype=np.float32),
+        np.asarray(image_processor.image_std, dtype=np.float32),
+    )
+
+
+def _set_torch_threads(profile: ExecutionProfile):
+    # the profile's thread counts, 0 leaves torch's default of every core
+    import torch
+    if profile.intra_op_threads > 0:
+        torch.set_num_threads(profile.intra_op_threads)
+    if profile.inter_op_threads > 0 and torch.get_num_interop_threads() != profile.inter_op_threads:
+        try:
+            torch.set_num_interop_threads(profile.inter_op_threads)
+        except RuntimeError as e:
+            # can only be set before torch first runs anything in parallel
+            logging.warning(f"Couldn't set torch inter op threads: {e}")
+
+
+def _torch_dtype(name: str, device):
+    import torch
+    if name == "bfloat16":
+        if device.type == "cuda":
+            supported = torch.cuda.is_bf16_supported()
+        else:
+            # without AVX512-BF16 or AMX bfloat16 matmuls are emulated, and slower than float32
+            try:
+                supported = torch.ops.mkldnn._is_mkldnn_bf16_supported()
+            except (AttributeError, RuntimeError):
+                supported = False
+        if supported:
+            return torch.bfloat16
+        logging.warning(f"bfloat16 isn't supported on {device}, running captioning models in float32")
+    return torch.float32
+
+
+def _torch_model_bytes(model) -> int:
+    return sum(p.numel() * p.element_size() for p in model.parameters()) + \
+        sum(b.numel() * b.element_size() for b in model.buffers())
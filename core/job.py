@@ -0,0 +1,70 @@
+import threading
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Optional
+
+import numpy as np
+
+from core.interrogator import ImageSource
+from core.priority import PRIORITY_NORMAL
+from core.tagging import TaggingOptions, TagResult
+from core.tracing import JobTrace
+
+
+class JobBatch:
+    """
+    A job zip holding many images. Each image runs as its own Job and records one result line, the lines are
+    written out together once every image has one.
+    """
+
+    def __init__(self, job_id: str, zip_path: str, total: int):
+        self.job_id = job_id
+        self.zip_path = zip_path
+        self.total = total
+        self.lines: list[dict] = []
+        self._mutex = threading.Lock()
+
+    def record(self, line: dict) -> bool:
+        # returns true once the last image has been recorded
+        with self._mutex:
+            self.lines.append(line)
+            return len(self.lines) == self.total
+
+
+@dataclass
+class Job:
+    job_id: str
+    zip_path: str
+    model_name: str
+    # either the extracted image on disk or the image read straight out of the zip
+    image_path: Optional[str] = None
+    image_bytes: Optional[bytes] = None
+    options: TaggingOptions = TaggingOptions()
+    image: Optional[np.ndarray] = None
+    result: Optional[TagResult] = None
+    cache_key: Optional[str] = None
+    from_cache: bool = False
+    # perceptual hash of the preprocessed image, set when the near duplicate index is on
+    image_hash: Optional[int] = None
+    from_near_duplicate: bool = False
+    # set when this image is one of many in a batch job
+    batch: Optional[JobBatch] = None
+    filename: Optional[str] = None
+    index: Optional[int] = None
+    error: Optional[str] = None
+    # the result line recorded in the job journal before a restart, the image isn't run again
+    resumed_line: Optional[dict] = None
+    priority: str = PRIORITY_NORMAL
+    # unix time after which the job is dropped instead of run
+    deadline: Optional[float] = None
+    # time.monotonic() when the zip was picked up, for the queue wait of its priority
+    picked_up_at: Optional[float] = None
+    # spans of the job while it's traced, every image of a batch shares its zip's trace
+    trace: Optional[JobTrace] = None
+    # job.json asked for a trace with "trace": true
+    trace_requested: bool = False
+
+    def image_source(self) -> ImageSource:
+        if self.image_bytes is not None:
+            return BytesIO(self.image_bytes)
+        return self.image_path
@@ -0,0 +1,115 @@
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_FILE = ".heartbeat"
+DEFAULT_CLAIM_TIMEOUT = 60.0
+DEFAULT_HEARTBEAT_INTERVAL = 5.0
+
+
+def default_worker_id(index: int = 0) -> str:
+    return f"{socket.gethostname()}-{index}"
+
+
+class JobClaims:
+    """
+    Lets several workers, on one host or several sharing the data dir, take jobs from one input dir. A worker
+    claims a zip by renaming it into its own claim dir, which only one worker can win. Each worker touches a
+    heartbeat file in its claim dir, and zips claimed by a worker whose heartbeat is older than claim_timeout
+    are renamed back into the input dir for any worker to pick up again.
+    """
+
+    def __init__(
+            self,
+            claims_path: str,
+            worker_id: str,
+            input_path: str,
+            claim_timeout: float = DEFAULT_CLAIM_TIMEOUT,
+            heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+    ):
+        if claim_timeout <= heartbeat_interval:
+            raise ValueError(f"claim_timeout must be longer than the heartbeat interval of {heartbeat_interval}s")
+        self._claims_path = claims_path
+        self.worker_id = worker_id
+        self.path = os.path.join(claims_path, worker_id)
+        self._input_path = input_path
+        self._claim_timeout = claim_timeout
+        self._heartbeat_interval = heartbeat_interval
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._heartbeat()
+        self._thread = threading.Thread(target=self._run, name="job-claims", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def claim(self, zip_path: str) -> Optional[str]:
+        # returns where the zip now lives, or None if another worker got to it first
+        claimed_path = os.path.join(self.path, os.path.basename(zip_path))
+        try:
+            os.rename(zip_path, claimed_path)
+        except FileNotFoundError:
+            return None
+        return claimed_path
+
+    def release_own(self) -> int:
+        # anything left in our claim dir is from a previous run that didn't finish it
+        os.makedirs(self.path, exist_ok=True)
+        return self._release(self.path)
+
+    def recover_stale(self) -> int:
+        recovered = 0
+        for entry in os.scandir(self._claims_path):
+            if not entry.is_dir() or entry.name == self.worker_id:
+                continue
+            heartbeat_path = os.path.join(entry.path, HEARTBEAT_FILE)
+            try:
+                age = time.time() - os.stat(heartbeat_path).st_mtime
+            except FileNotFoundError:
+                age = self._claim_timeout + 1
+            if age <= self._claim_timeout:
+                continue
+            released = self._release(entry.path)
+            if released > 0:
+                logging.warning(f"Recovered {released} jobs from worker {entry.name}, not seen for {age:.0f}s")
+            recovered += released
+        return recovered
+
+    def _release(self, claim_path: str) -> int:
+        released = 0
+        for entry in os.scandir(claim_path):
+            if entry.name == HEARTBEAT_FILE:
+                continue
+            try:
+                # several workers may recover the same claims, only one rename of each wins
+                os.rename(entry.path, os.path.join(self._input_path, entry.name))
+                released += 1
+            except FileNotFoundError:
+                pass
+        return released
+
+    def _heartbeat(self):
+        heartbeat_path = os.path.join(self.path, HEARTBEAT_FILE)
+        with open(heartbeat_path, "a"):
+            pass
+        os.utime(heartbeat_path)
+
+    def _run(self):
+        while not self._stopping.wait(self._heartbeat_interval):
+            try:
+                self._heartbeat()
+                self.recover_stale()
+            except OSError as e:
+                logging.error(f"Failed to update job claims in {self._claims_path}: {e}")
@@ -0,0 +1,306 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Iterator, Optional, Protocol
+
+from core import tracing
+from core.job import Job
+from core.metrics import JOBS_QUEUED, JOBS_IN_FLIGHT, JOBS_DROPPED
+from core.priority import PRIORITIES, DeadlineExceededError, is_expired, urgency
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IO_WORKERS = 4
+DEFAULT_PREPROCESS_WORKERS = 2
+DEFAULT_MAX_QUEUED = 64
+DEFAULT_MAX_IN_FLIGHT = 32
+
+
+class JobHandler(Protocol):
+    def load_jobs(self, zip_path: str) -> Iterator[Job]:
+        # one job per image. A job may come back with its result already set (ie: from a cache) or with an
+        # error, those go straight to finish_job. A zip closed before any of its jobs was handled is loaded again
+        # from the start later.
+        ...
+
+    def preprocess_job(self, job: Job): ...
+
+    def infer_job(self, job: Job) -> Future: ...
+
+    def finish_job(self, job: Job): ...
+
+    def fail_job(self, zip_path: str, error: Exception, job: Optional[Job] = None): ...
+
+
+class _ParkedZip:
+    # The rest of a zip whose next job had no room in the queue. A zip none of whose jobs had room yet keeps only its
+    # path (jobs and job are None) and is read again from the start, so a backlog waiting for room holds no open
+    # zips or images.
+    def __init__(
+            self,
+            zip_path: str,
+            priority: str,
+            deadline: Optional[float],
+            jobs: Optional[Iterator[Job]] = None,
+            job: Optional[Job] = None,
+    ):
+        self.zip_path = zip_path
+        self.priority = priority
+        self.deadline = deadline
+        self.jobs = jobs
+        self.job = job
+
+
+class _JobQueue:
+    """
+    Jobs waiting for a preprocess worker, handed out most urgent first. Each priority has room for max_queued jobs,
+    so a bulk backlog filling its share never holds up an interactive job. Zips whose next job has no room are
+    parked here until it does.
+    """
+
+    def __init__(self, max_queued: int):
+        self._max_queued = max_queued
+        self._condition = threading.Condition()
+        self._heap: list[tuple] = []
+        self._sequence = itertools.count()
+        self._counts = {priority: 0 for priority in PRIORITIES}
+        self._parked: list[_ParkedZip] = []
+        self._closing = False
+
+    def put(self, job: Job) -> bool:
+        # false when the job's priority has no room
+        with self._condition:
+            if self._counts[job.priority] >= self._max_queued:
+                return False
+            heapq.heappush(self._heap, (*urgency(job.priority, job.deadline), next(self._sequence), job))
+            self._counts[job.priority] += 1
+            self._condition.notify_all()
+            return True
+
+    def put_stop(self):
+        # sorts after every job, so a worker only stops once the queue is empty
+        with self._condition:
+            heapq.heappush(self._heap, (len(PRIORITIES), 0.0, next(self._sequence), None))
+            self._condition.notify_all()
+
+    def get(self) -> Optional[Job]:
+        with self._condition:
+            while len(self._heap) == 0:
+                self._condition.wait()
+            job = heapq.heappop(self._heap)[-1]
+            if job is not None:
+                self._counts[job.priority] -= 1
+                self._condition.notify_all()
+            return job
+
+    def park(self, parked: _ParkedZip):
+        with self._condition:
+            self._parked.append(parked)
+            self._condition.notify_all()
+
+    def unpark(self) -> Optional[_ParkedZip]:
+        # blocks until a parked zip's next job has room, the most urgent first. None once closed and empty.
+        with self._condition:
+            while True:
+                ready = [parked for parked in self._parked if self._counts[parked.priority] < self._max_queued]
+                if len(ready) > 0:
+                    parked = min(ready, key=lambda parked: urgency(parked.priority, parked.deadline))
+                    self._parked.remove(parked)
+                    return parked
+                if self._closing and len(self._parked) == 0:
+                    return None
+                self._condition.wait()
+
+    def close(self):
+        # the unparking thread stops once nothing is parked
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+
+    def qsize(self) -> int:
+        with self._condition:
+            return sum(self._counts.values()) + len(self._parked)
+
+
+class JobExecutor:
+    """
+    Runs jobs through a fixed set of stages so that loading of one job overlaps inference of another:
+
+    intake queue -> io workers (stability wait, unzip, job spec) -> preprocess workers (decode, resize)
+    -> inference (owned by the handler, ie: the batch scheduler) -> writer (response file, cleanup)
+
+    At most max_queued zips wait for an io worker, so submit() blocks producers instead of piling up threads.
+    Preprocess workers take the most urgent job first. An io worker never waits for room for a job: when the job's
+    priority is full, the rest of its zip is parked and resumed by the unparking thread once there's room, so io
+    workers stay free to read the next, possibly more urgent, zip. A parked zip no longer counts towards max_queued,
+    so a parked bulk backlog never keeps an interactive zip from being accepted. Jobs past their deadline are failed
+    before they're preprocessed.
+    """
+
+    def __init__(
+            self,
+            handler: JobHandler,
+            io_workers: int = DEFAULT_IO_WORKERS,
+            preprocess_workers: int = DEFAULT_PREPROCESS_WORKERS,
+            max_queued: int = DEFAULT_MAX_QUEUED,
+            max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    ):
+        self._handler = handler
+        self._io_workers = io_workers
+        self._preprocess_workers = preprocess_workers
+        self._intake: queue.Queue[str | None] = queue.Queue()
+        # zips submitted and not yet read, parked or put aside by an io worker
+        self._admitted = threading.BoundedSemaphore(max_queued)
+        self._preprocess_queue = _JobQueue(max_queued)
+        self._finish_queue: queue.Queue[tuple[Job, Future] | None] = queue.Queue()
+        self._max_in_flight = max_in_flight
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._io_threads: list[threading.Thread] = []
+        self._preprocess_threads: list[threading.Thread] = []
+        self._unpark_thread: threading.Thread | None = None
+        self._writer_thread: threading.Thread | None = None
+
+    def start(self):
+        self._io_threads = [
+            threading.Thread(target=self._run_io, name=f"job-io-{i}", daemon=True)
+            for i in range(self._io_workers)
+        ]
+        self._preprocess_threads = [
+            threading.Thread(target=self._run_preprocess, name=f"job-preprocess-{i}", daemon=True)
+            for i in range(self._preprocess_workers)
+        ]
+        self._unpark_thread = threading.Thread(target=self._run_unpark, name="job-unpark", daemon=True)
+        self._writer_thread = threading.Thread(target=self._run_writer, name="job-writer", daemon=True)
+        for thread in self._io_threads + self._preprocess_threads + [self._unpark_thread, self._writer_thread]:
+            thread.start()
+        JOBS_QUEUED.set_function(self.queued)
+
+    def submit(self, zip_path: str):
+        # blocks while max_queued zips are waiting for an io worker
+        self._admitted.acquire()
+        self._intake.put(zip_path)
+
+    def queued(self) -> int:
+        return self._intake.qsize() + self._preprocess_queue.qsize()
+
+    def stop(self):
+        # drain each stage in order so no accepted job is dropped
+        for _ in self._io_threads:
+            self._intake.put(None)
+        for thread in self._io_threads:
+            thread.join()
+        self._preprocess_queue.close()
+        if self._unpark_thread is not None:
+            self._unpark_thread.join()
+        for _ in self._preprocess_threads:
+            self._preprocess_queue.put_stop()
+        for thread in self._preprocess_threads:
+            thread.join()
+        # wait for every job still in inference to reach the writer
+        for _ in range(self._max_in_flight):
+            self._in_flight.acquire()
+        self._finish_queue.put(None)
+        if self._writer_thread is not None:
+            self._writer_thread.join()
+        for _ in range(self._max_in_flight):
+            self._in_flight.release()
+
+    def _run_io(self):
+        while True:
+            zip_path = self._intake.get()
+            if zip_path is None:
+                return
+            self._read(zip_path, self._handler.load_jobs(zip_path))
+            # read, parked or failed, the zip no longer holds up the zips behind it
+            self._admitted.release()
+
+    def _run_unpark(self):
+        while True:
+            parked = self._preprocess_queue.unpark()
+            if parked is None:
+                return
+            if parked.jobs is None:
+                self._read(parked.zip_path, self._handler.load_jobs(parked.zip_path))
+            else:
+                self._read(parked.zip_path, parked.jobs, parked.job)
+
+    def _read(self, zip_path: str, jobs: Iterator[Job], job: Optional[Job] = None):
+        # Queues the jobs of a zip, starting with job when resuming a parked one. Images are read one at a time,
+        # the bounded queue keeps a large batch from being read up front.
+        handed_on = job is not None
+        try:
+            while True:
+                if job is None:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                if job.result is not None or job.error is not None:
+                    try:
+                        with tracing.use(job.trace, image=job.index):
+                            self._handler.finish_job(job)
+                    except Exception as e:
+                        self._fail(zip_path, e, job)
+                elif not self._drop_expired(job) and not self._preprocess_queue.put(job):
+                    if handed_on:
+                        self._preprocess_queue.park(_ParkedZip(zip_path, job.priority, job.deadline, jobs, job))
+                    else:
+                        jobs.close()
+                        # read again from where the zip lives now, loading may have moved it, ie: into a claim dir
+                        self._preprocess_queue.park(_ParkedZip(job.zip_path, job.priority, job.deadline))
+                    return
+                handed_on = True
+                job = None
+        except Exception as e:
+            self._fail(zip_path, e)
+
+    def _drop_expired(self, job: Job) -> bool:
+        if not is_expired(job.deadline):
+            return False
+        JOBS_DROPPED.inc(job.priority, "deadline")
+        self._fail(job.zip_path, DeadlineExceededError(f"Job {job.job_id} passed its deadline before it was run"), job)
+        return True
+
+    def _run_preprocess(self):
+        while True:
+            job = self._preprocess_queue.get()
+            if job is None:
+                return
+            if self._drop_expired(job):
+                continue
+            self._in_flight.acquire()
+            JOBS_IN_FLIGHT.inc()
+            try:
+                with tracing.use(job.trace, image=job.index):
+                    with tracing.span("preprocess"):
+                        self._handler.preprocess_job(job)
+                    future = self._handler.infer_job(job)
+            except Exception as e:
+                self._in_flight.release()
+                JOBS_IN_FLIGHT.dec()
+                self._fail(job.zip_path, e, job)
+                continue
+            future.add_done_callback(lambda f, job=job: self._finish_queue.put((job, f)))
+
+    def _run_writer(self):
+        while True:
+            item = self._finish_queue.get()
+            if item is None:
+                return
+            job, future = item
+            self._in_flight.release()
+            JOBS_IN_FLIGHT.dec()
+            try:
+                job.result = future.result()
+                with tracing.use(job.trace, image=job.index):
+                    self._handler.finish_job(job)
+            except Exception as e:
+                self._fail(job.zip_path, e, job)
+
+    def _fail(self, zip_path: str, error: Exception, job: Optional[Job] = None):
+        try:
+            self._handler.fail_job(zip_path, error, job)
+        except Exception as e:
+            logging.error(f"Failed to record error for {zip_path}: {e}")
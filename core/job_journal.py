@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+STATE_SEEN = "seen"
+STATE_CLAIMED = "claimed"
+STATE_INFERRED = "inferred"
+STATE_WRITTEN = "written"
+
+
+class JobJournal:
+    """
+    Where every job_id has got to: seen in the input dir, claimed by a worker, inferred (with the result of each
+    of its images) and written to the result sink. A restart resumes unfinished jobs in the order they were seen,
+    reuses results of images inferred before it, and never runs a job_id that was already written again.
+    Several workers on one host can share the journal.
+    """
+
+    def __init__(self, db_path: str, worker_id: str):
+        self._worker_id = worker_id
+        self._mutex = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # a transition lost to a power cut only makes a job run again
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, zip_name TEXT NOT NULL, state TEXT NOT NULL, worker_id TEXT, "
+            "seen_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS lines ("
+            "job_id TEXT NOT NULL, image_index INTEGER NOT NULL, line TEXT NOT NULL, PRIMARY KEY (job_id, image_index))"
+        )
+
+    def seen(self, job_id: str, zip_name: str):
+        now = time.time()
+        with self._mutex:
+            self._db.execute(
+                "INSERT OR IGNORE INTO jobs (job_id, zip_name, state, seen_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, zip_name, STATE_SEEN, now, now),
+            )
+
+    def claimed(self, job_id: str, zip_name: str):
+        now = time.time()
+        with self._mutex:
+            self._db.execute(
+                "INSERT INTO jobs (job_id, zip_name, state, worker_id, seen_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (job_id) DO UPDATE SET state = excluded.state, worker_id = excluded.worker_id, "
+                "updated_at = excluded.updated_at WHERE state != ?",
+                (job_id, zip_name, STATE_CLAIMED, self._worker_id, now, now, STATE_WRITTEN),
+            )
+
+    def inferred(self, job_id: str, image_index: int, line: dict):
+        with self._mutex:
+            self._db.execute("BEGIN")
+            self._db.execute(
+                "INSERT OR REPLACE INTO lines (job_id, image_index, line) VALUES (?, ?, ?)",
+                (job_id, image_index, json.dumps(line, separators=(",", ":"))),
+            )
+            self._db.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE job_id = ? AND state != ?",
+                (STATE_INFERRED, time.time(), job_id, STATE_WRITTEN),
+            )
+            self._db.execute("COMMIT")
+
+    def written(self, job_id: str, zip_name: str):
+        # the results now live in the sink, only the job_id is kept so it isn't run again
+        now = time.time()
+        with self._mutex:
+            self._db.execute("BEGIN")
+            self._db.execute(
+                "INSERT INTO jobs (job_id, zip_name, state, worker_id, seen_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (job_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (job_id, zip_name, STATE_WRITTEN, self._worker_id, now, now),
+            )
+            self._db.execute("DELETE FROM lines WHERE job_id = ?", (job_id,))
+            self._db.execute("COMMIT")
+
+    def is_written(self, job_id: str) -> bool:
+        with self._mutex:
+            row = self._db.execute("SELECT state FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row is not None and row[0] == STATE_WRITTEN
+
+    def inferred_lines(self, job_id: str) -> dict[int, dict]:
+        with self._mutex:
+            rows = self._db.execute("SELECT image_index, line FROM lines WHERE job_id = ?", (job_id,)).fetchall()
+        return {image_index: json.loads(line) for image_index, line in rows}
+
+    def unfinished(self, page_size: int = 1000) -> Iterator[str]:
+        # zip paths relative to the input dir of jobs not yet written, oldest first, read a page at a time however
+        # long the backlog is
+        # rows are inserted when a job is first seen, so rowid order is seen order
+        after = 0
+        while True:
+            with self._mutex:
+                rows = self._db.execute(
+                    "SELECT rowid, zip_name FROM jobs WHERE state IN (?, ?, ?) AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (STATE_SEEN, STATE_CLAIMED, STATE_INFERRED, after, page_size),
+                ).fetchall()
+            for _, zip_name in rows:
+                yield zip_name
+            if len(rows) < page_size:
+                return
+            after = rows[-1][0]
+
+    def close(self):
+        with self._mutex:
+            self._db.close()
@@ -16,7 +16,8 @@ class InputObserver():
         self._output_watcher: InputWatcher = output_watcher
     def start(self):
         os.makedirs(self._input_path, exist_ok=True)
-        self._observer.schedule(self._output_watcher, self._input_path, recursive=False)
+        # recursive so jobs in the sharded layout's subdirectories are seen too
+        self._observer.schedule(self._output_watcher, self._input_path, recursive=True)
         self._observer.start()
 
         try:
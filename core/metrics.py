@@ -0,0 +1,359 @@
+import abc
+import bisect
+import logging
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+from core import tracing
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_TEXTFILE_INTERVAL = 15.0
+
+# seconds, from a sub millisecond tag selection up to a slow model load
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Metric(abc.ABC):
+    type_name = ""
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._mutex = threading.Lock()
+
+    def render(self, constant: str = "") -> list[str]:
+        # constant is label text added to every sample, ie: the worker
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples(constant))
+        return lines
+
+    @abc.abstractmethod
+    def _samples(self, constant: str) -> list[str]:
+        ...
+
+    def _label_text(self, values: tuple[str, ...], *extra: str) -> str:
+        pairs = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, values)]
+        pairs.extend(text for text in extra if text)
+        if len(pairs) == 0:
+            return ""
+        return "{" + ",".join(pairs) + "}"
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._mutex:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        with self._mutex:
+            return self._values.get(label_values, 0)
+
+    def _samples(self, constant: str) -> list[str]:
+        with self._mutex:
+            values = list(self._values.items())
+        return [f"{self.name}{self._label_text(labels, constant)} {_format(value)}" for labels, value in values]
+
+
+class Gauge(_Metric):
+    """A gauge is either set directly or read from a function when metrics are rendered."""
+    type_name = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, *label_values: str):
+        with self._mutex:
+            self._values[label_values] = value
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._mutex:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set_function(self, function: Optional[Callable[[], float]]):
+        self._function = function
+
+    def _samples(self, constant: str) -> list[str]:
+        function = self._function
+        if function is not None:
+            return [f"{self.name}{self._label_text((), constant)} {_format(function())}"]
+        with self._mutex:
+            values = list(self._values.items())
+        return [f"{self.name}{self._label_text(labels, constant)} {_format(value)}" for labels, value in values]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            description: str,
+            labels: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self._buckets = tuple(sorted(buckets))
+        # per label values: a count for each bucket plus one for +Inf, the sum and the total count
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._mutex:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = ([0] * (len(self._buckets) + 1), [0.0, 0])
+                self._values[label_values] = entry
+            entry[0][index] += 1
+            entry[1][0] += value
+            entry[1][1] += 1
+
+    def count(self, *label_values: str) -> int:
+        with self._mutex:
+            entry = self._values.get(label_values)
+            return 0 if entry is None else entry[1][1]
+
+    def total(self, *label_values: str) -> float:
+        with self._mutex:
+            entry = self._values.get(label_values)
+            return 0.0 if entry is None else entry[1][0]
+
+    def label_values(self) -> list[tuple[str, ...]]:
+        with self._mutex:
+            return list(self._values)
+
+    def quantile(self, q: float, *label_values: str) -> float:
+        # estimated from the buckets like prometheus' histogram_quantile, interpolating within the bucket it falls in
+        with self._mutex:
+            entry = self._values.get(label_values)
+            counts = None if entry is None else list(entry[0])
+        if counts is None or sum(counts) == 0:
+            return math.nan
+        rank = q * sum(counts)
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count > 0:
+                if index == len(self._buckets):
+                    # in +Inf, the highest finite bound is all that's known
+                    return self._buckets[-1]
+                lower = self._buckets[index - 1] if index > 0 else 0.0
+                return lower + (self._buckets[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self._buckets[-1]
+
+    def _samples(self, constant: str) -> list[str]:
+        with self._mutex:
+            values = [(labels, list(counts), list(totals)) for labels, (counts, totals) in self._values.items()]
+        lines = []
+        for labels, counts, (total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format(bound)}"'
+                lines.append(f"{self.name}_bucket{self._label_text(labels, constant, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(labels, constant)} {_format(total)}")
+            lines.append(f"{self.name}_count{self._label_text(labels, constant)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        # labels added to every sample, so several worker processes can be told apart
+        self.constant_labels: dict[str, str] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        constant = ",".join(f'{label}="{_escape(value)}"' for label, value in self.constant_labels.items())
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render(constant))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS: Histogram = REGISTRY.register(Histogram(
+    "interrogate_stage_seconds",
+    "Time spent in each stage of handling an image",
+    labels=("stage",),
+))
+BATCH_SIZE: Histogram = REGISTRY.register(Histogram(
+    "interrogate_batch_size",
+    "Images run through the model together",
+    labels=("model",),
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+))
+JOBS_FINISHED: Counter = REGISTRY.register(Counter(
+    "interrogate_jobs_finished_total",
+    "Images tagged, by where the tags came from",
+    labels=("source",),
+))
+QUEUE_WAIT_SECONDS: Histogram = REGISTRY.register(Histogram(
+    "interrogate_queue_wait_seconds",
+    "Time from a job being picked up until its image reaches the model, by priority",
+    labels=("priority",),
+))
+JOBS_DROPPED: Counter = REGISTRY.register(Counter(
+    "interrogate_jobs_dropped_total",
+    "Images dropped before reaching the model, by priority and reason",
+    labels=("priority", "reason"),
+))
+JOB_ERRORS: Counter = REGISTRY.register(Counter(
+    "interrogate_job_errors_total",
+    "Jobs and images that failed, by exception type",
+    labels=("error",),
+))
+JOBS_QUEUED: Gauge = REGISTRY.register(Gauge(
+    "interrogate_jobs_queued",
+    "Jobs waiting for an io or preprocess worker",
+))
+JOBS_IN_FLIGHT: Gauge = REGISTRY.register(Gauge(
+    "interrogate_jobs_in_flight",
+    "Images waiting on or in inference",
+))
+BATCH_PENDING: Gauge = REGISTRY.register(Gauge(
+    "interrogate_batch_pending_images",
+    "Preprocessed images waiting for a batch",
+))
+MODEL_LOADS: Counter = REGISTRY.register(Counter(
+    "interrogate_model_loads_total",
+    "Models loaded",
+    labels=("model",),
+))
+MODEL_EVICTIONS: Counter = REGISTRY.register(Counter(
+    "interrogate_model_evictions_total",
+    "Models unloaded to stay within the memory budget",
+    labels=("model",),
+))
+MODEL_SWITCHES: Counter = REGISTRY.register(Counter(
+    "interrogate_model_switches_total",
+    "Times inference moved to a different model",
+))
+CACHE_LOOKUPS: Counter = REGISTRY.register(Counter(
+    "interrogate_cache_lookups_total",
+    "Result cache lookups, by outcome",
+    labels=("result",),
+))
+NEAR_DUPLICATE_LOOKUPS: Counter = REGISTRY.register(Counter(
+    "interrogate_near_duplicate_lookups_total",
+    "Near duplicate index lookups, by outcome",
+    labels=("result",),
+))
+HTTP_REQUESTS: Counter = REGISTRY.register(Counter(
+    "interrogate_http_requests_total",
+    "HTTP API requests, by status code",
+    labels=("status",),
+))
+
+
+class timed:
+    # with timed("decode"): ... records the block in STAGE_SECONDS, and as a span of the jobs traced on this
+    # thread. A plain class rather than a @contextmanager generator, it's entered several times per image.
+    __slots__ = ("_stage", "_started")
+
+    def __init__(self, stage: str):
+        self._stage = stage
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        ended = time.perf_counter()
+        STAGE_SECONDS.observe(ended - self._started, self._stage)
+        if tracing.active:
+            tracing.record(self._stage, self._started, ended)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
+
+
+class MetricsTextfileWriter:
+    """Writes the metrics for the node exporter textfile collector every interval seconds, and once more on stop."""
+
+    def __init__(self, path: str, interval: float = DEFAULT_TEXTFILE_INTERVAL):
+        self._path = path
+        self._interval = interval
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="metrics-textfile", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def write(self):
+        # the collector may read at any time, so the file is replaced rather than rewritten
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(REGISTRY.render())
+        os.replace(tmp_path, self._path)
+
+    def _run(self):
+        while not self._stopping.wait(self._interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.error(f"Failed to write metrics to {self._path}: {e}")
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,84 @@
+import hashlib
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from core.execution_profile import ExecutionProfile
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_model_file(repo_id: str, filename: str) -> Path:
+    # Anything already in the hugging face cache is used as is, so a restart never waits on the hub.
+    # The hub is only asked when the file has never been downloaded.
+    from huggingface_hub import hf_hub_download
+    from huggingface_hub.utils import LocalEntryNotFoundError
+    try:
+        return Path(hf_hub_download(repo_id=repo_id, filename=filename, local_files_only=True))
+    except LocalEntryNotFoundError:
+        logging.info(f"{filename} for {repo_id} isn't cached, downloading it")
+        return Path(hf_hub_download(repo_id=repo_id, filename=filename))
+
+
+def create_onnx_session(model_path: Path, profile: ExecutionProfile, optimized_cache_path: Optional[str] = None):
+    import onnxruntime as ort
+
+    options = profile.session_options()
+    available = ort.get_available_providers()
+    providers = [provider for provider in profile.providers if provider in available]
+    if optimized_cache_path is None or profile.graph_optimization == "disable":
+        return ort.InferenceSession(str(model_path), options, providers=providers)
+
+    # Extended optimizations only fuse nodes, they don't bake in hardware specific layouts, so the
+    # serialized model stays loadable on this provider after a restart. Loading it applies the rest.
+    saved_level = "basic" if profile.graph_optimization == "basic" else "extended"
+    optimized_path = _optimized_model_path(model_path, providers, saved_level, optimized_cache_path)
+    if optimized_path.exists():
+        logging.info(f"Loading optimized model from {optimized_path}")
+        return ort.InferenceSession(str(optimized_path), options, providers=providers)
+
+    os.makedirs(optimized_path.parent, exist_ok=True)
+    # several workers may be starting at once, each writes its own copy and the last rename wins
+    tmp_path = optimized_path.with_suffix(f".{os.getpid()}.tmp")
+    options = profile.session_options(saved_level)
+    options.optimized_model_filepath = str(tmp_path)
+    session = ort.InferenceSession(str(model_path), options, providers=providers)
+    os.replace(tmp_path, optimized_path)
+    logging.info(f"Saved optimized model to {optimized_path}")
+    return session
+
+
+def quantized_model_path(model_path: Path, cache_path: str) -> Path:
+    # An INT8 dynamically quantized copy of the model, made once and kept in cache_path.
+    # Only the weights are stored quantized, activations are quantized at run time so no calibration data is needed.
+    quantized_path = Path(cache_path) / f"{model_path.stem}.{_source_hash(model_path)}.int8.onnx"
+    if quantized_path.exists():
+        return quantized_path
+
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    os.makedirs(quantized_path.parent, exist_ok=True)
+    tmp_path = quantized_path.with_suffix(f".{os.getpid()}.tmp")
+    logging.info(f"Quantizing {model_path} to INT8, this only happens once")
+    start = time.perf_counter()
+    quantize_dynamic(str(model_path), str(tmp_path), weight_type=QuantType.QInt8)
+    os.replace(tmp_path, quantized_path)
+    logging.info(
+        f"Saved quantized model to {quantized_path} in {time.perf_counter() - start:.1f}s, "
+        f"{model_path.stat().st_size / 1024 / 1024:.0f}MiB -> {quantized_path.stat().st_size / 1024 / 1024:.0f}MiB"
+    )
+    return quantized_path
+
+
+def _optimized_model_path(model_path: Path, providers: list[str], level: str, optimized_cache_path: str) -> Path:
+    return Path(optimized_cache_path) / f"{model_path.stem}.{_source_hash(model_path)}.{providers[0]}.{level}.onnx"
+
+
+def _source_hash(model_path: Path) -> str:
+    # The hub cache path includes the snapshot revision, so a new revision gets a new derived copy. A local model
+    # dir keeps the same path when its model is replaced, the size and mtime tell the copies apart.
+    resolved = model_path.resolve()
+    stat = resolved.stat()
+    key = f"{resolved}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
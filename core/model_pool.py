@@ -0,0 +1,113 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from core.metrics import STAGE_SECONDS, MODEL_LOADS, MODEL_EVICTIONS, MODEL_SWITCHES
+from core.tagging import TagVocabulary
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_BUDGET = 8 * 1024 * 1024 * 1024
+
+
+@dataclass
+class LoadedModel:
+    name: str
+    architecture: str
+    # an onnxruntime InferenceSession for vit models, a transformers model for blip models
+    model: Any
+    processor: Any = None
+    vocabulary: Optional[TagVocabulary] = None
+    memory_bytes: int = 0
+    load_seconds: float = 0.0
+    # onnx session metadata looked up once at load, and the io binding reused by every run
+    input_name: Optional[str] = None
+    output_name: Optional[str] = None
+    input_shape: Optional[tuple[int, int, int]] = None
+    output_size: int = 0
+    io_binding: Any = None
+
+
+class ModelPool:
+    """
+    Keeps loaded models resident until their combined memory goes over the budget, then unloads the least
+    recently used ones. The model being asked for is never unloaded, even if it alone is over budget.
+    Not thread safe, callers hold the interrogator lock.
+    """
+
+    def __init__(
+            self,
+            loader: Callable[[str], LoadedModel],
+            unloader: Callable[[LoadedModel], None],
+            memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    ):
+        self._loader = loader
+        self._unloader = unloader
+        self._memory_budget = memory_budget
+        self._models: OrderedDict[str, LoadedModel] = OrderedDict()
+        self._last_used: Optional[str] = None
+        self.loads = 0
+        self.evictions = 0
+        self.switches = 0
+        self.load_seconds = 0.0
+
+    def get(self, model_name: str) -> LoadedModel:
+        if self._last_used is not None and model_name != self._last_used:
+            self.switches += 1
+            MODEL_SWITCHES.inc()
+        self._last_used = model_name
+
+        loaded = self._models.get(model_name)
+        if loaded is not None:
+            self._models.move_to_end(model_name)
+            return loaded
+
+        start = time.perf_counter()
+        loaded = self._loader(model_name)
+        loaded.load_seconds = time.perf_counter() - start
+        self.loads += 1
+        self.load_seconds += loaded.load_seconds
+        MODEL_LOADS.inc(model_name)
+        STAGE_SECONDS.observe(loaded.load_seconds, "model_load")
+        self._models[model_name] = loaded
+        logging.info(
+            f"Loaded {model_name} in {loaded.load_seconds:.2f}s using {loaded.memory_bytes / 1024 / 1024:.0f}MiB, "
+            f"{self.resident_bytes() / 1024 / 1024:.0f}MiB resident"
+        )
+        self._evict(keep=model_name)
+        return loaded
+
+    def resident_bytes(self) -> int:
+        return sum(loaded.memory_bytes for loaded in self._models.values())
+
+    def stats(self) -> dict:
+        return {
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "switches": self.switches,
+            "load_seconds": self.load_seconds,
+            "resident_bytes": self.resident_bytes(),
+            "resident": {
+                name: {"memory_bytes": loaded.memory_bytes, "load_seconds": loaded.load_seconds}
+                for name, loaded in self._models.items()
+            },
+        }
+
+    def clear(self):
+        while len(self._models) > 0:
+            _, loaded = self._models.popitem(last=False)
+            self._unloader(loaded)
+
+    def _evict(self, keep: str):
+        while self.resident_bytes() > self._memory_budget and len(self._models) > 1:
+            name = next(iter(self._models))
+            if name == keep:
+                self._models.move_to_end(name)
+                continue
+            loaded = self._models.pop(name)
+            logging.info(f"Unloading {name} to stay within the model memory budget")
+            self._unloader(loaded)
+            self.evictions += 1
+            MODEL_EVICTIONS.inc(name)
@@ -0,0 +1,220 @@
+import dataclasses
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from core.metrics import NEAR_DUPLICATE_LOOKUPS
+from core.tagging import TaggingOptions, TagResult
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+# the hash is stored as four 16 bit bands, each indexed
+BANDS = 4
+BAND_BITS = HASH_BITS // BANDS
+# resized and re-encoded copies are usually within 2 bits. Up to 3 only rows sharing a whole band are compared,
+# from 4 to 7 a lookup probes 17 values per band and compares ~17x more rows.
+DEFAULT_MAX_DISTANCE = 3
+# beyond this a lookup would probe thousands of values per band
+MAX_DISTANCE = 4 * BANDS - 1
+# sqlite page cache, the band indexes are written at random
+CACHE_KIB = 64 * 1024
+DEFAULT_MAX_ENTRIES = 5_000_000
+
+# orthonormal DCT-II basis for the 32x32 grayscale copy pHash is computed from
+_DCT_SIZE = 32
+_DCT = np.sqrt(2 / _DCT_SIZE) * np.cos(
+    np.pi * (2 * np.arange(_DCT_SIZE)[None, :] + 1) * np.arange(_DCT_SIZE)[:, None] / (2 * _DCT_SIZE)
+)
+_DCT[0] /= np.sqrt(2)
+_DCT = _DCT.astype(np.float32)
+_CHANNEL_SUM = np.ones((1, 3), dtype=np.float32)
+
+
+def perceptual_hash(image: np.ndarray) -> int:
+    # pHash of a preprocessed (height, width, 3) image: the lowest 8x8 frequencies of the DCT of a 32x32 grayscale
+    # copy, a bit set for each one above their median. Resizing, re-encoding and format changes move few bits.
+    # Channels are averaged, so BGR tagger input and normalized RGB captioner input both work.
+    small = cv2.resize(_trim_padding(image), (_DCT_SIZE, _DCT_SIZE), interpolation=cv2.INTER_AREA).mean(axis=2)
+    frequencies = (_DCT @ small @ _DCT.T)[:8, :8]
+    bits = frequencies > np.median(frequencies)
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _trim_padding(image: np.ndarray) -> np.ndarray:
+    # Preprocessing centers the picture on a square of the padding colour, and doesn't scale up pictures smaller than
+    # the model input. Only the picture is hashed, so a small copy matches the full size one.
+    # summed per channel difference from the corner pixel, cv2 is much faster at this than numpy's channel axis
+    difference = cv2.transform(cv2.absdiff(image, (*image[0, 0].tolist(), 0.0)), _CHANNEL_SUM)
+    rows = np.flatnonzero(difference.max(axis=1) > 0)
+    columns = np.flatnonzero(difference.max(axis=0) > 0)
+    if len(rows) == 0:
+        return image
+    return np.ascontiguousarray(image[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1])
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def variant_key(model_name: str, options: TaggingOptions) -> str:
+    # tags are only reused for the same model and options
+    digest = hashlib.blake2b(model_name.encode("utf-8"), digest_size=16)
+    digest.update(json.dumps(dataclasses.asdict(options), sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class NearDuplicateIndex:
+    """
+    Tag results keyed on the perceptual hash of the preprocessed image, so a resized or re-encoded copy of an image
+    already tagged is answered without running the model. Lookups find the nearest stored hash within max_distance
+    bits by multi-index hashing: of two hashes that close, at least one of their four 16 bit bands differs in at
+    most max_distance // 4 bits, so only rows with a band equal to one of those few neighbours are compared. The
+    sqlite table persists across restarts and can be shared by workers. It's trimmed back to max_entries, oldest
+    first.
+    """
+
+    def __init__(self, db_path: str, max_distance: int = DEFAULT_MAX_DISTANCE, max_entries: int = DEFAULT_MAX_ENTRIES):
+        if not 0 <= max_distance <= MAX_DISTANCE:
+            raise ValueError(f"max_distance must be between 0 and {MAX_DISTANCE}, got {max_distance}")
+        self._max_distance = max_distance
+        self._max_entries = max_entries
+        self._mutex = threading.Lock()
+        # variant key -> its row id, hashes refer to a small integer to keep the band indexes small
+        self._variants: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(f"PRAGMA cache_size=-{CACHE_KIB}")
+        self._db.execute("CREATE TABLE IF NOT EXISTS variants (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE)")
+        bands = ", ".join(f"band{band} INTEGER NOT NULL" for band in range(BANDS))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            f"id INTEGER PRIMARY KEY, variant INTEGER NOT NULL, hash INTEGER NOT NULL, {bands}, result TEXT NOT NULL)"
+        )
+        for band in range(BANDS):
+            # the hash is in the index so candidates are compared without reading their rows
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS hashes_band{band} ON hashes (variant, band{band}, hash)")
+        self._entries = self._db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def get(self, image_hash: int, model_name: str, options: TaggingOptions) -> Optional[TagResult]:
+        radius = self._max_distance // BANDS
+        with self._mutex:
+            variant = self._variant_id(variant_key(model_name, options))
+            queries = []
+            parameters = []
+            for band, value in enumerate(_bands(image_hash)):
+                neighbours = _neighbours(value, radius)
+                queries.append(f"SELECT id, hash FROM hashes WHERE variant = ? AND band{band} IN ({','.join('?' * len(neighbours))})")
+                parameters.extend([variant, *neighbours])
+            best_id, best_distance = None, self._max_distance + 1
+            for row_id, stored in self._db.execute(" UNION ".join(queries), parameters):
+                distance = hamming_distance(image_hash, _unsigned(stored))
+                if distance < best_distance:
+                    best_id, best_distance = row_id, distance
+            if best_id is None:
+                self.misses += 1
+                NEAR_DUPLICATE_LOOKUPS.inc("miss")
+                return None
+            row = self._db.execute("SELECT result FROM hashes WHERE id = ?", (best_id,)).fetchone()
+            self.hits += 1
+            NEAR_DUPLICATE_LOOKUPS.inc("hit")
+        return TagResult.from_response(json.loads(row[0]))
+
+    def put(self, image_hash: int, model_name: str, options: TaggingOptions, result: TagResult):
+        value = json.dumps(result.to_response(), separators=(",", ":"))
+        with self._mutex:
+            self._db.execute(
+                f"INSERT INTO hashes (variant, hash, {', '.join(f'band{band}' for band in range(BANDS))}, result) "
+                f"VALUES (?, ?, {', '.join('?' * BANDS)}, ?)",
+                (self._variant_id(variant_key(model_name, options)), _signed(image_hash), *_bands(image_hash), value),
+            )
+            self._entries += 1
+            if self._entries > self._max_entries:
+                self._evict()
+
+    def put_many(self, rows: list[tuple[int, str, TaggingOptions, TagResult]]):
+        # one transaction for many entries, used to fill the index for benchmarks
+        with self._mutex:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                f"INSERT INTO hashes (variant, hash, {', '.join(f'band{band}' for band in range(BANDS))}, result) "
+                f"VALUES (?, ?, {', '.join('?' * BANDS)}, ?)",
+                (
+                    (
+                        self._variant_id(variant_key(model_name, options)),
+                        _signed(image_hash),
+                        *_bands(image_hash),
+                        json.dumps(result.to_response(), separators=(",", ":")),
+                    )
+                    for image_hash, model_name, options, result in rows
+                ),
+            )
+            self._db.execute("COMMIT")
+            self._entries += len(rows)
+
+    def stats(self) -> dict[str, int]:
+        with self._mutex:
+            return {"hits": self.hits, "misses": self.misses, "entries": self._entries}
+
+    def close(self):
+        with self._mutex:
+            self._db.close()
+
+    def _variant_id(self, key: str) -> int:
+        variant = self._variants.get(key)
+        if variant is None:
+            # another worker may have added it first
+            self._db.execute("INSERT OR IGNORE INTO variants (key) VALUES (?)", (key,))
+            variant = self._db.execute("SELECT id FROM variants WHERE key = ?", (key,)).fetchone()[0]
+            self._variants[key] = variant
+        return variant
+
+    def _evict(self):
+        # trim to 90% of max_entries so every put near the limit doesn't trigger another eviction
+        target = int(self._max_entries * 0.9)
+        evicted = self._entries - target
+        self._db.execute(
+            "DELETE FROM hashes WHERE id IN (SELECT id FROM hashes ORDER BY id LIMIT ?)",
+            (evicted,),
+        )
+        self._entries = self._db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        logging.info(f"Evicted {evicted} near duplicate hashes, {self._entries} remain")
+
+
+def _bands(image_hash: int) -> list[int]:
+    mask = (1 << BAND_BITS) - 1
+    return [(image_hash >> (band * BAND_BITS)) & mask for band in range(BANDS)]
+
+
+def _neighbours(value: int, radius: int) -> list[int]:
+    # every band value within radius bits of value, value itself first
+    values = [value]
+    for distance in range(1, radius + 1):
+        for bits in itertools.combinations(range(BAND_BITS), distance):
+            flipped = value
+            for bit in bits:
+                flipped ^= 1 << bit
+            values.append(flipped)
+    return values
+
+
+def _signed(image_hash: int) -> int:
+    # sqlite integers are signed 64 bit
+    return image_hash - (1 << HASH_BITS) if image_hash >= 1 << (HASH_BITS - 1) else image_hash
+
+
+def _unsigned(stored: int) -> int:
+    return stored + (1 << HASH_BITS) if stored < 0 else stored
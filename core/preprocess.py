@@ -0,0 +1,160 @@
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from core import dbimutils as dbimutils
+from core.metrics import timed
+from core.tagging import TaggingOptions, FRAME_SAMPLING_SCENE
+
+# frames are compared for scene changes as grayscale thumbnails of this size
+SCENE_THUMBNAIL_SIZE = 32
+# Times the target size an image is kept at before the final resize. Decoding or reducing closer than that lets
+# edges drift well past the full resolution output, INTER_AREA needs room to average over.
+DRAFT_MARGIN = 2
+REDUCE_MARGIN = 4
+
+
+def preprocess_legacy(image_source, size: int) -> np.ndarray:
+    # the original full resolution pipeline, kept to check preprocess() against
+    image: Image.Image = Image.open(image_source)
+
+    # code for converting the image and running the model is taken from the link below
+    # thanks, SmilingWolf!
+    # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
+
+    # alpha to white
+    image = image.convert('RGBA')
+    new_image = Image.new('RGBA', image.size, 'WHITE')
+    new_image.paste(image, mask=image)
+    image = new_image.convert('RGB')
+    image = np.asarray(image)
+
+    # PIL RGB to OpenCV BGR
+    image = image[:, :, ::-1]
+
+    image = dbimutils.make_square(image, size)
+    image = dbimutils.smart_resize(image, size)
+    image = image.astype(np.float32)
+    return image
+
+
+def preprocess(image_source, size: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+    # Close to the output of preprocess_legacy (not bit exact, see _load_reduced), but the image is shrunk as early
+    # as possible so alpha compositing, padding and resizing happen near the target size instead of at full
+    # resolution.
+    with timed("decode"):
+        image: Image.Image = Image.open(image_source)
+        image = _to_rgb(_load_reduced(image, size))
+    with timed("resize"):
+        return _resize_into(image, size, out)
+
+
+def preprocess_frames(image_source, size: int, options: TaggingOptions, out: Optional[np.ndarray] = None) -> np.ndarray:
+    # A (size, size, 3) array for still images like preprocess(), written to out when given, or
+    # (frames, size, size, 3) holding the frames of an animated GIF, APNG or WebP picked by the options' frame
+    # sampling.
+    with timed("decode"):
+        image: Image.Image = Image.open(image_source)
+        if getattr(image, "n_frames", 1) == 1:
+            frames = None
+            image = _to_rgb(_load_reduced(image, size))
+        else:
+            frames = [_to_rgb(frame) for frame in _sample_frames(image, size, options)]
+    with timed("resize"):
+        if frames is None:
+            return _resize_into(image, size, out)
+        out = np.empty((len(frames), size, size, 3), dtype=np.float32)
+        for frame, frame_out in zip(frames, out):
+            _resize_into(frame, size, frame_out)
+        return out
+
+
+def preprocess_caption(
+        image_source,
+        size: tuple[int, int],
+        mean: np.ndarray,
+        std: np.ndarray,
+        out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    # A (height, width, 3) RGB array scaled to 0..1 and normalized by the mean and std of a captioning model's
+    # image processor. The image is fitted inside and padded with black, like captioning always did. It's kept
+    # channels last like the tagger input, so both share the same pooled buffers.
+    height, width = size
+    with timed("decode"):
+        image: Image.Image = Image.open(image_source)
+        image = _to_rgb(_load_reduced(image, max(size)))
+    with timed("resize"):
+        image.thumbnail((width, height), Image.Resampling.LANCZOS)
+        padded = Image.new("RGB", (width, height), (0, 0, 0))
+        padded.paste(image, ((width - image.size[0]) // 2, (height - image.size[1]) // 2))
+        if out is None:
+            out = np.empty((height, width, 3), dtype=np.float32)
+        np.copyto(out, np.asarray(padded), casting='unsafe')
+        out /= 255
+        out -= mean
+        out /= std
+        return out
+
+
+def _sample_frames(image: Image.Image, size: int, options: TaggingOptions) -> list[Image.Image]:
+    # seeking decodes every frame before the target anyway, so frames are visited in order
+    frames = []
+    last_thumbnail = None
+    for index in range(0, image.n_frames, options.frame_step):
+        image.seek(index)
+        # later frames are drawn over earlier ones, converting gives the composited frame
+        frame = image.convert('RGBA')
+        if options.frame_sampling == FRAME_SAMPLING_SCENE:
+            thumbnail = frame.convert('L').resize((SCENE_THUMBNAIL_SIZE, SCENE_THUMBNAIL_SIZE))
+            thumbnail = np.asarray(thumbnail, dtype=np.float32)
+            if last_thumbnail is not None and np.abs(thumbnail - last_thumbnail).mean() / 255 <= options.scene_threshold:
+                continue
+            last_thumbnail = thumbnail
+        frames.append(_load_reduced(frame, size))
+    if len(frames) > options.max_frames:
+        # spread over the whole animation rather than just its start
+        keep = np.linspace(0, len(frames) - 1, options.max_frames).round().astype(int)
+        frames = [frames[index] for index in keep]
+    return frames
+
+
+def _to_rgb(image: Image.Image) -> Image.Image:
+    if image.mode == 'RGB':
+        return image
+    if image.mode == 'L':
+        return image.convert('RGB')
+    # alpha to white, pasted straight onto an RGB canvas, which gives the same pixels as compositing in RGBA
+    image = image.convert('RGBA')
+    new_image = Image.new('RGB', image.size, 'WHITE')
+    new_image.paste(image, mask=image.getchannel('A'))
+    return new_image
+
+
+def _resize_into(image: Image.Image, size: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+    # Padding is white and resizing works per channel, so PIL's RGB is only swapped to OpenCV's BGR at the
+    # target size, instead of cv2 copying a reversed full size view first
+    pixels = np.asarray(image)
+    pixels = dbimutils.make_square(pixels, size)
+    pixels = dbimutils.smart_resize(pixels, size)
+
+    if out is None:
+        out = np.empty((size, size, 3), dtype=np.float32)
+    # swaps to BGR and converts to float32 while copying, no intermediate array
+    np.copyto(out, pixels[:, :, ::-1], casting='unsafe')
+    return out
+
+
+def _load_reduced(image: Image.Image, size: int) -> Image.Image:
+    # Let the decoder skip detail we'd throw away. Every step keeps the image a margin above size so the final
+    # resize is still a real downscale, like it is at full resolution. The result differs from full resolution
+    # by a few values at edges, images already within the margins come out bit exact.
+    if image.format == 'JPEG':
+        # DCT scaling by 1/2, 1/4 or 1/8 while keeping both sides >= the requested box
+        image.draft('RGB' if image.mode == 'RGB' else image.mode, (size * DRAFT_MARGIN, size * DRAFT_MARGIN))
+    image.load()
+    factor = max(image.size) // (size * REDUCE_MARGIN)
+    if factor >= 2 and image.mode in ('RGB', 'RGBA', 'L', 'LA'):
+        # box filtered integer reduce, the remaining factor of 4 to 8 is left to INTER_AREA
+        image = image.reduce(factor)
+    return image
@@ -0,0 +1,37 @@
+import math
+import time
+from typing import Optional
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_NORMAL = "normal"
+PRIORITY_BULK = "bulk"
+# most urgent first, a job is only served once nothing more urgent is waiting
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK)
+
+
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+def read_priority(job_spec: dict) -> str:
+    priority = job_spec.get("priority", PRIORITY_NORMAL)
+    if priority not in PRIORITIES:
+        raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}, got {priority}")
+    return priority
+
+
+def read_deadline(job_spec: dict) -> Optional[float]:
+    # unix time in seconds, the job is dropped with an error if it hasn't reached the model by then
+    deadline = job_spec.get("deadline")
+    if deadline is not None and (isinstance(deadline, bool) or not isinstance(deadline, (int, float))):
+        raise ValueError(f"deadline must be a unix time in seconds, got {deadline}")
+    return None if deadline is None else float(deadline)
+
+
+def is_expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.time() > deadline
+
+
+def urgency(priority: str, deadline: Optional[float]) -> tuple[int, float]:
+    # sorts more urgent work first: by priority, then earliest deadline, jobs without one last
+    return PRIORITIES.index(priority), math.inf if deadline is None else deadline
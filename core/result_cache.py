@@ -0,0 +1,135 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from core.metrics import CACHE_LOOKUPS
+from core.tagging import TaggingOptions, TagResult
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_ENTRIES = 10000
+DEFAULT_MAX_DISK_BYTES = 512 * 1024 * 1024
+
+
+def cache_key(image_bytes: bytes, model_name: str, options: TaggingOptions, generation: Optional[dict] = None) -> str:
+    # Keyed on the encoded bytes rather than the decoded pixels, so a hit costs a hash and no decode. The same image
+    # saved again or in another format misses, --near-duplicates covers those. generation holds the interrogator's
+    # settings that change a model's output, ie: max_caption_tokens.
+    digest = hashlib.blake2b(image_bytes, digest_size=16)
+    digest.update(model_name.encode("utf-8"))
+    digest.update(json.dumps(dataclasses.asdict(options), sort_keys=True).encode("utf-8"))
+    if generation:
+        # left out when empty, which keeps the keys of tagger results from before it was added
+        digest.update(json.dumps(generation, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Tag results keyed on image bytes, model, options and generation settings. Lookups check an in-process LRU first, then a sqlite
+    table on disk which is trimmed back to max_disk_bytes, least recently used first.
+    """
+
+    def __init__(
+            self,
+            db_path: str,
+            memory_entries: int = DEFAULT_MEMORY_ENTRIES,
+            max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES,
+    ):
+        self._memory_entries = memory_entries
+        self._max_disk_bytes = max_disk_bytes
+        self._memory: OrderedDict[str, TagResult] = OrderedDict()
+        self._mutex = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def get(self, key: str) -> Optional[TagResult]:
+        with self._mutex:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                CACHE_LOOKUPS.inc("memory_hit")
+                return result
+            row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc("miss")
+                return None
+            self._db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            result = TagResult.from_response(json.loads(row[0]))
+            self._remember(key, result)
+            self.disk_hits += 1
+            CACHE_LOOKUPS.inc("disk_hit")
+            return result
+
+    def put(self, key: str, result: TagResult):
+        value = json.dumps(result.to_response(), separators=(",", ":"))
+        size = len(value)
+        with self._mutex:
+            self._remember(key, result)
+            previous = self._db.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._disk_bytes += size - (previous[0] if previous else 0)
+            if self._disk_bytes > self._max_disk_bytes:
+                self._evict()
+
+    def stats(self) -> dict[str, int]:
+        with self._mutex:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def close(self):
+        with self._mutex:
+            self._db.close()
+
+    def _remember(self, key: str, result: TagResult):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        # trim to 90% of the budget so every put near the limit doesn't trigger another eviction
+        target = self._max_disk_bytes * 0.9
+        evicted = 0
+        while self._disk_bytes > target:
+            rows = self._db.execute("SELECT key, size FROM results ORDER BY last_used LIMIT 1000").fetchall()
+            if len(rows) == 0:
+                break
+            self._db.execute("BEGIN")
+            for key, size in rows:
+                if self._disk_bytes <= target:
+                    break
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._disk_bytes -= size
+                evicted += 1
+            self._db.execute("COMMIT")
+        logging.info(f"Evicted {evicted} cached results, {self._disk_bytes} bytes remain on disk")
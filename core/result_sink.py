@@ -0,0 +1,235 @@
+import abc
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from core.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+SINK_FILES = "files"
+SINK_JSONL = "jsonl"
+SINK_SQLITE = "sqlite"
+SINKS = (SINK_FILES, SINK_JSONL, SINK_SQLITE)
+DEFAULT_COMMIT_INTERVAL = 0.05
+DEFAULT_MAX_GROUP = 256
+DEFAULT_ROTATE_BYTES = 64 * 1024 * 1024
+
+
+class ResultSink(abc.ABC):
+    """
+    Where finished jobs are written. write() hands back a future that's done once the result is stored, the
+    job's input zip must only be removed after that.
+    """
+
+    def write(self, job_id: str, response: dict) -> Future:
+        return self.write_batch(job_id, [response])
+
+    @abc.abstractmethod
+    def write_batch(self, job_id: str, lines: list[dict]) -> Future:
+        ...
+
+    def close(self):
+        pass
+
+
+class FileResultSink(ResultSink):
+    # data/output/<job_id>.json for single image jobs and <job_id>.jsonl for batch jobs, written before returning
+
+    def __init__(self, output_path: str):
+        self._output_path = output_path
+
+    def write(self, job_id: str, response: dict) -> Future:
+        path = os.path.join(self._output_path, f"{job_id}.json")
+        with open(path, "w") as f:
+            json.dump(response, f, indent=4)
+        logging.info(f"Wrote {job_id}.json")
+        return _done()
+
+    def write_batch(self, job_id: str, lines: list[dict]) -> Future:
+        path = os.path.join(self._output_path, f"{job_id}.jsonl")
+        # renamed into place so readers never see a partial batch
+        partial_path = path + ".partial"
+        with open(partial_path, "w") as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+        os.replace(partial_path, path)
+        logging.info(f"Wrote {job_id}.jsonl with {len(lines)} images")
+        return _done()
+
+
+class _GroupCommitSink(ResultSink):
+    # Writes are queued for one committing thread, which takes everything queued within commit_interval of the
+    # first write (up to max_group jobs) and stores it with a single fsync.
+
+    def __init__(self, commit_interval: float = DEFAULT_COMMIT_INTERVAL, max_group: int = DEFAULT_MAX_GROUP):
+        self._commit_interval = commit_interval
+        self._max_group = max_group
+        self._queue: queue.Queue[tuple[str, list[dict], Future] | None] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="result-sink", daemon=True)
+        self._thread.start()
+
+    def write_batch(self, job_id: str, lines: list[dict]) -> Future:
+        future = Future()
+        self._queue.put((job_id, lines, future))
+        return future
+
+    def close(self):
+        # everything already written is committed before this returns
+        self._queue.put(None)
+        self._thread.join()
+        self._close()
+
+    @abc.abstractmethod
+    def _commit(self, group: list[tuple[str, list[dict]]]):
+        # stores the whole group durably or raises, every job in it then fails
+        ...
+
+    def _close(self):
+        pass
+
+    def _run(self):
+        closing = False
+        while not closing:
+            item = self._queue.get()
+            if item is None:
+                return
+            group = [item]
+            deadline = time.monotonic() + self._commit_interval
+            while len(group) < self._max_group:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                group.append(item)
+            try:
+                with timed("commit"):
+                    self._commit([(job_id, lines) for job_id, lines, _ in group])
+            except Exception as e:
+                logging.error(f"Failed to commit results of {len(group)} jobs: {e}")
+                for _, _, future in group:
+                    future.set_exception(e)
+                continue
+            for _, _, future in group:
+                future.set_result(None)
+
+
+class JsonLinesResultSink(_GroupCommitSink):
+    """
+    Appends one compact line per image to <name>.jsonl, each carrying its job_id. Once the file reaches
+    rotate_bytes it's renamed to <name>.<unix ms>.jsonl, which is never written again, and a new file is started.
+    """
+
+    def __init__(
+            self,
+            output_path: str,
+            name: str,
+            rotate_bytes: int = DEFAULT_ROTATE_BYTES,
+            commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+            max_group: int = DEFAULT_MAX_GROUP,
+    ):
+        self._output_path = output_path
+        self._name = name
+        self._path = os.path.join(output_path, f"{name}.jsonl")
+        self._rotate_bytes = rotate_bytes
+        os.makedirs(output_path, exist_ok=True)
+        self._file = open(self._path, "a")
+        super().__init__(commit_interval, max_group)
+
+    def _commit(self, group: list[tuple[str, list[dict]]]):
+        self._file.write("".join(
+            json.dumps({"job_id": job_id, **line}, separators=(",", ":")) + "\n"
+            for job_id, lines in group
+            for line in lines
+        ))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._file.tell() >= self._rotate_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        rotated_path = os.path.join(self._output_path, f"{self._name}.{time.time_ns() // 1_000_000}.jsonl")
+        os.replace(self._path, rotated_path)
+        logging.info(f"Rotated results to {rotated_path}")
+        self._file = open(self._path, "a")
+
+    def _close(self):
+        self._file.close()
+
+
+class SqliteResultSink(_GroupCommitSink):
+    """
+    Results in a sqlite table indexed by job_id, one row per image with the response as JSON. Single image jobs
+    have image_index 0. Several workers can share the database, WAL mode lets readers query it while it's written.
+    """
+
+    def __init__(
+            self,
+            db_path: str,
+            commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+            max_group: int = DEFAULT_MAX_GROUP,
+    ):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # other workers may hold the write lock for a commit
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # every commit is a group, so fsyncing each one is cheap enough
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "job_id TEXT NOT NULL, image_index INTEGER NOT NULL, response TEXT NOT NULL, finished_at REAL NOT NULL, "
+            "PRIMARY KEY (job_id, image_index))"
+        )
+        super().__init__(commit_interval, max_group)
+
+    def _commit(self, group: list[tuple[str, list[dict]]]):
+        finished_at = time.time()
+        rows = [
+            (job_id, line.get("index", 0), json.dumps(line, separators=(",", ":")), finished_at)
+            for job_id, lines in group
+            for line in lines
+        ]
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results (job_id, image_index, response, finished_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def _close(self):
+        self._db.close()
+
+
+def create_result_sink(
+        kind: str,
+        output_path: str,
+        name: str,
+        rotate_bytes: int = DEFAULT_ROTATE_BYTES,
+        commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+) -> ResultSink:
+    if kind == SINK_FILES:
+        return FileResultSink(output_path)
+    if kind == SINK_JSONL:
+        return JsonLinesResultSink(output_path, name, rotate_bytes=rotate_bytes, commit_interval=commit_interval)
+    if kind == SINK_SQLITE:
+        return SqliteResultSink(os.path.join(output_path, "results.sqlite"), commit_interval=commit_interval)
+    raise ValueError(f"Unknown result sink {kind}, expected one of {', '.join(SINKS)}")
+
+
+def _done() -> Future:
+    future = Future()
+    future.set_result(None)
+    return future
@@ -0,0 +1,97 @@
+import logging
+import os
+
+import numpy as np
+
+from core.tagging import CATEGORY_GENERAL, CATEGORY_CHARACTER, CATEGORY_RATING
+
+logger = logging.getLogger(__name__)
+
+RATINGS = ["general", "sensitive", "questionable", "explicit"]
+DEFAULT_TAG_COUNT = 10000
+# real wd v3 vocabularies have a few thousand character tags among ~10k general ones
+CHARACTER_EVERY = 4
+
+
+def write_stand_in_model(model_dir: str, size: int = 448, tag_count: int = DEFAULT_TAG_COUNT, seed: int = 0):
+    # A tiny model.onnx and selected_tags.csv laid out like a wd v3 tagger: NHWC float32 input of size x size x 3
+    # and one sigmoid confidence per tag. The weights are random but fixed by the seed, so results are reproducible.
+    # It only stands in for the real model's shapes, not its cost.
+
+    # onnx is only needed to build the stand-in, not to run it
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    os.makedirs(model_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    model_input = helper.make_tensor_value_info("input", TensorProto.FLOAT, ["N", size, size, 3])
+    model_output = helper.make_tensor_value_info("predictions_sigmoid", TensorProto.FLOAT, ["N", tag_count])
+    # 8x8 average pooled pixels -> per channel means -> tag logits. Pooling first keeps some work per pixel.
+    weights = numpy_helper.from_array((rng.standard_normal((3, tag_count)) / 50).astype(np.float32), "weights")
+    bias = numpy_helper.from_array((rng.standard_normal(tag_count) * 2 - 3).astype(np.float32), "bias")
+    axes = numpy_helper.from_array(np.array([2, 3], dtype=np.int64), "axes")
+    nodes = [
+        helper.make_node("Transpose", ["input"], ["nchw"], perm=[0, 3, 1, 2]),
+        helper.make_node("AveragePool", ["nchw"], ["pooled"], kernel_shape=[8, 8], strides=[8, 8]),
+        helper.make_node("ReduceMean", ["pooled", "axes"], ["means"], keepdims=0),
+        helper.make_node("Gemm", ["means", "weights", "bias"], ["logits"]),
+        helper.make_node("Sigmoid", ["logits"], ["predictions_sigmoid"]),
+    ]
+    graph = helper.make_graph(nodes, "stand_in_tagger", [model_input], [model_output], [weights, bias, axes])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 18)])
+    # an ir version onnxruntime releases from the last couple of years can all load
+    model.ir_version = 9
+    onnx.checker.check_model(model)
+    onnx.save(model, os.path.join(model_dir, "model.onnx"))
+
+    with open(os.path.join(model_dir, "selected_tags.csv"), "w") as f:
+        f.write("tag_id,name,category,count\n")
+        for index in range(tag_count):
+            if index < len(RATINGS):
+                name, category = RATINGS[index], CATEGORY_RATING
+            elif index % CHARACTER_EVERY == 0:
+                name, category = f"character_{index}", CATEGORY_CHARACTER
+            else:
+                name, category = f"tag_{index}", CATEGORY_GENERAL
+            f.write(f"{index},{name},{category},0\n")
+    logging.info(f"Wrote stand-in model with {tag_count} tags and {size}x{size} input to {model_dir}")
+
+
+# words the stand-in captioner can generate, on top of the special tokens a BLIP tokenizer needs
+CAPTION_WORDS = [
+    "a", "an", "the", "of", "on", "in", "with", "and", "picture", "photo", "drawing", "girl", "boy", "cat", "dog",
+    "sitting", "standing", "holding", "table", "room", "street", "sky", "red", "blue", "green", "white", "black",
+]
+
+
+def write_stand_in_captioner(model_dir: str, size: int = 384, seed: int = 0):
+    # A tiny BLIP captioning model with random weights, fixed by the seed, saved with its processor like
+    # Salesforce/blip-image-captioning-base so from_pretrained loads it offline. Images go through the same
+    # preprocessing and batched generate as the real model, but the encoder and decoder are a couple of small
+    # layers, so it stands in for everything around the model, not its cost. Captions are random words.
+    import torch
+    from transformers import BlipConfig, BlipForConditionalGeneration, BlipImageProcessor, BlipProcessor, BertTokenizer
+
+    os.makedirs(model_dir, exist_ok=True)
+    special = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[DEC]"]
+    vocab_path = os.path.join(model_dir, "vocab.txt")
+    with open(vocab_path, "w") as f:
+        f.write("\n".join(special + CAPTION_WORDS) + "\n")
+    tokenizer = BertTokenizer(vocab_path, bos_token="[DEC]")
+    layers = {"hidden_size": 32, "intermediate_size": 64, "num_hidden_layers": 2, "num_attention_heads": 4}
+    config = BlipConfig(
+        vision_config={**layers, "image_size": size, "patch_size": 16},
+        text_config={
+            **layers,
+            "vocab_size": len(special) + len(CAPTION_WORDS),
+            "encoder_hidden_size": layers["hidden_size"],
+            "pad_token_id": special.index("[PAD]"),
+            "sep_token_id": special.index("[SEP]"),
+            "bos_token_id": special.index("[DEC]"),
+        },
+    )
+    torch.manual_seed(seed)
+    BlipForConditionalGeneration(config).save_pretrained(model_dir)
+    processor = BlipProcessor(BlipImageProcessor(size={"height": size, "width": size}), tokenizer)
+    processor.save_pretrained(model_dir)
+    logging.info(f"Wrote stand-in captioner with {size}x{size} input to {model_dir}")
@@ -0,0 +1,172 @@
+import csv
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+# categories used by selected_tags.csv
+CATEGORY_GENERAL = 0
+CATEGORY_CHARACTER = 4
+CATEGORY_RATING = 9
+
+DEFAULT_GENERAL_THRESHOLD = 0.35
+DEFAULT_CHARACTER_THRESHOLD = 0.35
+
+# how frames of animated images are picked: every frame_step-th frame, or frames that differ from the last
+# picked one by more than scene_threshold. Either way at most max_frames, spread over the animation.
+FRAME_SAMPLING_EVERY = "every"
+FRAME_SAMPLING_SCENE = "scene"
+FRAME_SAMPLINGS = (FRAME_SAMPLING_EVERY, FRAME_SAMPLING_SCENE)
+# how the confidences of the picked frames are combined into the image's
+FRAME_AGGREGATIONS = ("max", "mean")
+DEFAULT_MAX_FRAMES = 16
+DEFAULT_SCENE_THRESHOLD = 0.05
+
+
+@dataclass(frozen=True)
+class TaggingOptions:
+    general_threshold: float = DEFAULT_GENERAL_THRESHOLD
+    character_threshold: float = DEFAULT_CHARACTER_THRESHOLD
+    top_k: Optional[int] = None
+    include_ratings: bool = False
+    include_confidences: bool = False
+    frame_sampling: str = FRAME_SAMPLING_EVERY
+    frame_step: int = 1
+    max_frames: int = DEFAULT_MAX_FRAMES
+    scene_threshold: float = DEFAULT_SCENE_THRESHOLD
+    frame_aggregation: str = "max"
+
+    @staticmethod
+    def from_job_spec(job_spec: dict) -> "TaggingOptions":
+        options = job_spec.get("options", {})
+        if not isinstance(options, dict):
+            raise ValueError("options must be an object")
+        general_threshold = _read_threshold(options, "general_threshold", DEFAULT_GENERAL_THRESHOLD)
+        character_threshold = _read_threshold(options, "character_threshold", DEFAULT_CHARACTER_THRESHOLD)
+        top_k = options.get("top_k")
+        if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1):
+            raise ValueError(f"top_k must be a positive integer, got {top_k}")
+        include_ratings = options.get("include_ratings", False)
+        include_confidences = options.get("include_confidences", False)
+        if not isinstance(include_ratings, bool):
+            raise ValueError(f"include_ratings must be true or false, got {include_ratings}")
+        if not isinstance(include_confidences, bool):
+            raise ValueError(f"include_confidences must be true or false, got {include_confidences}")
+        frame_sampling = options.get("frame_sampling", FRAME_SAMPLING_EVERY)
+        if frame_sampling not in FRAME_SAMPLINGS:
+            raise ValueError(f"frame_sampling must be one of {', '.join(FRAME_SAMPLINGS)}, got {frame_sampling}")
+        frame_aggregation = options.get("frame_aggregation", "max")
+        if frame_aggregation not in FRAME_AGGREGATIONS:
+            raise ValueError(f"frame_aggregation must be one of {', '.join(FRAME_AGGREGATIONS)}, got {frame_aggregation}")
+        return TaggingOptions(
+            general_threshold=general_threshold,
+            character_threshold=character_threshold,
+            top_k=top_k,
+            include_ratings=include_ratings,
+            include_confidences=include_confidences,
+            frame_sampling=frame_sampling,
+            frame_step=_read_positive_int(options, "frame_step", 1),
+            max_frames=_read_positive_int(options, "max_frames", DEFAULT_MAX_FRAMES),
+            scene_threshold=_read_threshold(options, "scene_threshold", DEFAULT_SCENE_THRESHOLD),
+            frame_aggregation=frame_aggregation,
+        )
+
+
+def _read_threshold(options: dict, key: str, default: float) -> float:
+    value = options.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 1:
+        raise ValueError(f"{key} must be a number between 0 and 1, got {value}")
+    return float(value)
+
+
+def _read_positive_int(options: dict, key: str, default: int) -> int:
+    value = options.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"{key} must be a positive integer, got {value}")
+    return value
+
+
+@dataclass
+class TagResult:
+    tags: list[str]
+    confidences: Optional[dict[str, float]] = None
+    ratings: Optional[dict[str, float]] = None
+    # the generated sentence captioning models take their tags from
+    caption: Optional[str] = None
+
+    def to_response(self) -> dict:
+        response = {"tags": self.tags}
+        if self.confidences is not None:
+            response["confidences"] = self.confidences
+        if self.ratings is not None:
+            response["ratings"] = self.ratings
+        if self.caption is not None:
+            response["caption"] = self.caption
+        return response
+
+    @staticmethod
+    def from_response(response: dict) -> "TagResult":
+        return TagResult(
+            tags=response["tags"],
+            confidences=response.get("confidences"),
+            ratings=response.get("ratings"),
+            caption=response.get("caption"),
+        )
+
+
+class TagVocabulary:
+    """
+    The tags a wd model can output, loaded once into arrays so a whole batch of confidence rows can be
+    thresholded with a single mask.
+    """
+
+    def __init__(self, names: np.ndarray, categories: np.ndarray):
+        self.names = names
+        self.categories = categories
+        self._rating_indices = np.flatnonzero(categories == CATEGORY_RATING)
+        self._is_character = categories == CATEGORY_CHARACTER
+        self._is_rating = categories == CATEGORY_RATING
+
+    @staticmethod
+    def load(tags_path: str) -> "TagVocabulary":
+        names = []
+        categories = []
+        with open(tags_path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                names.append(row["name"].replace("_", " "))
+                categories.append(int(row["category"]))
+        return TagVocabulary(np.array(names, dtype=object), np.array(categories, dtype=np.int16))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def select(self, confidences: np.ndarray, options: TaggingOptions) -> list[TagResult]:
+        # confidences is (batch, tags)
+        thresholds = np.where(self._is_character, options.character_threshold, options.general_threshold)
+        mask = (confidences > thresholds) & ~self._is_rating
+
+        if options.top_k is not None:
+            # keep only the k most confident tags that passed their threshold, most confident first
+            masked = np.where(mask, confidences, -np.inf)
+            k = min(options.top_k, masked.shape[1])
+            top = np.argpartition(-masked, k - 1, axis=1)[:, :k]
+            top_confidences = np.take_along_axis(masked, top, axis=1)
+            order = np.argsort(-top_confidences, axis=1, kind="stable")
+            top = np.take_along_axis(top, order, axis=1)
+            selected_indices = [row[np.isfinite(masked[i, row])] for i, row in enumerate(top)]
+        else:
+            selected_indices = [np.flatnonzero(row) for row in mask]
+
+        results = []
+        for row, indices in zip(confidences, selected_indices):
+            names = self.names[indices].tolist()
+            result = TagResult(tags=names)
+            if options.include_confidences:
+                result.confidences = dict(zip(names, row[indices].tolist()))
+            if options.include_ratings:
+                result.ratings = dict(zip(
+                    self.names[self._rating_indices].tolist(),
+                    row[self._rating_indices].tolist(),
+                ))
+            results.append(result)
+        return results
@@ -0,0 +1,257 @@
+import cProfile
+import heapq
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_SLOWEST = 10
+# tracing is on while this file exists in the trace dir
+CONTROL_FILE = "enabled"
+CONTROL_INTERVAL = 1.0
+
+# true while any job is being traced, timed() only looks for the thread's traces then
+active = False
+_live = 0
+_live_mutex = threading.Lock()
+_local = threading.local()
+
+
+class JobTrace:
+    """
+    Spans of one job across every thread that handled it, written out as Chrome trace events. When profiled, the
+    cProfile stats of the code run for it are gathered too.
+    """
+
+    def __init__(self, job_id: str, profiled: bool = False):
+        self.job_id = job_id
+        self.profiled = profiled
+        self.started_at = time.perf_counter()
+        self.finished_at: Optional[float] = None
+        self._events: list[tuple[str, float, float, int, dict]] = []
+        self._threads: dict[int, str] = {}
+        self._profiles: list[cProfile.Profile] = []
+        self._mutex = threading.Lock()
+
+    def add(self, name: str, start: float, end: float, args: Optional[dict] = None):
+        # start and end are time.perf_counter()
+        thread = threading.current_thread()
+        with self._mutex:
+            if self.finished_at is not None:
+                return
+            self._threads[thread.ident] = thread.name
+            self._events.append((name, start, end, thread.ident, args or {}))
+
+    def add_profile(self, profile: cProfile.Profile):
+        with self._mutex:
+            if self.finished_at is None:
+                self._profiles.append(profile)
+
+    def finish(self) -> float:
+        # seconds from the earliest span to now
+        with self._mutex:
+            self.finished_at = time.perf_counter()
+            return self.finished_at - min([self.started_at, *(event[1] for event in self._events)])
+
+    def to_chrome(self) -> dict:
+        # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+        pid = os.getpid()
+        with self._mutex:
+            origin = min([self.started_at, *(event[1] for event in self._events)])
+            events = [
+                {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self._threads.items()
+            ]
+            for name, start, end, tid, args in self._events:
+                events.append({
+                    "name": name,
+                    "cat": "stage",
+                    "ph": "X",
+                    "ts": round((start - origin) * 1e6, 1),
+                    "dur": round((end - start) * 1e6, 1),
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args,
+                })
+            end = self.finished_at if self.finished_at is not None else time.perf_counter()
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"job_id": self.job_id, "duration_ms": round((end - origin) * 1000, 3)},
+        }
+
+    def write_profile(self, path: str):
+        with self._mutex:
+            profiles = list(self._profiles)
+        if len(profiles) == 0:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+
+class use:
+    # with use(job.trace): ... makes the trace current on this thread, so timed() blocks inside add their span to
+    # it. Several traces share the spans of a batch. A plain class so it costs next to nothing when None is passed.
+    __slots__ = ("_traces", "_args", "_previous", "_profile")
+
+    def __init__(self, *traces: Optional[JobTrace], **args):
+        self._traces = [trace for trace in traces if trace is not None]
+        self._args = args
+
+    def __enter__(self):
+        if len(self._traces) == 0:
+            return
+        self._previous = getattr(_local, "traces", None)
+        args = {name: value for name, value in self._args.items() if value is not None}
+        _local.traces = [(trace, args) for trace in self._traces]
+        self._profile = None
+        # cProfile only sees the thread it's enabled on, each traced block gets its own
+        if any(trace.profiled for trace in self._traces) and not getattr(_local, "profiling", False):
+            _local.profiling = True
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def __exit__(self, *exc_info):
+        if len(self._traces) == 0:
+            return
+        _local.traces = self._previous
+        if self._profile is not None:
+            self._profile.disable()
+            _local.profiling = False
+            for trace in self._traces:
+                if trace.profiled:
+                    trace.add_profile(self._profile)
+
+
+class span:
+    # a span in the current traces that isn't also a metrics stage, ie: a stage made of several timed() ones
+    __slots__ = ("_name", "_started")
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter() if active else None
+
+    def __exit__(self, *exc_info):
+        if self._started is not None:
+            record(self._name, self._started, time.perf_counter())
+
+
+def _untrack():
+    global active, _live
+    with _live_mutex:
+        _live -= 1
+        active = _live > 0
+
+
+def record(name: str, start: float, end: float):
+    for trace, args in getattr(_local, "traces", None) or ():
+        trace.add(name, start, end, args)
+
+
+class Tracer:
+    """
+    Decides which jobs are traced and writes each trace to trace_dir as <job_id>.trace.json, which chrome://tracing
+    and ui.perfetto.dev open. Every job is traced while tracing is on (from the start, toggled with toggle() or while
+    trace_dir/enabled exists), and jobs asking for it in job.json always are. A profile_sample share of traced jobs
+    is also run under cProfile, the stats of the profile_slowest slowest of those are kept as <job_id>.prof.
+    """
+
+    def __init__(
+            self,
+            trace_dir: str,
+            enabled: bool = False,
+            profile_sample: float = 0.0,
+            profile_slowest: int = DEFAULT_PROFILE_SLOWEST,
+    ):
+        if not 0 <= profile_sample <= 1:
+            raise ValueError(f"profile_sample must be between 0 and 1, got {profile_sample}")
+        self._trace_dir = trace_dir
+        self._enabled = enabled
+        self._profile_sample = profile_sample
+        self._profile_slowest = profile_slowest
+        self._control_path = os.path.join(trace_dir, CONTROL_FILE)
+        self._control_enabled = False
+        # (seconds, job_id) of the slowest profiled jobs whose stats are kept
+        self._slowest: list[tuple[float, str]] = []
+        self._mutex = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled or self._control_enabled
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch_control_file, name="trace-control", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def toggle(self):
+        self._enabled = not self._enabled
+        logging.info(f"Tracing {'on' if self._enabled else 'off'}, traces are written to {self._trace_dir}")
+
+    def begin(self, job_id: str, requested: bool = False) -> Optional[JobTrace]:
+        # None unless tracing is on or the job asked for it
+        global active, _live
+        if not (requested or self.enabled):
+            return None
+        trace = JobTrace(job_id, profiled=self._profile_sample > 0 and random.random() < self._profile_sample)
+        with _live_mutex:
+            _live += 1
+            active = True
+        return trace
+
+    def discard(self, trace: JobTrace):
+        # for a zip that turned out not to be a job to run, ie: another worker took it
+        _untrack()
+        trace.finish()
+
+    def finish(self, trace: JobTrace):
+        _untrack()
+        seconds = trace.finish()
+        os.makedirs(self._trace_dir, exist_ok=True)
+        path = os.path.join(self._trace_dir, f"{trace.job_id}.trace.json")
+        try:
+            with open(path, "w") as f:
+                json.dump(trace.to_chrome(), f)
+            if trace.profiled:
+                self._keep_if_slowest(trace, seconds)
+        except OSError as e:
+            logging.error(f"Failed to write the trace of job {trace.job_id}: {e}")
+            return
+        logging.info(f"Wrote trace of job {trace.job_id} ({seconds * 1000:.0f}ms) to {path}")
+
+    def _keep_if_slowest(self, trace: JobTrace, seconds: float):
+        with self._mutex:
+            if len(self._slowest) >= self._profile_slowest and seconds <= self._slowest[0][0]:
+                return
+            heapq.heappush(self._slowest, (seconds, trace.job_id))
+            evicted = heapq.heappop(self._slowest) if len(self._slowest) > self._profile_slowest else None
+        trace.write_profile(os.path.join(self._trace_dir, f"{trace.job_id}.prof"))
+        if evicted is not None:
+            try:
+                os.remove(os.path.join(self._trace_dir, f"{evicted[1]}.prof"))
+            except FileNotFoundError:
+                pass
+
+    def _watch_control_file(self):
+        while not self._stopping.wait(CONTROL_INTERVAL):
+            enabled = os.path.exists(self._control_path)
+            if enabled != self._control_enabled:
+                self._control_enabled = enabled
+                logging.info(f"Tracing {'on' if enabled else 'off'} from {self._control_path}")